@@ -0,0 +1,239 @@
+"""Offline analysis of the referral graph for abuse review.
+
+The users table is read in keyset-paged chunks (one short read per chunk, with
+a pause between them so writers are never held up for long) into flat NumPy
+arrays. Everything after the load is vectorized:
+
+- chain depth and tree root for every user by pointer jumping, which takes
+  log2(depth) passes; chains that never reach a root are referred_by cycles;
+- referral bursts: referrals per referrer in fixed time windows, counted at
+  two offsets so a burst straddling a window edge is still caught;
+- referral trees (the connected components of the graph) that are too deep,
+  or large and grown within a few hours;
+- payout wallets shared by many accounts, or by accounts in the same tree.
+
+Flagged accounts replace the contents of referral_flags in one short
+transaction, and the admin panel lists them by score. The bot runs this in its
+worker process (see app.run_referral_analysis); it can also be run by hand,
+e.g. against a restored backup:
+
+    python analyze_referrals.py --database user_database.db --dry-run
+"""
+import argparse
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Dict
+
+import numpy as np
+
+ANALYSIS_CHUNK_ROWS = 100_000
+ANALYSIS_CHUNK_PAUSE = 0.02  # seconds between chunks, lets writers in
+
+BURST_WINDOW = 3600
+BURST_REFERRALS = 20  # referrals by one referrer within BURST_WINDOW
+CHAIN_DEPTH = 15
+FARM_WINDOW = 6 * 3600
+FARM_MIN_SIZE = 25  # a tree at least this big that grew within FARM_WINDOW
+SHARED_WALLET_ACCOUNTS = 3
+MAX_JUMPS = 64  # pointer jumping covers chains up to 2**64 long
+
+# reason -> score; an account's score is the sum over its reasons
+FLAG_WEIGHTS = {
+    'cycle': 5,
+    'wallet_in_tree': 4,
+    'burst': 3,
+    'farm': 3,
+    'shared_wallet': 2,
+    'deep_chain': 1,
+}
+
+USERS_QUERY = '''
+    SELECT user_id, COALESCE(referred_by, -1), COALESCE(CAST(strftime('%s', joined_at) AS INTEGER), -1),
+           wallet_address
+    FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+'''
+EDGE_DTYPE = np.dtype([('user_id', np.int64), ('referred_by', np.int64), ('joined', np.int64)])
+
+
+def load_users(conn) -> Dict[str, np.ndarray]:
+    """user_id, referred_by and join time (unix, -1 if unknown) per user, ordered by user_id,
+    and a wallet group per user (-1 without a wallet)."""
+    chunks = []
+    wallet_chunks = []
+    wallet_groups: Dict[str, int] = {}
+    last_user_id = -(1 << 63)
+    while True:
+        rows = conn.execute(USERS_QUERY, (last_user_id, ANALYSIS_CHUNK_ROWS)).fetchall()
+        if not rows:
+            break
+        chunks.append(np.fromiter((row[:3] for row in rows), dtype=EDGE_DTYPE, count=len(rows)))
+        wallet_chunks.append(np.fromiter(
+            (-1 if row[3] is None else wallet_groups.setdefault(row[3], len(wallet_groups)) for row in rows),
+            dtype=np.int64, count=len(rows)
+        ))
+        last_user_id = rows[-1][0]
+        if len(rows) < ANALYSIS_CHUNK_ROWS:
+            break
+        time.sleep(ANALYSIS_CHUNK_PAUSE)
+    users = np.concatenate(chunks) if chunks else np.empty(0, EDGE_DTYPE)
+    return {
+        'user_id': users['user_id'],
+        'referred_by': users['referred_by'],
+        'joined': users['joined'],
+        'wallet': np.concatenate(wallet_chunks) if wallet_chunks else np.empty(0, np.int64),
+    }
+
+
+def parent_index(user_id: np.ndarray, referred_by: np.ndarray) -> np.ndarray:
+    """Row index of each user's referrer, -1 for none (or a referrer that no longer exists)."""
+    position = np.searchsorted(user_id, referred_by)
+    position[position == len(user_id)] = 0
+    found = (referred_by >= 0) & (user_id[position] == referred_by) if len(user_id) else referred_by >= 0
+    return np.where(found, position, -1)
+
+
+def chain_depths(parent: np.ndarray):
+    """(depth, root, in_cycle) per user by pointer jumping.
+
+    ancestor[i] starts as the referrer (roots point to themselves) and doubles
+    its reach every pass, while depth[i] accumulates the hops skipped.
+    """
+    index = np.arange(len(parent))
+    is_root = parent < 0
+    ancestor = np.where(is_root, index, parent)
+    depth = (~is_root).astype(np.int64)
+    for _ in range(MAX_JUMPS):
+        next_ancestor = ancestor[ancestor]
+        if np.array_equal(next_ancestor, ancestor):
+            break
+        depth = depth + depth[ancestor]
+        ancestor = next_ancestor
+    # A chain that never reaches a real root runs into a cycle
+    in_cycle = ~is_root[ancestor]
+    return depth, ancestor, in_cycle
+
+
+def referral_bursts(referrer: np.ndarray, joined: np.ndarray) -> np.ndarray:
+    """Most referrals each row index made within one BURST_WINDOW (0 for none)."""
+    most = np.zeros(0 if not len(referrer) else referrer.max() + 1, dtype=np.int64)
+    for offset in (0, BURST_WINDOW // 2):
+        window = (joined + offset) // BURST_WINDOW
+        windows = window.max() + 1 if len(window) else 1
+        keys, counts = np.unique(referrer * windows + window, return_counts=True)
+        np.maximum.at(most, keys // windows, counts)
+    return most
+
+
+def analyze(users: Dict[str, np.ndarray]) -> Dict:
+    """Flags per row index: {index: [(reason, detail), ...]}, plus graph totals."""
+    n = len(users['user_id'])
+    parent = parent_index(users['user_id'], users['referred_by'])
+    depth, root, in_cycle = chain_depths(parent)
+    joined = users['joined']
+    flags = defaultdict(list)
+
+    for i in np.flatnonzero(in_cycle):
+        flags[i].append(('cycle', "referral chain loops back on itself"))
+
+    # Only referrals in proper trees count below; cycles are flagged already
+    in_tree = ~in_cycle
+    edge = (parent >= 0) & in_tree & (joined >= 0)
+    bursts = referral_bursts(parent[edge], joined[edge])
+    for i in np.flatnonzero(bursts >= BURST_REFERRALS):
+        flags[i].append(('burst', f"{bursts[i]} referrals within {BURST_WINDOW // 60} min"))
+
+    # Trees are the components of the graph: every user reaches exactly one root
+    tree_size = np.bincount(root[in_tree], minlength=n)
+    tree_depth = np.zeros(n, dtype=np.int64)
+    np.maximum.at(tree_depth, root[in_tree], depth[in_tree])
+    timed = in_tree & (joined >= 0)
+    first_join = np.full(n, np.iinfo(np.int64).max)
+    last_join = np.full(n, -1)
+    np.minimum.at(first_join, root[timed], joined[timed])
+    np.maximum.at(last_join, root[timed], joined[timed])
+    span = last_join - first_join
+    for i in np.flatnonzero(tree_depth >= CHAIN_DEPTH):
+        flags[i].append(('deep_chain', f"referral chain {tree_depth[i]} deep below this account"))
+    for i in np.flatnonzero((tree_size >= FARM_MIN_SIZE) & (last_join >= 0) & (span <= FARM_WINDOW)):
+        flags[i].append(('farm', f"{tree_size[i]} accounts in its tree joined within {span[i] / 3600:.1f}h"))
+
+    wallet = users['wallet']
+    has_wallet = wallet >= 0
+    wallet_groups = wallet.max() + 1 if n else 0
+    accounts = np.zeros(n, dtype=np.int64)
+    accounts[has_wallet] = np.bincount(wallet[has_wallet], minlength=wallet_groups)[wallet[has_wallet]]
+    for i in np.flatnonzero(accounts >= SHARED_WALLET_ACCOUNTS):
+        flags[i].append(('shared_wallet', f"wallet shared by {accounts[i]} accounts"))
+    # The same payout wallet on both ends of a referral chain is self-referral
+    candidates = np.flatnonzero((accounts > 1) & in_tree)
+    if len(candidates):
+        _, inverse, counts = np.unique(
+            root[candidates] * wallet_groups + wallet[candidates], return_inverse=True, return_counts=True
+        )
+        for i in candidates[counts[inverse] > 1]:
+            flags[i].append(('wallet_in_tree', "wallet shared with another account in its referral tree"))
+
+    return {
+        'flags': flags,
+        'users': n,
+        'referrals': int((parent >= 0).sum()),
+        'trees': int((tree_size > 1).sum()),
+        'largest_tree': int(tree_size.max()) if n else 0,
+        'max_depth': int(depth[in_tree].max()) if in_tree.any() else 0,
+    }
+
+
+def write_flags(conn, user_ids: np.ndarray, flags) -> int:
+    rows = []
+    for i, found in flags.items():
+        reasons = sorted({reason for reason, _ in found}, key=lambda reason: -FLAG_WEIGHTS[reason])
+        rows.append((
+            int(user_ids[i]),
+            sum(FLAG_WEIGHTS[reason] for reason in reasons),
+            ','.join(reasons),
+            '\n'.join(detail for _, detail in found),
+        ))
+    with conn:
+        conn.execute('DELETE FROM referral_flags')
+        conn.executemany(
+            'INSERT INTO referral_flags (user_id, score, reasons, details) VALUES (?, ?, ?, ?)', rows
+        )
+    return len(rows)
+
+
+def analyze_referrals(database: str = 'user_database.db', write: bool = True) -> Dict:
+    """Load the graph from database, flag suspicious accounts and (if write) store them
+    in referral_flags. Returns graph totals, flag counts by reason and timings."""
+    started = time.monotonic()
+    conn = sqlite3.connect(f'file:{database}?mode={"rw" if write else "ro"}', uri=True)
+    try:
+        users = load_users(conn)
+        loaded = time.monotonic()
+        result = analyze(users)
+        analyzed = time.monotonic()
+        flags = result.pop('flags')
+        if write:
+            write_flags(conn, users['user_id'], flags)
+    finally:
+        conn.close()
+    reasons = defaultdict(int)
+    for found in flags.values():
+        for reason in {reason for reason, _ in found}:
+            reasons[reason] += 1
+    result.update(
+        flagged=len(flags),
+        reasons=dict(reasons),
+        load_seconds=round(loaded - started, 2),
+        analysis_seconds=round(analyzed - loaded, 2),
+        duration_seconds=round(time.monotonic() - started, 2),
+    )
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Flag suspicious referral patterns for admin review.')
+    parser.add_argument('--database', default='user_database.db')
+    parser.add_argument('--dry-run', action='store_true', help='report only; leave referral_flags untouched')
+    args = parser.parse_args()
+    print(analyze_referrals(args.database, write=not args.dry_run))
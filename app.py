@@ -3,12 +3,24 @@ import hashlib
 import math
 import logging
 import json
+import io
+import re
 import asyncio
+import heapq
 import streamlit as st
 import pandas as pd
 import os
+import sys
+import gzip
+import shutil
+import signal
+import threading
+import time
+import contextlib
+from array import array
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
@@ -17,15 +29,33 @@ from telegram.ext import (
     CallbackQueryHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
+    BasePersistence,
+    PersistenceInput
 )
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
-
-def init_database():
-    conn = sqlite3.connect('user_database.db')
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from storage import get_repository, close_repository, table_versions, touch_tables
+from exports import EXPORT_FORMATS, EXPORT_QUERIES, create_executor, create_progress, export_path, export_table
+from analyze_referrals import FLAG_WEIGHTS, analyze_referrals
+from profiling import PROFILE_MAX_SECONDS, LoopWatchdog, SamplingProfiler, TimedRequest, start_metrics_server, tracer
+
+def connect_db(database: str = 'user_database.db') -> sqlite3.Connection:
+    """Open the bot's database; queries on it are timed while the tracer is on."""
+    return sqlite3.connect(database, factory=tracer.connection_factory)
+
+def init_database(database: str = 'user_database.db'):
+    conn = connect_db(database)
     cursor = conn.cursor()
 
+    # Incremental auto_vacuum lets the archive job return freed pages to the OS.
+    # This only takes effect on a new, empty database; an existing one is switched
+    # over by `python app.py vacuum`, a full VACUUM run with the bot stopped.
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
     # Ensure users table exists
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -33,10 +63,16 @@ def init_database():
         points INTEGER DEFAULT 0,
         referral_code TEXT UNIQUE,
         referred_by INTEGER,
-        wallet_address TEXT
+        wallet_address TEXT,
+        joined_at TIMESTAMP
     )
     ''')
 
+    # Older databases predate joined_at
+    cursor.execute('PRAGMA table_info(users)')
+    if 'joined_at' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE users ADD COLUMN joined_at TIMESTAMP')
+
     # Ensure messages table exists
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS messages (
@@ -46,10 +82,20 @@ def init_database():
         timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         status TEXT DEFAULT 'pending',
         admin_reply TEXT,
-        replied_by INTEGER
+        replied_by INTEGER,
+        claimed_by INTEGER,
+        claim_expires_at TIMESTAMP
     )
     ''')
 
+    # Older databases predate the inbox claim columns
+    cursor.execute('PRAGMA table_info(messages)')
+    message_columns = {row[1] for row in cursor.fetchall()}
+    if 'claimed_by' not in message_columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN claimed_by INTEGER')
+    if 'claim_expires_at' not in message_columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN claim_expires_at TIMESTAMP')
+
     # Ensure banned words table exists
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS banned_words (
@@ -86,6 +132,406 @@ def init_database():
     )
     ''')
 
+    # Ensure referral_counts table exists (materialized per-referrer totals)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS referral_counts (
+        referrer_id INTEGER PRIMARY KEY,
+        referral_count INTEGER NOT NULL DEFAULT 0,
+        last_referral_at TIMESTAMP
+    )
+    ''')
+
+    # Top-N index so the leaderboard reads the first rows instead of sorting
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_referral_counts_rank
+    ON referral_counts (referral_count DESC, referrer_id)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)')
+
+    # Ensure persistence tables exist (user_data keys and conversation states)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS persisted_user_data (
+        user_id INTEGER,
+        key TEXT,
+        value TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, key)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS persisted_conversations (
+        name TEXT,
+        conversation_key TEXT,
+        state TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (name, conversation_key)
+    ) WITHOUT ROWID
+    ''')
+
+    # Full-text index over the admin inbox, kept in sync with messages by triggers
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        message,
+        admin_reply,
+        content='messages',
+        content_rowid='message_id'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, message, admin_reply)
+        VALUES (new.message_id, new.message, new.admin_reply);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message, admin_reply)
+        VALUES ('delete', old.message_id, old.message, old.admin_reply);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message, admin_reply ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message, admin_reply)
+        VALUES ('delete', old.message_id, old.message, old.admin_reply);
+        INSERT INTO messages_fts (rowid, message, admin_reply)
+        VALUES (new.message_id, new.message, new.admin_reply);
+    END
+    ''')
+    if not fts_exists:
+        cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    # Indexes for the inbox filters (status/date and per-user listings)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_status_timestamp ON messages (status, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages (user_id, timestamp)')
+
+    # Indexes backing audience segment predicates
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_points ON users (points)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users (joined_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_with_wallet ON users (user_id) WHERE wallet_address IS NOT NULL')
+
+    # Ensure audience segment tables exist
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS audience_segments (
+        name TEXT PRIMARY KEY,
+        predicates TEXT NOT NULL,
+        refresh_interval INTEGER DEFAULT 0,
+        refreshed_at TIMESTAMP,
+        member_count INTEGER,
+        created_by INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS segment_members (
+        segment_name TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (segment_name, user_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # Old referral codes keep resolving after migration to the current format
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS legacy_referral_codes (
+        code TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL
+    )
+    ''')
+
+    # One-off data migrations, applied once and recorded by name
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name TEXT PRIMARY KEY,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute("SELECT 1 FROM schema_migrations WHERE name = 'referral_codes_v2'")
+    if cursor.fetchone() is None:
+        migrate_referral_codes(cursor)
+        cursor.execute("INSERT INTO schema_migrations (name) VALUES ('referral_codes_v2')")
+
+    # Inbox work queue: claims by admin and trigger-maintained counters
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_claims ON messages (claimed_by, claim_expires_at)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute("SELECT 1 FROM counters WHERE name = 'messages_pending'")
+    if cursor.fetchone() is None:
+        cursor.execute('''
+        INSERT INTO counters (name, value)
+        SELECT 'messages_pending', COUNT(*) FROM messages WHERE status = 'pending'
+        ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_pending_insert AFTER INSERT ON messages
+    WHEN new.status = 'pending' BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'messages_pending';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_pending_update AFTER UPDATE OF status ON messages
+    WHEN (old.status = 'pending') != (new.status = 'pending') BEGIN
+        UPDATE counters
+        SET value = value + (CASE WHEN new.status = 'pending' THEN 1 ELSE -1 END)
+        WHERE name = 'messages_pending';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_pending_delete AFTER DELETE ON messages
+    WHEN old.status = 'pending' BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'messages_pending';
+    END
+    ''')
+
+    # Ensure withdrawals table exists (written by the repository with each debit)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        withdrawal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        points INTEGER NOT NULL,
+        wallet_address TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Totals and per-day rollups for /stats, kept current by triggers on every write
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER NOT NULL DEFAULT 0,
+        referrals INTEGER NOT NULL DEFAULT 0,
+        messages INTEGER NOT NULL DEFAULT 0,
+        withdrawals INTEGER NOT NULL DEFAULT 0,
+        points_withdrawn INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users BEGIN
+        UPDATE counters SET value = value + CASE name
+            WHEN 'users' THEN 1
+            WHEN 'users_referred' THEN new.referred_by IS NOT NULL
+            ELSE COALESCE(new.points, 0) END
+        WHERE name IN ('users', 'users_referred', 'points_total');
+        INSERT INTO daily_stats (day, new_users, referrals)
+        VALUES (date(COALESCE(new.joined_at, 'now')), 1, new.referred_by IS NOT NULL)
+        ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1, referrals = referrals + excluded.referrals;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users BEGIN
+        UPDATE counters SET value = value - CASE name
+            WHEN 'users' THEN 1
+            WHEN 'users_referred' THEN old.referred_by IS NOT NULL
+            ELSE COALESCE(old.points, 0) END
+        WHERE name IN ('users', 'users_referred', 'points_total');
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_stats_points AFTER UPDATE OF points ON users
+    WHEN old.points IS NOT new.points BEGIN
+        UPDATE counters SET value = value + COALESCE(new.points, 0) - COALESCE(old.points, 0)
+        WHERE name = 'points_total';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_stats_referred AFTER UPDATE OF referred_by ON users
+    WHEN (old.referred_by IS NULL) != (new.referred_by IS NULL) BEGIN
+        UPDATE counters SET value = value + (CASE WHEN new.referred_by IS NULL THEN -1 ELSE 1 END)
+        WHERE name = 'users_referred';
+    END
+    ''')
+    # muted_users is written with upserts only: INSERT OR REPLACE would skip the delete trigger
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS muted_users_stats_insert AFTER INSERT ON muted_users BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'muted_users';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS muted_users_stats_delete AFTER DELETE ON muted_users BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'muted_users';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_stats_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO daily_stats (day, messages) VALUES (date(COALESCE(new.timestamp, 'now')), 1)
+        ON CONFLICT (day) DO UPDATE SET messages = messages + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS withdrawals_stats_insert AFTER INSERT ON withdrawals BEGIN
+        UPDATE counters SET value = value + CASE name WHEN 'withdrawals' THEN 1 ELSE new.points END
+        WHERE name IN ('withdrawals', 'points_withdrawn');
+        INSERT INTO daily_stats (day, withdrawals, points_withdrawn)
+        VALUES (date(COALESCE(new.created_at, 'now')), 1, new.points)
+        ON CONFLICT (day) DO UPDATE SET
+            withdrawals = withdrawals + 1, points_withdrawn = points_withdrawn + excluded.points_withdrawn;
+    END
+    ''')
+    # Counters added after the data: one scan each, the first time only
+    for name, query in STATS_COUNTER_BACKFILL.items():
+        cursor.execute('SELECT 1 FROM counters WHERE name = ?', (name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'INSERT INTO counters (name, value) SELECT ?, ({query})', (name,))
+    cursor.execute("SELECT 1 FROM schema_migrations WHERE name = 'daily_stats_backfill'")
+    if cursor.fetchone() is None:
+        backfill_daily_stats(cursor)
+        cursor.execute("INSERT INTO schema_migrations (name) VALUES ('daily_stats_backfill')")
+
+    # Ensure broadcast checkpoint table exists (broadcasts interrupted by shutdown)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_checkpoints (
+        checkpoint_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ad_names TEXT NOT NULL,
+        last_user_id INTEGER NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0,
+        fired_at REAL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    # Older checkpoints predate fired_at (unix time the interrupted pass started)
+    cursor.execute('PRAGMA table_info(broadcast_checkpoints)')
+    if 'fired_at' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE broadcast_checkpoints ADD COLUMN fired_at REAL')
+
+    # Ensure backup metrics table exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS backup_runs (
+        run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        status TEXT NOT NULL,
+        path TEXT,
+        sha256 TEXT,
+        pages INTEGER,
+        size_bytes INTEGER,
+        compressed_bytes INTEGER,
+        duration_seconds REAL,
+        error TEXT
+    )
+    ''')
+
+    # Ensure ad frequency cap tables exist
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ad_frequency (
+        user_id INTEGER PRIMARY KEY,
+        last_bucket INTEGER NOT NULL,
+        counts BLOB NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ad_suppressions (
+        ad_name TEXT PRIMARY KEY,
+        suppressed INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # Ensure referral flags table exists (rewritten by each referral analysis run)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS referral_flags (
+        user_id INTEGER PRIMARY KEY,
+        score INTEGER NOT NULL,
+        reasons TEXT NOT NULL,
+        details TEXT,
+        flagged_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Backfill counts from existing referrals while the table is still empty
+    cursor.execute('SELECT 1 FROM referral_counts LIMIT 1')
+    if cursor.fetchone() is None:
+        cursor.execute('''
+        INSERT INTO referral_counts (referrer_id, referral_count)
+        SELECT referred_by, COUNT(*)
+        FROM users
+        WHERE referred_by IS NOT NULL
+        GROUP BY referred_by
+        ''')
+
+    # Ensure change feed exists: every write to CHANGE_FEED_TABLES, from any process,
+    # is logged so the bot and dashboard can invalidate what they cache (see ChangeFeed).
+    # Created after the backfills above so they are not logged row by row.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_log (
+        change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        row_id INTEGER,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_log_table ON change_log (table_name)')
+    # Newest change per table; unlike change_log it survives pruning, so it only grows
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS change_versions (
+        table_name TEXT PRIMARY KEY,
+        change_id INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS change_log_version AFTER INSERT ON change_log BEGIN
+        INSERT INTO change_versions (table_name, change_id) VALUES (new.table_name, new.change_id)
+        ON CONFLICT (table_name) DO UPDATE SET change_id = excluded.change_id;
+    END
+    ''')
+    cursor.execute('''
+    INSERT OR IGNORE INTO change_versions (table_name, change_id)
+    SELECT table_name, MAX(change_id) FROM change_log GROUP BY table_name
+    ''')
+    for table, key in CHANGE_FEED_TABLES.items():
+        for operation, row in (('insert', 'new'), ('update', 'new'), ('delete', 'old')):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_change_{operation} AFTER {operation.upper()} ON {table} BEGIN
+                INSERT INTO change_log (table_name, row_id) VALUES ('{table}', {row}.{key});
+            END
+            ''')
+
+    conn.commit()
+
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        logger.warning("Incremental auto_vacuum is off; archived messages won't shrink the file. "
+                       "Stop the bot and run `python app.py vacuum` to enable it.")
+
+    conn.close()
+
+    init_archive_database(os.path.join(os.path.dirname(database), MESSAGE_ARCHIVE_DB))
+
+def init_archive_database(database: str):
+    """Archive of handled messages, with the same messages/messages_fts layout as the hot database."""
+    conn = connect_db(database)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        message TEXT,
+        timestamp TIMESTAMP,
+        status TEXT,
+        admin_reply TEXT,
+        replied_by INTEGER,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp ON messages (user_id, timestamp)')
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        message, admin_reply, content='messages', content_rowid='message_id'
+    )
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, message, admin_reply) VALUES (new.message_id, new.message, new.admin_reply);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, message, admin_reply)
+        VALUES ('delete', old.message_id, old.message, old.admin_reply);
+    END
+    ''')
+
     conn.commit()
     conn.close()
 
@@ -94,14 +540,10 @@ def init_database():
 async def referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT referral_code FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    user = await get_repository().get_user(user_id)
     
-    if result:
-        referral_code = result[0]
+    if user:
+        referral_code = user.referral_code
         referral_link = f"https://t.me/test123zekpotbot?start={referral_code}"
         
         await update.message.reply_text(
@@ -113,83 +555,51 @@ async def referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
+    repo = get_repository()
     
     # Check if user exists
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    existing_user = cursor.fetchone()
+    if await repo.get_user(user_id):
+        await update.message.reply_text(
+            "Welcome back! Use /balance to check your points or /referral to get your referral link."
+        )
+        return
     
-    if not existing_user:
-        # Generate new referral code
-        referral_code = generate_referral_code(user_id)
-        
-        # Check if there's a referral code in the start command
-        if context.args and len(context.args) > 0:
-            referral_code_input = context.args[0]
-            
-            # Find the referrer
-            cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code_input,))
-            referrer = cursor.fetchone()
-            
-            if referrer and referrer[0] != user_id:  # Prevent self-referral
-                # Add points to referrer and notify
-                referrer_id = referrer[0]
-                cursor.execute('''
-                    UPDATE users 
-                    SET points = points + 1500 
-                    WHERE user_id = ?
-                ''', (referrer_id,))
-                
-                # Notify referrer about point addition
-                try:
-                    await context.bot.send_message(
-                        chat_id=referrer_id, 
-                        text=f"🎉 Congratulations! A new user joined using your referral link! You earned 1500 points!"
-                    )
-                except Exception as e:
-                    logger.error(f"Could not send notification to referrer: {e}")
-                
-                # Create new user with referrer tracking
-                cursor.execute('''
-                    INSERT INTO users (user_id, points, referral_code, referred_by) 
-                    VALUES (?, 5000, ?, ?)
-                ''', (user_id, referral_code, referrer_id))
-                
-                await update.message.reply_text(
-                    f"Welcome! You've been given 5000 points for starting and joined through a referral!\n"
-                    f"Your unique referral link is: https://t.me/test123zekpotbot?start={referral_code}"
-                )
-            else:
-                # Create user without referrer
-                cursor.execute('''
-                    INSERT INTO users (user_id, points, referral_code) 
-                    VALUES (?, 5000, ?)
-                ''', (user_id, referral_code))
-                
-                await update.message.reply_text(
-                    f"Welcome! You've been given 5000 starting points!\n"
-                    f"Your unique referral link is: https://t.me/test123zekpotbot?start={referral_code}"
-                )
-        else:
-            # Create user without referrer
-            cursor.execute('''
-                INSERT INTO users (user_id, points, referral_code) 
-                VALUES (?, 5000, ?)
-            ''', (user_id, referral_code))
-            
-            await update.message.reply_text(
-                f"Welcome! You've been given 5000 starting points!\n"
-                f"Your unique referral link is: https://t.me/test123zekpotbot?start={referral_code}"
-            )
-    else:
+    # Generate new referral code
+    referral_code = generate_referral_code(user_id)
+    
+    # Check if there's a referral code in the start command
+    referrer_id = None
+    if context.args and len(context.args) > 0:
+        referrer_id = await resolve_referral_code(context.args[0])
+        if referrer_id == user_id:  # Prevent self-referral
+            referrer_id = None
+    
+    # Create the user, crediting the referrer in the same transaction
+    if not await repo.register_user(user_id, referral_code, referred_by=referrer_id):
         await update.message.reply_text(
             "Welcome back! Use /balance to check your points or /referral to get your referral link."
         )
+        return
     
-    conn.commit()
-    conn.close()
+    if referrer_id:
+        # Notify referrer about point addition
+        try:
+            await context.bot.send_message(
+                chat_id=referrer_id, 
+                text=f"🎉 Congratulations! A new user joined using your referral link! You earned 1500 points!"
+            )
+        except Exception as e:
+            logger.error(f"Could not send notification to referrer: {e}")
+        
+        await update.message.reply_text(
+            f"Welcome! You've been given 5000 points for starting and joined through a referral!\n"
+            f"Your unique referral link is: https://t.me/test123zekpotbot?start={referral_code}"
+        )
+    else:
+        await update.message.reply_text(
+            f"Welcome! You've been given 5000 starting points!\n"
+            f"Your unique referral link is: https://t.me/test123zekpotbot?start={referral_code}"
+        )
 
 WAITING_FOR_WALLET = 1
 
@@ -210,21 +620,11 @@ async def handle_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("Invalid wallet address. Please try again or use /cancel to cancel.")
         return WAITING_FOR_WALLET
 
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-
     try:
-        # Ensure user exists before updating
-        cursor.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
-        existing_user = cursor.fetchone()
-
-        if not existing_user:
+        # Update wallet address; no row means the user never registered
+        if not await get_repository().set_wallet(user_id, wallet_address):
             await update.message.reply_text("User not found. Please use /start first to register.")
             return ConversationHandler.END
-
-        # Update wallet address
-        cursor.execute('UPDATE users SET wallet_address = ? WHERE user_id = ?', (wallet_address, user_id))
-        conn.commit()
         
         await update.message.reply_text(f"✅ Your wallet address has been successfully saved: {wallet_address}")
         return ConversationHandler.END
@@ -233,9 +633,6 @@ async def handle_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("An error occurred while saving your wallet address. Please try again.")
         logging.error(f"Error saving wallet address: {e}")
         return ConversationHandler.END
-    
-    finally:
-        conn.close()
 
 async def cancel_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the wallet settings conversation."""
@@ -247,14 +644,10 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user = update.effective_user
     
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT points, wallet_address FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = await get_repository().get_user(user_id)
     
     if result:
-        points, wallet_address = result
+        points, wallet_address = result.points, result.wallet_address
         
         # Bitcoin image URL (direct Telegram file URL)
         image_url = "https://upload.wikimedia.org/wikipedia/commons/thumb/4/46/Bitcoin.svg/1200px-Bitcoin.svg.png"
@@ -282,45 +675,182 @@ async def handle_start_referral(update: Update, context: ContextTypes.DEFAULT_TY
     new_user_id = update.effective_user.id
     
     if referral_code:
-        conn = sqlite3.connect('user_database.db')
-        cursor = conn.cursor()
+        repo = get_repository()
         
         # Find the referrer
-        cursor.execute('SELECT user_id FROM users WHERE referral_code = ?', (referral_code,))
-        referrer = cursor.fetchone()
+        referrer_id = await resolve_referral_code(referral_code)
         
-        if referrer:
-            # Add points to referrer
-            referrer_id = referrer[0]
-            cursor.execute('''
-                UPDATE users 
-                SET points = points + 1500 
-                WHERE user_id = ?
-            ''', (referrer_id,))
-            
-            # Create new user
+        if referrer_id and referrer_id != new_user_id:
+            # Create new user and add points to referrer
             new_referral_code = generate_referral_code(new_user_id)
-            cursor.execute('''
-                INSERT INTO users (user_id, points, referral_code) 
-                VALUES (?, 5000, ?)
-            ''', (new_user_id, new_referral_code))
-            
-            conn.commit()
-            conn.close()
+            if not await repo.register_user(new_user_id, new_referral_code, referred_by=referrer_id):
+                await start(update, context)
+                return
             
             await update.message.reply_text(
                 f"Welcome! You've been given 5000 points. "
                 f"Your referrer received 1500 points. "
                 f"Your unique referral link is: https://t.me/test123zekpotbot?start={new_referral_code}"
             )
-        else:
-            conn.close()
     else:
         await start(update, context)
 
-# Generate unique referral code (previous function remains the same)
-def generate_referral_code(user_id):
-    return hashlib.sha256(f"referral_{user_id}".encode()).hexdigest()[:8]
+# Referral codes are a keyed, reversible permutation of the user id, so they are
+# unique by construction and a deep link resolves without a referral_code lookup.
+# Telegram user ids have at most 52 significant bits: a 4-round Feistel network
+# over two 26-bit halves, written as 9 base62 characters (62**9 > 2**52).
+REFERRAL_CODE_KEY = os.environ.get('REFERRAL_CODE_KEY', 'referral-code-key-v1').encode()
+REFERRAL_CODE_HALF_BITS = 26
+REFERRAL_CODE_ROUNDS = 4
+REFERRAL_CODE_LENGTH = 9
+BASE62_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+_BASE62_INDEX = {char: index for index, char in enumerate(BASE62_ALPHABET)}
+_HALF_MASK = (1 << REFERRAL_CODE_HALF_BITS) - 1
+
+# HMAC-SHA256 with the padded key states hashed once up front; copying them per
+# round is half the cost of hmac.new (codes are generated in bulk by generate_data.py)
+_hmac_key = REFERRAL_CODE_KEY if len(REFERRAL_CODE_KEY) <= 64 else hashlib.sha256(REFERRAL_CODE_KEY).digest()
+_HMAC_INNER = hashlib.sha256(bytes(byte ^ 0x36 for byte in _hmac_key.ljust(64, b'\0')))
+_HMAC_OUTER = hashlib.sha256(bytes(byte ^ 0x5c for byte in _hmac_key.ljust(64, b'\0')))
+
+def _feistel_round(round_number: int, half: int) -> int:
+    inner = _HMAC_INNER.copy()
+    inner.update(f"{round_number}:{half}".encode())
+    outer = _HMAC_OUTER.copy()
+    outer.update(inner.digest())
+    return int.from_bytes(outer.digest()[:4], 'big') & _HALF_MASK
+
+def _feistel(value: int, rounds) -> int:
+    left, right = value >> REFERRAL_CODE_HALF_BITS, value & _HALF_MASK
+    for round_number in rounds:
+        left, right = right, left ^ _feistel_round(round_number, right)
+    return (right << REFERRAL_CODE_HALF_BITS) | left
+
+def generate_referral_code(user_id: int) -> str:
+    if user_id < 0 or user_id >> (2 * REFERRAL_CODE_HALF_BITS):
+        raise ValueError(f"User id {user_id} does not fit in {2 * REFERRAL_CODE_HALF_BITS} bits")
+    value = _feistel(user_id, range(REFERRAL_CODE_ROUNDS))
+    chars = []
+    for _ in range(REFERRAL_CODE_LENGTH):
+        value, remainder = divmod(value, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+def decode_referral_code(referral_code: str) -> Optional[int]:
+    """Return the user id encoded in referral_code, or None if it isn't a current-format code."""
+    if len(referral_code) != REFERRAL_CODE_LENGTH:
+        return None
+    value = 0
+    for char in referral_code:
+        if char not in _BASE62_INDEX:
+            return None
+        value = value * 62 + _BASE62_INDEX[char]
+    if value >> (2 * REFERRAL_CODE_HALF_BITS):
+        return None
+    # The output halves are swapped, so the same network with the rounds reversed inverts it
+    return _feistel(value, reversed(range(REFERRAL_CODE_ROUNDS)))
+
+async def resolve_referral_code(referral_code: str) -> Optional[int]:
+    repo = get_repository()
+    user_id = decode_referral_code(referral_code)
+    if user_id is not None:
+        # Primary key lookup only confirms the referrer is registered
+        return user_id if await repo.get_user(user_id) else None
+    # Links shared before the migration still carry the old 8-hex-char codes
+    return await repo.find_legacy_referral_code(referral_code)
+
+# counter -> query that computes it from scratch
+STATS_COUNTER_BACKFILL = {
+    'users': 'SELECT COUNT(*) FROM users',
+    'users_referred': 'SELECT COUNT(referred_by) FROM users',
+    'points_total': 'SELECT COALESCE(SUM(points), 0) FROM users',
+    'muted_users': 'SELECT COUNT(*) FROM muted_users',
+    'withdrawals': 'SELECT COUNT(*) FROM withdrawals',
+    'points_withdrawn': 'SELECT COALESCE(SUM(points), 0) FROM withdrawals',
+}
+
+# table -> key column logged to change_log; the tables other processes write to
+CHANGE_FEED_TABLES = {
+    'users': 'user_id',
+    'referral_counts': 'referrer_id',
+    'muted_users': 'user_id',
+    'administrators': 'admin_id',
+}
+
+def read_counter(cursor, name: str) -> int:
+    cursor.execute('SELECT value FROM counters WHERE name = ?', (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def backfill_daily_stats(cursor):
+    """Rebuild daily_stats from the rows already in users, messages and withdrawals."""
+    cursor.execute('DELETE FROM daily_stats')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, new_users, referrals)
+        SELECT date(joined_at), COUNT(*), COUNT(referred_by) FROM users
+        WHERE joined_at IS NOT NULL GROUP BY date(joined_at)
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, messages)
+        SELECT date(timestamp), COUNT(*) FROM messages WHERE timestamp IS NOT NULL GROUP BY date(timestamp)
+        ON CONFLICT (day) DO UPDATE SET messages = excluded.messages
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, withdrawals, points_withdrawn)
+        SELECT date(created_at), COUNT(*), SUM(points) FROM withdrawals GROUP BY date(created_at)
+        ON CONFLICT (day) DO UPDATE SET
+            withdrawals = excluded.withdrawals, points_withdrawn = excluded.points_withdrawn
+    ''')
+
+def migrate_referral_codes(cursor):
+    """Re-issue pre-existing codes in the current format, remembering the old ones."""
+    cursor.execute('''
+        SELECT user_id, referral_code FROM users
+        WHERE referral_code IS NULL OR length(referral_code) != ?
+    ''', (REFERRAL_CODE_LENGTH,))
+    rows = cursor.fetchall()
+    cursor.executemany(
+        'INSERT OR IGNORE INTO legacy_referral_codes (code, user_id) VALUES (?, ?)',
+        [(code, user_id) for user_id, code in rows if code]
+    )
+    cursor.executemany(
+        'UPDATE users SET referral_code = ? WHERE user_id = ?',
+        [(generate_referral_code(user_id), user_id) for user_id, _ in rows]
+    )
+    return len(rows)
+
+# Keep the materialized referral counter in step when a referred user is deleted
+def uncredit_referral(cursor, referrer_id: int):
+    cursor.execute('''
+        UPDATE referral_counts
+        SET referral_count = referral_count - 1
+        WHERE referrer_id = ? AND referral_count > 0
+    ''', (referrer_id,))
+
+LEADERBOARD_SIZE = 10
+
+# Leaderboard command
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+
+    repo = get_repository()
+    # Served straight from idx_referral_counts_rank, no GROUP BY over users
+    top_referrers = await repo.top_referrers(LEADERBOARD_SIZE)
+    own_count = await repo.get_referral_count(user_id)
+
+    if not top_referrers:
+        await update.message.reply_text("🏆 No referrals yet. Be the first with /referral!")
+        return
+
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    message_text = "🏆 Top Referrers\n\n"
+    for position, (referrer_id, referral_count) in enumerate(top_referrers, start=1):
+        masked_id = f"{str(referrer_id)[:3]}***{str(referrer_id)[-2:]}"
+        marker = " (you)" if referrer_id == user_id else ""
+        message_text += f"{medals.get(position, f'{position}.')} User {masked_id}{marker} — {referral_count} referrals\n"
+
+    message_text += f"\nYour referrals: {own_count}"
+    await update.message.reply_text(message_text)
 
 # Previous functions (start, settings, balance, handle_wallet, handle_start_referral) remain the same
 
@@ -332,6 +862,7 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "• Earn 1500 points for each successful referral\n"
         "• Check balance with /balance\n"
         "• Set wallet with /settings\n"
+        "• See the top referrers with /leaderboard\n"
         "• Withdraw points when you have 6500 or more"
     )
     await update.message.reply_text(about_text)
@@ -340,26 +871,20 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT points, wallet_address FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
+    result = await get_repository().get_user(user_id)
     
     if not result:
         await update.message.reply_text("User not found. Please /start first.")
-        conn.close()
         return
     
-    points, wallet_address = result
+    points, wallet_address = result.points, result.wallet_address
     
     if points < 6500:
         await update.message.reply_text(f"Insufficient points. You need at least 6500 points. Current balance: {points} points")
-        conn.close()
         return
     
     if not wallet_address:
         await update.message.reply_text("Please set your wallet address first using /settings")
-        conn.close()
         return
     
     # Confirmation keyboard
@@ -375,10 +900,11 @@ async def withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"Withdraw {points} points to wallet {wallet_address}?", 
         reply_markup=reply_markup
     )
-    
-    conn.close()
 
 # Withdrawal confirmation handler
+WITHDRAW_STEPS = ('Checking wallet', 'Reserving funds', 'Signing transfer', 'Broadcasting transfer', 'Confirming')
+WITHDRAW_STEP_SECONDS = 3
+
 async def handle_withdraw_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     
@@ -392,55 +918,954 @@ async def handle_withdraw_confirmation(update: Update, context: ContextTypes.DEF
     if query.data == 'cancel_withdraw':
         await query.edit_message_text("Withdrawal cancelled.")
         return
-    
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT points, wallet_address FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    
-    if not result or result[0] < 6500:
-        await query.edit_message_text("Withdrawal failed. Insufficient points.")
-        conn.close()
+    
+    repo = get_repository()
+    result = await repo.get_user(user_id)
+    
+    if not result or result.points < 6500:
+        await query.edit_message_text("Withdrawal failed. Insufficient points.")
+        return
+    
+    points, wallet_address = result.points, result.wallet_address
+    
+    async with lifecycle.work(f'withdraw {user_id}'):
+        # Debit first, only if the balance didn't change meanwhile, so a restart can't lose it
+        if not await repo.withdraw_points(user_id, points, 6500, wallet_address):
+            await query.message.reply_text("Withdrawal failed. Your balance changed, please try again.")
+            return
+        
+        # One status message, edited as the transfer steps complete
+        async with ProgressReporter("Processing withdrawal...", total=len(WITHDRAW_STEPS), unit='steps') as progress:
+            await progress.start(query.message)
+            
+            # Simulated transfer steps; cut short when the bot is shutting down
+            for step, stage in enumerate(WITHDRAW_STEPS, start=1):
+                if lifecycle.stopping.is_set():
+                    break
+                progress.update(step - 1, stage=stage)
+                await asyncio.sleep(WITHDRAW_STEP_SECONDS)
+                progress.update(step)
+            
+            await progress.finish(f"Withdrawal successful! Transferred {points} points to {wallet_address}")
+
+
+#logging.basicConfig(
+#    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+#    level=logging.INFO
+#)
+logger = logging.getLogger(__name__)
+
+
+ADMIN_IDS = [5279018187]  
+USERS_PER_PAGE = 5
+
+# Bot API endpoint; BOT_API_BASE_URL lets loadtest.py point the bot at its fake server
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '8091822623:AAGC5kB9IMlYmslBwBLU-82gLjUxBtQuNWM')
+BOT_API_BASE_URL = os.environ.get('BOT_API_BASE_URL')
+
+
+# Seconds shutdown waits for in-flight broadcasts and withdrawals before cancelling them
+SHUTDOWN_DRAIN_SECONDS = int(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 20))
+
+class Lifecycle:
+    """Owns background tasks and in-flight work so a stop can drain them.
+
+    On SIGTERM/SIGINT intake stops first (the updater is stopped), long-running
+    work sees `stopping` and wraps up or checkpoints, and post_stop waits up to
+    SHUTDOWN_DRAIN_SECONDS before cancelling whatever is still running.
+    """
+
+    def __init__(self):
+        self.stopping = asyncio.Event()
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.in_flight: Dict[int, str] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._next_work_id = 0
+
+    def spawn(self, name: str, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.tasks[name] = task
+        task.add_done_callback(lambda done: self.tasks.pop(name, None) if self.tasks.get(name) is done else None)
+        return task
+
+    @contextlib.asynccontextmanager
+    async def work(self, label: str):
+        """Mark a section that shutdown should let finish (within the deadline)."""
+        self._next_work_id += 1
+        work_id = self._next_work_id
+        self.in_flight[work_id] = label
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            del self.in_flight[work_id]
+            if not self.in_flight:
+                self._idle.set()
+
+    def install_signal_handlers(self, application: Application):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.begin_shutdown, application)
+            except (NotImplementedError, RuntimeError):
+                pass  # e.g. Windows; run_polling still stops on KeyboardInterrupt
+
+    def begin_shutdown(self, application: Application):
+        if self.stopping.is_set():
+            return
+        logger.info(f"Shutdown requested; draining {len(self.in_flight)} in-flight jobs")
+        self.stopping.set()
+        application.stop_running()
+
+    async def drain(self, deadline: float = SHUTDOWN_DRAIN_SECONDS):
+        self.stopping.set()
+        try:
+            await asyncio.wait_for(self._idle.wait(), deadline)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutdown deadline passed with work in flight: {sorted(self.in_flight.values())}")
+
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for task, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Background task {task.get_name()} failed during shutdown: {result!r}")
+
+lifecycle = Lifecycle()
+
+
+# Telegram allows roughly one edit per second per chat; stay well under it
+PROGRESS_EDIT_INTERVAL = float(os.environ.get('PROGRESS_EDIT_INTERVAL', 3))
+PROGRESS_BAR_WIDTH = 10
+
+class ProgressReporter:
+    """Live status message for a long job, edited at most once per interval.
+
+    The job reports real progress with update()/advance(). Those only set
+    counters, so worker threads may call them too. One task edits the attached
+    messages with done/total, rate and ETA when the text has changed, so the
+    API cost is bounded by the interval, not by the number of items. RetryAfter
+    postpones the next edit instead of failing the job.
+    """
+
+    def __init__(self, title: str, total: Optional[int] = None, unit: str = 'items',
+                 interval: float = PROGRESS_EDIT_INTERVAL):
+        self.title = title
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.stage: Optional[str] = None
+        self.started = self.counting_since = time.monotonic()
+        self.messages = []
+        self._shown: Dict[int, str] = {}
+        self._next_edit = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._finished = False
+
+    def update(self, done: int, total: Optional[int] = None, stage: Optional[str] = None, unit: Optional[str] = None):
+        """Set progress. A count that restarts (or a new unit) restarts the rate and ETA,
+        so later stages of a job may count something else."""
+        if done < self.done or (unit is not None and unit != self.unit):
+            self.counting_since = time.monotonic()
+        if stage is not None:
+            self.stage = stage
+        if unit is not None:
+            self.unit = unit
+        if total is not None:
+            self.total = total
+        self.done = done
+
+    def advance(self, count: int = 1):
+        self.done += count
+
+    def render(self) -> str:
+        now = time.monotonic()
+        elapsed = now - self.started
+        rate = self.done / (now - self.counting_since) if now > self.counting_since else 0.0
+        lines = [f"⏳ {self.title}"]
+        if self.stage:
+            lines.append(self.stage)
+        if self.total:
+            filled = min(PROGRESS_BAR_WIDTH, PROGRESS_BAR_WIDTH * self.done // self.total)
+            lines.append(
+                "🟩" * filled + "⬜" * (PROGRESS_BAR_WIDTH - filled)
+                + f" {self.done}/{self.total} {self.unit} ({100 * self.done // self.total}%)"
+            )
+        else:
+            lines.append(f"{self.done} {self.unit}")
+        eta = ""
+        if self.total and rate > 0 and self.done < self.total:
+            eta = f", ETA {format_duration((self.total - self.done) / rate)}"
+        lines.append(f"{rate:.1f} {self.unit}/s, elapsed {format_duration(elapsed)}{eta}")
+        return "\n".join(lines)
+
+    async def start(self, reply_to):
+        """Reply to reply_to with the status message and keep it updated."""
+        self.attach(await reply_to.reply_text(self.render()))
+
+    def attach(self, message):
+        """Also keep message (already sent) updated, e.g. a later viewer of a running job."""
+        self.messages.append(message)
+        if self._task is None and not self._finished:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(self.interval, self._next_edit - time.monotonic()))
+            await self._edit(self.render())
+
+    async def _edit(self, text: str):
+        for message in list(self.messages):
+            if self._shown.get(id(message)) == text:
+                continue
+            try:
+                await message.edit_text(text)
+                self._shown[id(message)] = text
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self._next_edit = time.monotonic() + delay
+                return
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower():
+                    # Deleted or too old to edit: stop updating it
+                    self.messages.remove(message)
+            except TelegramError as e:
+                logger.debug(f"Progress edit failed: {e}")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """Never leave the edit task running: a job that didn't finish() is marked failed,
+        and a cancelled one just stops being updated so the cancellation isn't delayed."""
+        if self._finished:
+            return
+        if exc_type is None:
+            await self.finish()
+        elif issubclass(exc_type, asyncio.CancelledError):
+            self._finished = True
+            if self._task is not None:
+                self._task.cancel()
+                self._task = None
+        else:
+            await self.finish(f"❌ {self.title} failed")
+
+    async def finish(self, text: Optional[str] = None):
+        """Stop updating and replace the status with text (or the final counts)."""
+        if self._finished:
+            return
+        self._finished = True
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        delay = self._next_edit - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._edit(text or self.render().replace("⏳", "✅", 1))
+
+
+PERSISTENCE_UPDATE_INTERVAL = 30
+
+class SQLitePersistence(BasePersistence):
+    """Keeps user_data and conversation states in user_database.db.
+
+    PTB hands over changed users and conversations every update_interval
+    seconds. Only keys whose serialized value differs from what is already on
+    disk are staged, and everything staged is written in one transaction.
+    """
+
+    def __init__(self, database: str = 'user_database.db', update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.database = database
+        # Serialized values as they are on disk, used to detect changed keys
+        self._stored_user_data: Dict[int, Dict[str, str]] = {}
+        # Staged writes; a value of None deletes the row
+        self._pending_user_data: Dict[Tuple[int, str], Optional[str]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_task = None
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        conn = connect_db(self.database)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, key, value FROM persisted_user_data')
+        rows = cursor.fetchall()
+        conn.close()
+
+        user_data = {}
+        for user_id, key, value in rows:
+            self._stored_user_data.setdefault(user_id, {})[key] = value
+            user_data.setdefault(user_id, {})[key] = json.loads(value)
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        stored = self._stored_user_data.setdefault(user_id, {})
+        for key, value in data.items():
+            try:
+                serialized = json.dumps(value, sort_keys=True)
+            except TypeError:
+                logger.warning(f"Not persisting user_data[{key!r}] for {user_id}: value is not JSON serializable")
+                continue
+            if stored.get(key) != serialized:
+                stored[key] = serialized
+                self._pending_user_data[(user_id, key)] = serialized
+
+        for key in [key for key in stored if key not in data]:
+            del stored[key]
+            self._pending_user_data[(user_id, key)] = None
+
+        if not stored:
+            del self._stored_user_data[user_id]
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        for key in self._stored_user_data.pop(user_id, {}):
+            self._pending_user_data[(user_id, key)] = None
+        self._schedule_flush()
+
+    async def get_conversations(self, name: str) -> dict:
+        conn = connect_db(self.database)
+        cursor = conn.cursor()
+        cursor.execute('SELECT conversation_key, state FROM persisted_conversations WHERE name = ?', (name,))
+        rows = cursor.fetchall()
+        conn.close()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._pending_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # update_persistence() calls update_* back to back; write once they are all staged
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._write_pending()
+
+    def _write_pending(self):
+        user_rows, self._pending_user_data = self._pending_user_data, {}
+        conversation_rows, self._pending_conversations = self._pending_conversations, {}
+        if not user_rows and not conversation_rows:
+            return
+
+        conn = None
+        try:
+            conn = connect_db(self.database)
+            with conn:
+                conn.executemany('''
+                    INSERT INTO persisted_user_data (user_id, key, value) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+                ''', [(user_id, key, value) for (user_id, key), value in user_rows.items() if value is not None])
+                conn.executemany(
+                    'DELETE FROM persisted_user_data WHERE user_id = ? AND key = ?',
+                    [(user_id, key) for (user_id, key), value in user_rows.items() if value is None]
+                )
+                conn.executemany('''
+                    INSERT INTO persisted_conversations (name, conversation_key, state) VALUES (?, ?, ?)
+                    ON CONFLICT(name, conversation_key) DO UPDATE SET state = excluded.state, updated_at = CURRENT_TIMESTAMP
+                ''', [(name, key, state) for (name, key), state in conversation_rows.items() if state is not None])
+                conn.executemany(
+                    'DELETE FROM persisted_conversations WHERE name = ? AND conversation_key = ?',
+                    [(name, key) for (name, key), state in conversation_rows.items() if state is None]
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error writing persistence batch, will retry: {e}")
+            # Keep anything staged since, and put the failed batch back underneath it
+            for row_key, value in user_rows.items():
+                self._pending_user_data.setdefault(row_key, value)
+            for row_key, state in conversation_rows.items():
+                self._pending_conversations.setdefault(row_key, state)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        self._write_pending()
+
+    # Only user_data and conversations are persisted
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+# Flood control budgets per command class: (bucket capacity, tokens refilled per second)
+FLOOD_BUDGETS = {
+    'media': (3, 1 / 20),       # /balance re-sends a photo every time
+    'account': (3, 1 / 10),     # /start, /withdraw
+    'contact': (2, 1 / 30),     # /messageadmin
+    'command': (10, 1 / 3),
+    'message': (10, 1 / 3),
+    'callback': (20, 1),
+}
+FLOOD_COMMAND_CLASSES = {
+    '/balance': 'media',
+    '/start': 'account',
+    '/withdraw': 'account',
+    '/messageadmin': 'contact',
+}
+FLOOD_BUCKET_TTL = 600  # idle buckets are full again long before this
+FLOOD_SWEEP_INTERVAL = 300
+
+class FloodControl:
+    """In-memory token buckets keyed by (command class, user_id)."""
+
+    __slots__ = ('budgets', 'buckets', 'admin_ids', 'dropped')
+
+    def __init__(self, budgets: Dict[str, tuple]):
+        self.budgets = budgets
+        # class -> {user_id: [tokens, last_refill]}; one small list per active user
+        self.buckets = {name: {} for name in budgets}
+        self.admin_ids = set(ADMIN_IDS)
+        self.dropped = 0
+
+    def allow(self, user_id: int, bucket_class: str, now: Optional[float] = None) -> bool:
+        if user_id in self.admin_ids:
+            return True
+
+        now = time.monotonic() if now is None else now
+        capacity, refill_rate = self.budgets[bucket_class]
+        buckets = self.buckets[bucket_class]
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            buckets[user_id] = [capacity - 1, now]
+            return True
+
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * refill_rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            self.dropped += 1
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        removed = 0
+        for buckets in self.buckets.values():
+            expired = [user_id for user_id, bucket in buckets.items() if now - bucket[1] > FLOOD_BUCKET_TTL]
+            for user_id in expired:
+                del buckets[user_id]
+            removed += len(expired)
+        return removed
+
+    def refresh_admins(self, admin_ids: Optional[set] = None):
+        """Reload the exempt admin set, or only admin_ids (from the change feed) when given."""
+        conn = connect_db()
+        cursor = conn.cursor()
+        if admin_ids is None:
+            cursor.execute('SELECT admin_id FROM administrators')
+            self.admin_ids = set(ADMIN_IDS) | {row[0] for row in cursor.fetchall()}
+        else:
+            cursor.execute(
+                f"SELECT admin_id FROM administrators WHERE admin_id IN ({','.join('?' * len(admin_ids))})",
+                tuple(admin_ids)
+            )
+            current = {row[0] for row in cursor.fetchall()}
+            self.admin_ids = (self.admin_ids - admin_ids) | current | set(ADMIN_IDS)
+        conn.close()
+
+flood_control = FloodControl(FLOOD_BUDGETS)
+
+def classify_update(update: Update) -> str:
+    if update.callback_query:
+        return 'callback'
+    text = update.message.text if update.message and update.message.text else ''
+    if text.startswith('/'):
+        command = text.split()[0].split('@')[0].lower()
+        return FLOOD_COMMAND_CLASSES.get(command, 'command')
+    return 'message'
+
+# Runs in handler group -1, before any handler touches SQLite or the Bot API
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user
+    if user is None:
+        return
+    if not flood_control.allow(user.id, classify_update(update)):
+        raise ApplicationHandlerStop
+
+async def flood_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    removed = flood_control.sweep()
+    if removed or flood_control.dropped:
+        logger.info(f"Flood control: expired {removed} buckets, {flood_control.dropped} updates dropped so far")
+
+# Concurrent update processing: updates run in parallel across users, in order per user
+MAX_CONCURRENT_UPDATES = 64
+MAX_PENDING_UPDATES = 1024
+
+loop_watchdog = LoopWatchdog()
+# Port for Prometheus metrics (needs prometheus_client); unset disables the exporter
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Serializes updates from the same user while different users run in parallel.
+
+    The base class semaphore bounds admitted updates (running plus queued behind
+    their user); a second semaphore taken after the per-user lock bounds the ones
+    actually running, so a user's backlog never occupies execution slots.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int):
+        super().__init__(max_pending_updates)
+        self.max_running = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_depth: Dict[int, int] = {}
+        self.running = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.max_user_depth = 0
+        self.processed = 0
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+
+        lock = None
+        if key is not None:
+            lock = self._user_locks.get(key)
+            if lock is None:
+                lock = self._user_locks[key] = asyncio.Lock()
+            depth = self._user_depth.get(key, 0) + 1
+            self._user_depth[key] = depth
+            self.max_user_depth = max(self.max_user_depth, depth)
+
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        started = False
+        try:
+            if lock is not None:
+                await lock.acquire()
+            try:
+                async with self._slots:
+                    self.queued -= 1
+                    started = True
+                    self.running += 1
+                    handler = describe_update(update) if isinstance(update, Update) else None
+                    if handler is not None:
+                        # The loop watchdog reports this handler if the loop stalls while it runs
+                        coroutine = loop_watchdog.labelled(handler, coroutine)
+                    try:
+                        if tracer.enabled and handler is not None:
+                            with tracer.trace(handler):
+                                await coroutine
+                        else:
+                            await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+            finally:
+                if lock is not None:
+                    lock.release()
+        finally:
+            if not started:
+                self.queued -= 1
+            if key is not None:
+                depth = self._user_depth[key] - 1
+                if depth:
+                    self._user_depth[key] = depth
+                else:
+                    del self._user_depth[key]
+                    del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'active_users': len(self._user_locks),
+            'max_user_depth': self.max_user_depth,
+            'processed': self.processed,
+            'max_running': self.max_running,
+        }
+
+update_processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+
+def describe_update(update: Update) -> str:
+    """Handler-level name for an update: the command, or the callback data without ids."""
+    if update.callback_query and update.callback_query.data:
+        return 'callback ' + re.sub(r'(_-?\d+)+$', '', update.callback_query.data)
+    if update.message and update.message.text:
+        if update.message.text.startswith('/'):
+            return update.message.text.split()[0].split('@')[0].lower()
+        return 'text message'
+    return 'other update'
+
+# Update queue statistics command
+PROFILE_DEFAULT_SECONDS = 10
+
+async def run_profile(message, seconds: int):
+    # Sample the event loop thread: that's where handlers run and where stalls hurt
+    profiler = SamplingProfiler(thread_ids=[threading.get_ident()])
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(profiler.stop)
+
+    lines = [f"🔬 Profile: {seconds}s, {profiler.sample_count} samples\n", "self  total  function"]
+    for function, own, total in profiler.top_functions():
+        lines.append(f"{own:>4}  {total:>5}  {function}")
+    await message.reply_text("\n".join(lines)[:4000])
+    await message.reply_document(
+        document=io.BytesIO(profiler.folded().encode()),
+        filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded",
+        caption="Folded stacks for flamegraph.pl or speedscope.app"
+    )
+
+def render_trace_report() -> str:
+    if not tracer.stats:
+        return "No traced updates yet."
+    lines = ["handler: updates, avg ms | sql queries, ms | api calls, ms"]
+    for name, stats in tracer.report():
+        lines.append(
+            f"{name}: {stats.updates}, {stats.seconds / stats.updates * 1000:.1f} | "
+            f"{stats.sql_queries}, {stats.sql_seconds * 1000:.1f} | "
+            f"{stats.api_calls}, {stats.api_seconds * 1000:.1f}"
+        )
+    return "\n".join(lines)
+
+# Profiling command, main admins only
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Only main admins can profile the bot.")
+        return
+
+    args = [arg.lower() for arg in context.args]
+    if args and args[0] == 'trace':
+        action = args[1] if len(args) > 1 else 'show'
+        if action == 'on':
+            tracer.enable([get_repository().engine.sync_engine])
+            await update.message.reply_text("Tracing on. Use /profile trace show or /profile trace off.")
+        elif action == 'off':
+            tracer.disable()
+            await update.message.reply_text("Tracing off.\n\n" + render_trace_report())
+        else:
+            status = "on" if tracer.enabled else "off"
+            await update.message.reply_text(f"Tracing is {status}.\n\n" + render_trace_report())
+        return
+
+    try:
+        seconds = int(args[0]) if args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        await update.message.reply_text(
+            f"Usage: /profile [seconds, up to {PROFILE_MAX_SECONDS}] or /profile trace on|off|show"
+        )
         return
-    
-    points, wallet_address = result
-    
-    # Processing message
-    processing_msg = await query.message.reply_text("Processing withdrawal...")
-    
-    # Simulate withdrawal processing
-    progress_msg = await query.message.reply_text("⬜⬜⬜⬜⬜")
-    
-    for i in range(1, 6):
-        await asyncio.sleep(3)
-        progress_bar = "🟩" * i + "⬜" * (5 - i)
-        await progress_msg.edit_text(progress_bar)
-    
-    # Update points after processing
-    cursor.execute('UPDATE users SET points = 0 WHERE user_id = ?', (user_id,))
-    conn.commit()
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+    await update.message.reply_text(f"Profiling for {seconds}s...")
+    # Run outside the update so the admin's other updates aren't queued behind it
+    context.application.create_task(run_profile(update.message, seconds))
+
+STATS_DAYS = 7
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return  # Exit if not an admin
+
+    # Totals and rollups are trigger-maintained: a few primary key reads, no table scans
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, value FROM counters')
+    counters = dict(cursor.fetchall())
+    cursor.execute('''
+        SELECT day, new_users, referrals, messages, withdrawals, points_withdrawn
+        FROM daily_stats ORDER BY day DESC LIMIT ?
+    ''', (STATS_DAYS,))
+    days = cursor.fetchall()
     conn.close()
-    
-    await processing_msg.delete()
-    await progress_msg.delete()
-    await query.message.reply_text(f"Withdrawal successful! Transferred {points} points to {wallet_address}")
 
+    users_total = counters.get('users', 0)
+    referred = counters.get('users_referred', 0)
+    points_total = counters.get('points_total', 0)
+    lines = [
+        "📊 Stats\n",
+        f"👥 Users: {users_total}",
+        f"🔗 Referred: {referred} ({100 * referred / users_total if users_total else 0:.1f}%)",
+        f"💰 Points in circulation: {points_total} (avg {points_total / users_total if users_total else 0:.0f})",
+        f"💸 Withdrawals: {counters.get('withdrawals', 0)} ({counters.get('points_withdrawn', 0)} points)",
+        f"✉️ Pending messages: {counters.get('messages_pending', 0)}",
+        f"🔇 Muted users: {counters.get('muted_users', 0)}",
+        f"\n📅 Last {STATS_DAYS} days (new users / referrals / messages / withdrawals):",
+    ]
+    if not days:
+        lines.append("No activity recorded yet.")
+    for day, new_users, referrals, messages, withdrawal_count, points_withdrawn in days:
+        lines.append(f"{day}: {new_users} / {referrals} / {messages} / {withdrawal_count} ({points_withdrawn} pts)")
+    await update.message.reply_text("\n".join(lines))
 
-#logging.basicConfig(
-#    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-#    level=logging.INFO
-#)
-#logger = logging.getLogger(__name__)
+async def update_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return
 
+    stats = update_processor.stats()
+    await update.message.reply_text(
+        "⚙️ Update Processing\n\n"
+        f"Running: {stats['running']}/{stats['max_running']}\n"
+        f"Queued: {stats['queued']} (peak {stats['max_queued']})\n"
+        f"Users with updates in flight: {stats['active_users']}\n"
+        f"Deepest per-user backlog: {stats['max_user_depth']}\n"
+        f"Processed: {stats['processed']}\n"
+        f"Dropped by flood control: {flood_control.dropped}\n"
+        f"Admin screen cache: {render_cache.hits} hits, {render_cache.misses} misses, "
+        f"{render_cache.skipped_edits} unchanged edits skipped\n"
+        f"Change feed: {change_feed.applied} changes applied, {change_feed.resyncs} resyncs\n\n"
+        "⏱ Event Loop Lag\n\n"
+        f"p50 ≤ {loop_watchdog.percentile(50) * 1000:.0f} ms, p99 ≤ {loop_watchdog.percentile(99) * 1000:.0f} ms, "
+        f"max {loop_watchdog.max_lag * 1000:.0f} ms\n"
+        f"Stalls over {loop_watchdog.threshold * 1000:.0f} ms: {loop_watchdog.stall_count}"
+        + "".join(
+            f"\n• {stall['at'].strftime('%H:%M:%S')} {stall['lag'] * 1000:.0f} ms in {stall['handler'] or 'unknown'}"
+            for stall in list(loop_watchdog.stalls)[-5:]
+        )
+    )
 
-ADMIN_IDS = [5279018187]  
-USERS_PER_PAGE = 5
+RENDER_CACHE_SIZE = 256
+RENDER_CACHE_TTL = 300
+# screen -> tables whose writes change it
+SCREEN_TABLES = {
+    'admin_panel': (),
+    'users': ('users',),
+    'referrals': ('users',),
+    'muted': ('muted_users',),
+    'admins': ('administrators',),
+    'flags': ('referral_flags',),
+}
+# The muted list hides unmute buttons once a mute expires, which no write signals
+SCREEN_TTL = {'muted': 60}
+
+class RenderCache:
+    """Rendered admin screens (text, markup), keyed by (screen, cursor, display mode, data versions).
+
+    Writes bump the versions of the tables they change (storage.touch_tables), so
+    after a write the screen gets a new key and the stale entry ages out of the
+    LRU. Writes from other processes (the dashboard) bump them through the change
+    feed; the TTL is a backstop for changes nothing signals.
+    """
+
+    def __init__(self, size: int = RENDER_CACHE_SIZE, ttl: float = RENDER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.skipped_edits = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, rendered, ttl: Optional[float] = None):
+        self.entries[key] = (time.monotonic() + (ttl or self.ttl), rendered)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+render_cache = RenderCache()
+
+CHANGE_FEED_POLL_INTERVAL = 2
+CHANGE_FEED_BATCH = 1000
+CHANGE_LOG_RETENTION = 3600  # seconds; a follower further behind than this starts over
+CHANGE_LOG_PRUNE_INTERVAL = 300
+
+class ChangeFeed:
+    """Follows change_log, which triggers fill on every write to CHANGE_FEED_TABLES.
+
+    Subscribers are called with the set of changed row ids per table, or None when
+    changes were pruned before this follower read them or the backlog was too big to
+    read at once (everything may have changed).
+    Following starts at the newest change, so nothing written before startup is replayed.
+    """
+
+    def __init__(self, database: str = 'user_database.db'):
+        self.database = database
+        self.last_change_id: Optional[int] = None
+        self.subscribers: Dict[str, list] = {}
+        self.applied = 0
+        self.resyncs = 0
+
+    def subscribe(self, table: str, callback):
+        self.subscribers.setdefault(table, []).append(callback)
+
+    def read(self) -> Tuple[int, List[Tuple[int, str, int]], bool]:
+        """(new position, changes, resync) since the last apply. Blocking; run it in a thread.
+
+        At most CHANGE_FEED_BATCH changes are read. A bigger backlog, or a gap left by
+        pruning, skips to the newest change with resync set instead.
+        """
+        conn = connect_db(self.database)
+        try:
+            cursor = conn.cursor()
+            # sqlite_sequence keeps the last id even after its row is pruned
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+            row = cursor.fetchone()
+            newest = row[0] if row else 0
+            if self.last_change_id is None:
+                return newest, [], False
+            cursor.execute(
+                'SELECT change_id, table_name, row_id FROM change_log WHERE change_id > ? ORDER BY change_id LIMIT ?',
+                (self.last_change_id, CHANGE_FEED_BATCH + 1)
+            )
+            changes = cursor.fetchall()
+        finally:
+            conn.close()
+        # Ids only ever grow by one, so a gap, or nothing left up to newest, means
+        # pruning got there first
+        if changes:
+            pruned = changes[0][0] > self.last_change_id + 1
+        else:
+            pruned = newest > self.last_change_id
+        if len(changes) > CHANGE_FEED_BATCH or pruned:
+            return max(newest, changes[-1][0] if changes else 0), [], True
+        return (changes[-1][0] if changes else self.last_change_id), changes, False
+
+    def apply(self, position: int, changes: List[Tuple[int, str, int]], resync: bool) -> int:
+        """Deliver what read() returned to the subscribers. Returns how many changes that was."""
+        if self.last_change_id is None:
+            self.last_change_id = position
+            return 0
+        changed: Dict[str, Optional[set]] = {}
+        if resync:
+            self.resyncs += 1
+            changed = dict.fromkeys(CHANGE_FEED_TABLES)
+        for _, table, row_id in changes:
+            changed.setdefault(table, set()).add(row_id)
+        self.last_change_id = position
+        self.applied += len(changes)
+        for table, row_ids in changed.items():
+            for callback in self.subscribers.get(table, ()):
+                callback(row_ids)
+        return len(changes)
+
+    def poll(self) -> int:
+        return self.apply(*self.read())
+
+def prune_change_log(retention: int = CHANGE_LOG_RETENTION) -> int:
+    conn = connect_db()
+    try:
+        cursor = conn.execute("DELETE FROM change_log WHERE changed_at < datetime('now', ?)", (f'-{retention} seconds',))
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        conn.close()
 
+change_feed = ChangeFeed()
+# Writes from other processes (the dashboard) reach cached screens this way; the
+# bot's own writes already touch_tables directly, and see the feed bump them again.
+for _table in CHANGE_FEED_TABLES:
+    change_feed.subscribe(_table, lambda row_ids, table=_table: touch_tables(table))
+change_feed.subscribe('administrators', lambda row_ids: flood_control.refresh_admins(row_ids))
+
+async def change_feed_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        # Read in a thread; subscribers run here, on the loop, like every other cache write
+        change_feed.apply(*await asyncio.to_thread(change_feed.read))
+    except sqlite3.Error as e:
+        logger.error(f"Change feed poll failed: {e}")
+
+async def prune_change_log_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        pruned = await asyncio.to_thread(prune_change_log)
+    except sqlite3.Error as e:
+        logger.error(f"Change log pruning failed: {e}")
+        return
+    if pruned:
+        logger.info(f"Pruned {pruned} change log entries")
+
+async def edit_screen(query, text: str, reply_markup: InlineKeyboardMarkup) -> bool:
+    """Edit the query's message unless it already shows exactly this screen.
+
+    Telegram rejects such edits with "message is not modified"; the callback
+    carries the message as currently shown (with surrounding whitespace
+    trimmed), so the no-op is detected without a request.
+    """
+    message = query.message
+    if message is not None and message.text == text.strip() and message.reply_markup == reply_markup:
+        render_cache.skipped_edits += 1
+        return False
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if 'not modified' not in str(e).lower():
+            raise
+        render_cache.skipped_edits += 1
+        return False
+    return True
+
+async def show_screen(query, screen: str, cursor, render, display_mode: Optional[str] = None):
+    """Show a cached admin screen; render() is awaited only on a cache miss."""
+    key = (screen, cursor, display_mode, table_versions(SCREEN_TABLES[screen]))
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = await render()
+        render_cache.put(key, rendered, SCREEN_TTL.get(screen))
+    await edit_screen(query, *rendered)
+
+def get_display_mode(admin_id: int) -> str:
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT display_mode FROM admin_settings WHERE admin_id = ?', (admin_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else 'user_id'
 
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT admin_id FROM administrators')
     db_admins = {row[0] for row in cursor.fetchall()}
@@ -456,8 +1881,10 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("👥 Manage Users", callback_data='admin_users_0')],
         [InlineKeyboardButton("📋 View Referrals", callback_data='admin_referrals_0')],
+        [InlineKeyboardButton("🏆 Referral Ranking", callback_data='admin_ranking_0')],
         [InlineKeyboardButton("✉️ Messages", callback_data='admin_messages_0')],
-        [InlineKeyboardButton("🔇 Muted Users", callback_data='view_muted_users_0')]
+        [InlineKeyboardButton("🔇 Muted Users", callback_data='view_muted_users_0')],
+        [InlineKeyboardButton("🚩 Referral Flags", callback_data='admin_flags_0')]
     ]
 
     # Only main admins can manage other admins
@@ -471,7 +1898,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def check_admin(update: Update) -> bool:
     user_id = update.effective_user.id
 
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT admin_id FROM administrators')
     db_admins = {row[0] for row in cursor.fetchall()}
@@ -487,20 +1914,12 @@ async def check_admin(update: Update) -> bool:
         return False
     return True
 
-async def show_users_list(query, page: int):
+async def render_users_list(bot, page: int, display_mode: str):
+    conn = connect_db()
+    cursor = conn.cursor()
     try:
-        admin_id = query.from_user.id
-        conn = sqlite3.connect('user_database.db')
-        cursor = conn.cursor()
-        
-        # Get admin's display preference
-        cursor.execute('SELECT display_mode FROM admin_settings WHERE admin_id = ?', (admin_id,))
-        result = cursor.fetchone()
-        display_mode = result[0] if result else 'user_id'
-        
         # Get total number of users
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
+        total_users = read_counter(cursor, 'users')
         
         # Calculate total pages
         total_pages = math.ceil(total_users / USERS_PER_PAGE)
@@ -511,53 +1930,65 @@ async def show_users_list(query, page: int):
             (USERS_PER_PAGE, page * USERS_PER_PAGE)
         )
         users = cursor.fetchall()
+    finally:
+        conn.close()
+    
+    keyboard = []
+    for user in users:
+        user_id, points = user
+        try:
+            user_info = await bot.get_chat(user_id)
+            username = user_info.username
+            if username:
+                username = f"@{username}"
+            else:
+                username = "No username"
+        except:
+            username = "Unknown"
         
-        keyboard = []
-        for user in users:
-            user_id, points = user
-            try:
-                user_info = await query.bot.get_chat(user_id)
-                username = user_info.username
-                if username:
-                    username = f"@{username}"
-                else:
-                    username = "No username"
-            except:
-                username = "Unknown"
-            
-            display_text = ""
-            if display_mode == 'user_id':
-                display_text = f"ID: {user_id}"
-            elif display_mode == 'nickname':
-                display_text = f"ID: {user_id}"
-            elif display_mode == 'both':
-                display_text = f"ID: {user_id}"
-            
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{display_text} | 💰 {points}",
-                    callback_data=f'modify_user_{user_id}'
-                ),
-                InlineKeyboardButton(
-                    "❌ Delete",
-                    callback_data=f'delete_user_{user_id}'
-                )
-            ])
-        
-        # Add navigation buttons
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_users_{page-1}'))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_users_{page+1}'))
-        if nav_buttons:
-            keyboard.append(nav_buttons)
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
+        display_text = ""
+        if display_mode == 'user_id':
+            display_text = f"ID: {user_id}"
+        elif display_mode == 'nickname':
+            display_text = f"ID: {user_id}"
+        elif display_mode == 'both':
+            display_text = f"ID: {user_id}"
         
-        await query.edit_message_text(
-            f"👥 Users List (Page {page + 1}/{max(1, total_pages)})\nSelect a user to modify:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{display_text} | 💰 {points}",
+                callback_data=f'modify_user_{user_id}'
+            ),
+            InlineKeyboardButton(
+                "❌ Delete",
+                callback_data=f'delete_user_{user_id}'
+            )
+        ])
+    
+    # Add navigation buttons
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_users_{page-1}'))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_users_{page+1}'))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    
+    keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
+    
+    return (
+        f"👥 Users List (Page {page + 1}/{max(1, total_pages)})\nSelect a user to modify:",
+        InlineKeyboardMarkup(keyboard)
+    )
+
+async def show_users_list(query, page: int):
+    try:
+        # Get admin's display preference
+        display_mode = get_display_mode(query.from_user.id)
+        await show_screen(
+            query, 'users', page,
+            lambda: render_users_list(query.bot, page, display_mode),
+            display_mode
         )
         
     except Exception as e:
@@ -566,14 +1997,11 @@ async def show_users_list(query, page: int):
             "An error occurred while fetching users list.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]])
         )
-    finally:
-        conn.close()
 
-async def show_referrals_list(query, page: int):
+async def render_referrals_list(page: int):
+    conn = connect_db()
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect('user_database.db')
-        cursor = conn.cursor()
-        
         # Get users with their referrers
         cursor.execute('''
             SELECT u1.user_id, u1.points, u1.referral_code, u2.user_id as referrer_id 
@@ -584,23 +2012,73 @@ async def show_referrals_list(query, page: int):
         referrals = cursor.fetchall()
         
         # Get total count for pagination
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
+        total_users = read_counter(cursor, 'users')
         total_pages = math.ceil(total_users / USERS_PER_PAGE)
+    finally:
+        conn.close()
+    
+    message_text = f"📋 Referrals List (Page {page + 1}/{max(1, total_pages)})\n\n"
+    for user_id, points, ref_code, referrer_id in referrals:
+        message_text += f"👤 User {user_id}\n"
+        message_text += f"└ 💰 Points: {points}\n"
+        message_text += f"└ 🎫 Code: {ref_code}\n"
+        message_text += f"└ 👥 Referred by: {referrer_id or 'None'}\n\n"
+    
+    keyboard = []
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_referrals_{page-1}'))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_referrals_{page+1}'))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    
+    keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
+    
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def show_referrals_list(query, page: int):
+    try:
+        await show_screen(query, 'referrals', page, lambda: render_referrals_list(page))
+        
+    except Exception as e:
+        logger.error(f"Error in show_referrals_list: {e}")
+        await query.edit_message_text(
+            "An error occurred while fetching referrals list.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]])
+        )
+
+async def show_referral_ranking(query, page: int):
+    try:
+        conn = connect_db()
+        cursor = conn.cursor()
+        
+        # Fetch one extra row to know whether a next page exists without COUNT(*)
+        cursor.execute('''
+            SELECT referrer_id, referral_count, last_referral_at
+            FROM referral_counts
+            WHERE referral_count > 0
+            ORDER BY referral_count DESC, referrer_id
+            LIMIT ? OFFSET ?
+        ''', (USERS_PER_PAGE + 1, page * USERS_PER_PAGE))
+        ranking = cursor.fetchall()
+        has_next = len(ranking) > USERS_PER_PAGE
+        ranking = ranking[:USERS_PER_PAGE]
         
-        message_text = f"📋 Referrals List (Page {page + 1}/{max(1, total_pages)})\n\n"
-        for user_id, points, ref_code, referrer_id in referrals:
-            message_text += f"👤 User {user_id}\n"
-            message_text += f"└ 💰 Points: {points}\n"
-            message_text += f"└ 🎫 Code: {ref_code}\n"
-            message_text += f"└ 👥 Referred by: {referrer_id or 'None'}\n\n"
+        message_text = f"🏆 Referral Ranking (Page {page + 1})\n\n"
+        if not ranking:
+            message_text += "No referrals recorded yet."
+        for position, (referrer_id, referral_count, last_referral_at) in enumerate(ranking, start=page * USERS_PER_PAGE + 1):
+            message_text += f"{position}. User {referrer_id}\n"
+            message_text += f"└ 👥 Referrals: {referral_count}\n"
+            message_text += f"└ 🕒 Last referral: {last_referral_at or 'Unknown'}\n\n"
         
         keyboard = []
         nav_buttons = []
         if page > 0:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_referrals_{page-1}'))
-        if page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_referrals_{page+1}'))
+            nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_ranking_{page-1}'))
+        if has_next:
+            nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_ranking_{page+1}'))
         if nav_buttons:
             keyboard.append(nav_buttons)
         
@@ -612,14 +2090,26 @@ async def show_referrals_list(query, page: int):
         )
         
     except Exception as e:
-        logger.error(f"Error in show_referrals_list: {e}")
+        logger.error(f"Error in show_referral_ranking: {e}")
         await query.edit_message_text(
-            "An error occurred while fetching referrals list.",
+            "An error occurred while fetching referral ranking.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]])
         )
     finally:
         conn.close()
 
+async def render_admin_panel():
+    keyboard = [
+        [InlineKeyboardButton("👥 Manage Users", callback_data='admin_users_0')],
+        [InlineKeyboardButton("📋 View Referrals", callback_data='admin_referrals_0')],
+        [InlineKeyboardButton("🏆 Referral Ranking", callback_data='admin_ranking_0')],
+        [InlineKeyboardButton("✉️ Messages", callback_data='admin_messages_0')],
+        [InlineKeyboardButton("👮 Manage Admins", callback_data='manage_admins_panel')],
+        [InlineKeyboardButton("🔇 Muted Users", callback_data='view_muted_users_0')],
+        [InlineKeyboardButton("🚩 Referral Flags", callback_data='admin_flags_0')]
+    ]
+    return "🔐 Admin Panel\n\nSelect an action:", InlineKeyboardMarkup(keyboard)
+
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         query = update.callback_query
@@ -628,12 +2118,14 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         if not await check_admin(update):
             return  # Exit if not an admin
         
-        await query.answer()
+        # A callback can be answered only once; claiming answers with its own toast
+        if query.data != 'admin_claim_messages':
+            await query.answer()
         
         # Handle display mode settings
         if query.data.startswith('display_mode_'):
             mode = query.data.split('_')[2]
-            conn = sqlite3.connect('user_database.db')
+            conn = connect_db()
             cursor = conn.cursor()
             
             # Update admin settings
@@ -666,6 +2158,10 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
             page = int(data_parts[2])
             await show_referrals_list(query, page)
         
+        elif query.data.startswith('admin_ranking_'):
+            page = int(data_parts[2])
+            await show_referral_ranking(query, page)
+        
         elif query.data.startswith('modify_user_'):
             target_user_id = int(data_parts[2])
             await show_user_actions(query, target_user_id)
@@ -690,6 +2186,12 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
             target_user_id = int(data_parts[2])
             await reset_user(query, target_user_id)
             
+        elif query.data == 'admin_claim_messages':
+            await handle_claim_messages(query)
+            
+        elif query.data == 'admin_release_messages':
+            await handle_release_messages(query)
+            
         elif query.data.startswith('admin_messages_'):
             page = int(data_parts[2])
             await show_messages(query, page)
@@ -697,6 +2199,18 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         elif query.data.startswith('view_muted_users_'):
             page = int(data_parts[3])
             await show_muted_users(query, page)
+
+        elif query.data.startswith('admin_flags_'):
+            page = int(data_parts[2])
+            await show_referral_flags(query, page)
+        
+        elif query.data.startswith('admin_msgsearch_'):
+            page = int(data_parts[2])
+            await show_message_search(query, page, context)
+        
+        elif query.data.startswith('admin_archsearch_'):
+            page = int(data_parts[2])
+            await show_message_search(query, page, context, archive=True)
         
         elif query.data.startswith('view_message_'):
             message_id = int(data_parts[2])
@@ -735,17 +2249,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
             await handle_admin_removal(query, admin_id)
         
         elif query.data == 'admin_back':
-            keyboard = [
-                [InlineKeyboardButton("👥 Manage Users", callback_data='admin_users_0')],
-                [InlineKeyboardButton("📋 View Referrals", callback_data='admin_referrals_0')],
-                [InlineKeyboardButton("✉️ Messages", callback_data='admin_messages_0')],
-                [InlineKeyboardButton("👮 Manage Admins", callback_data='manage_admins_panel')],
-                [InlineKeyboardButton("🔇 Muted Users", callback_data='view_muted_users_0')]
-            ]
-            await query.edit_message_text(
-                "🔐 Admin Panel\n\nSelect an action:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await show_screen(query, 'admin_panel', None, render_admin_panel)
             
     except Exception as e:
         logger.error(f"Error in handle_admin_callback: {e}")
@@ -756,22 +2260,27 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def delete_user(query, target_user_id: int):
     try:
-        conn = sqlite3.connect('user_database.db')
+        conn = connect_db()
         cursor = conn.cursor()
         
         # Get user's current referral info before deletion
-        cursor.execute('SELECT referral_code FROM users WHERE user_id = ?', (target_user_id,))
+        cursor.execute('SELECT referral_code, referred_by FROM users WHERE user_id = ?', (target_user_id,))
         user_data = cursor.fetchone()
         
         if user_data:
-            old_referral_code = user_data[0]
+            old_referral_code, referred_by = user_data
             
             # Remove any referrals that were made using this user's referral code
             cursor.execute('UPDATE users SET referred_by = NULL WHERE referred_by = ?', (target_user_id,))
+            cursor.execute('DELETE FROM referral_counts WHERE referrer_id = ?', (target_user_id,))
+            if referred_by:
+                uncredit_referral(cursor, referred_by)
             
             # Delete the user from database
             cursor.execute('DELETE FROM users WHERE user_id = ?', (target_user_id,))
+            cursor.execute('DELETE FROM referral_flags WHERE user_id = ?', (target_user_id,))
             conn.commit()
+            touch_tables('users', 'referral_counts', 'referral_flags')
             
             await query.edit_message_text(
                 f"✅ User {target_user_id} has been deleted from the database.\n"
@@ -809,7 +2318,7 @@ async def delete_user(query, target_user_id: int):
 
 async def show_user_actions(query, target_user_id: int):
     try:
-        conn = sqlite3.connect('user_database.db')
+        conn = connect_db()
         cursor = conn.cursor()
         cursor.execute('SELECT points, wallet_address, referral_code FROM users WHERE user_id = ?', (target_user_id,))
         user_data = cursor.fetchone()
@@ -874,10 +2383,11 @@ async def show_points_options(query, target_user_id: int):
 
 async def modify_user_points(query, target_user_id: int, new_points: int):
     try:
-        conn = sqlite3.connect('user_database.db')
+        conn = connect_db()
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET points = ? WHERE user_id = ?', (new_points, target_user_id))
         conn.commit()
+        touch_tables('users')
         
         await query.edit_message_text(
             f"✅ Points updated successfully!\n\n"
@@ -899,10 +2409,11 @@ async def modify_user_points(query, target_user_id: int, new_points: int):
 
 async def reset_user(query, target_user_id: int):
     try:
-        conn = sqlite3.connect('user_database.db')
+        conn = connect_db()
         cursor = conn.cursor()
         cursor.execute('UPDATE users SET points = 5000, wallet_address = NULL WHERE user_id = ?', (target_user_id,))
         conn.commit()
+        touch_tables('users')
         
         await query.edit_message_text(
             f"✅ User {target_user_id} has been reset!\n"
@@ -921,16 +2432,221 @@ async def reset_user(query, target_user_id: int):
     finally:
         conn.close()
 
-active_ad_tasks = {}
-
 class Advertisement:
-    def __init__(self, name: str, text: str, buttons: List[Dict[str, str]], interval: int):
+    def __init__(self, name: str, text: str, buttons: List[Dict[str, str]], interval: int, segment: Optional[str] = None):
         self.name = name
         self.text = text
         self.buttons = buttons
         self.interval = interval
+        self.segment = segment  # None targets every user
         self.last_sent = None
 
+# Audience segment predicates: name -> (value parser, SQL fragment builder)
+def _parse_flag(value: str) -> bool:
+    if value.lower() in ('yes', 'true', '1'):
+        return True
+    if value.lower() in ('no', 'false', '0'):
+        return False
+    raise ValueError(f"Expected yes or no, got '{value}'")
+
+def _parse_days(value: str) -> int:
+    days = int(value)
+    if days < 0:
+        raise ValueError(f"Expected a number of days, got '{value}'")
+    return days
+
+SEGMENT_PREDICATES = {
+    'has_wallet': (_parse_flag, lambda v: ('wallet_address IS NOT NULL' if v else 'wallet_address IS NULL', [])),
+    'referred': (_parse_flag, lambda v: ('referred_by IS NOT NULL' if v else 'referred_by IS NULL', [])),
+    'min_points': (int, lambda v: ('points >= ?', [v])),
+    'max_points': (int, lambda v: ('points <= ?', [v])),
+    'joined_within_days': (_parse_days, lambda v: ("joined_at >= datetime('now', ?)", [f'-{v} days'])),
+}
+
+def parse_segment_predicates(args: List[str]) -> Dict:
+    predicates = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep or key not in SEGMENT_PREDICATES:
+            raise ValueError(f"Unknown predicate '{arg}'. Use: {', '.join(SEGMENT_PREDICATES)}")
+        predicates[key] = SEGMENT_PREDICATES[key][0](value)
+    return predicates
+
+def compile_segment(predicates: Dict):
+    """Compile segment predicates to a WHERE clause over users and its parameters."""
+    clauses = []
+    params = []
+    for key, value in sorted(predicates.items()):
+        clause, clause_params = SEGMENT_PREDICATES[key][1](value)
+        clauses.append(clause)
+        params += clause_params
+    return (' AND '.join(clauses) or '1'), params
+
+def refresh_segment(cursor, name: str, predicates: Dict) -> int:
+    where, params = compile_segment(predicates)
+    cursor.execute('DELETE FROM segment_members WHERE segment_name = ?', (name,))
+    cursor.execute(
+        f'INSERT INTO segment_members (segment_name, user_id) SELECT ?, user_id FROM users WHERE {where}',
+        [name] + params
+    )
+    member_count = cursor.rowcount
+    cursor.execute('''
+        UPDATE audience_segments SET refreshed_at = CURRENT_TIMESTAMP, member_count = ?
+        WHERE name = ?
+    ''', (member_count, name))
+    return member_count
+
+RECIPIENT_PAGE_SIZE = 1000
+
+def recipient_query(segment: Optional[str]) -> Optional[Tuple[str, List]]:
+    """SQL selecting the user ids an ad targeting segment (None = everyone) goes to, and
+    its parameters; None if the segment no longer exists. The SQL ends in a WHERE clause
+    so pages can be cut from it by user_id (see fetch_recipient_page)."""
+    if segment is None:
+        return 'SELECT user_id FROM users WHERE 1', []
+
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT predicates, refresh_interval,
+                   refreshed_at IS NULL OR refreshed_at <= datetime('now', '-' || refresh_interval || ' seconds')
+            FROM audience_segments WHERE name = ?
+        ''', (segment,))
+        row = cursor.fetchone()
+        if not row:
+            logger.warning(f"Audience segment '{segment}' no longer exists; skipping send")
+            return None
+
+        predicates, refresh_interval, stale = json.loads(row[0]), row[1], row[2]
+        if refresh_interval:
+            # Materialized segment: reuse the cached recipient set until it goes stale
+            if stale:
+                refresh_segment(cursor, segment, predicates)
+                conn.commit()
+            return 'SELECT user_id FROM segment_members WHERE segment_name = ?', [segment]
+        where, params = compile_segment(predicates)
+        return f'SELECT user_id FROM users WHERE ({where})', params
+    finally:
+        conn.close()
+
+def count_recipients(queries: List[Tuple[str, List]], after: int) -> int:
+    """Distinct user ids after `after` across the recipient queries."""
+    if not queries:
+        return 0
+    conn = connect_db()
+    try:
+        sql = ' UNION '.join(f'{query} AND user_id > ?' for query, _ in queries)
+        params = [param for _, query_params in queries for param in query_params + [after]]
+        return conn.execute(f'SELECT COUNT(*) FROM ({sql})', params).fetchone()[0]
+    finally:
+        conn.close()
+
+def fetch_recipient_page(queries: List[Tuple[str, List]], after: int,
+                         limit: int = RECIPIENT_PAGE_SIZE) -> List[Tuple[int, List[int]]]:
+    """The next recipients after user id `after`, in user_id order, each with the indexes
+    of the queries (ads) it matched. Empty once every query is exhausted.
+
+    Each query reads at most limit ids by keyset. Only ids up to the smallest last id
+    of a full page are returned, since a query with a full page may match more beyond it.
+    """
+    conn = connect_db()
+    try:
+        pages = []
+        bound = None
+        for query, params in queries:
+            ids = [row[0] for row in conn.execute(
+                f'{query} AND user_id > ? ORDER BY user_id LIMIT ?', params + [after, limit]
+            )]
+            pages.append(ids)
+            if len(ids) == limit:
+                bound = ids[-1] if bound is None else min(bound, ids[-1])
+    finally:
+        conn.close()
+    recipients: Dict[int, List[int]] = {}
+    for index, ids in enumerate(pages):
+        for user_id in ids:
+            if bound is None or user_id <= bound:
+                recipients.setdefault(user_id, []).append(index)
+    return sorted(recipients.items())
+
+# Audience segments command
+async def manage_segments(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return
+
+    usage = (
+        "Usage:\n"
+        "/segment list\n"
+        "/segment add <name> [refresh=<seconds>] <predicate>=<value> ...\n"
+        "/segment remove <name>\n\n"
+        f"Predicates: {', '.join(SEGMENT_PREDICATES)}"
+    )
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+
+    action = context.args[0].lower()
+    conn = connect_db()
+    cursor = conn.cursor()
+    try:
+        if action == 'list':
+            cursor.execute('SELECT name, predicates, refresh_interval, member_count, refreshed_at FROM audience_segments ORDER BY name')
+            segments = cursor.fetchall()
+            if not segments:
+                await update.message.reply_text("No audience segments defined.")
+                return
+            message_text = "🎯 Audience Segments\n\n"
+            for name, predicates, refresh_interval, member_count, refreshed_at in segments:
+                message_text += f"• {name}: {predicates}\n"
+                if refresh_interval:
+                    message_text += f"└ Cached, refresh every {refresh_interval}s ({member_count} users at {refreshed_at})\n"
+                else:
+                    message_text += "└ Evaluated at send time\n"
+            await update.message.reply_text(message_text)
+
+        elif action == 'add' and len(context.args) >= 2:
+            name = context.args[1]
+            refresh_interval = 0
+            predicate_args = []
+            for arg in context.args[2:]:
+                if arg.startswith('refresh='):
+                    refresh_interval = int(arg.split('=', 1)[1])
+                else:
+                    predicate_args.append(arg)
+            predicates = parse_segment_predicates(predicate_args)
+
+            cursor.execute('''
+                INSERT OR REPLACE INTO audience_segments (name, predicates, refresh_interval, created_by)
+                VALUES (?, ?, ?, ?)
+            ''', (name, json.dumps(predicates), refresh_interval, update.effective_user.id))
+            member_count = None
+            if refresh_interval:
+                member_count = refresh_segment(cursor, name, predicates)
+            else:
+                cursor.execute('DELETE FROM segment_members WHERE segment_name = ?', (name,))
+            conn.commit()
+
+            message_text = f"✅ Segment '{name}' saved."
+            if member_count is not None:
+                message_text += f" {member_count} users cached."
+            await update.message.reply_text(message_text)
+
+        elif action == 'remove' and len(context.args) >= 2:
+            name = context.args[1]
+            cursor.execute('DELETE FROM audience_segments WHERE name = ?', (name,))
+            cursor.execute('DELETE FROM segment_members WHERE segment_name = ?', (name,))
+            conn.commit()
+            await update.message.reply_text(f"Segment '{name}' removed.")
+
+        else:
+            await update.message.reply_text(usage)
+
+    except ValueError as e:
+        await update.message.reply_text(f"Invalid segment: {e}")
+    finally:
+        conn.close()
+
 def load_ads() -> List[Advertisement]:
     try:
         with open('advertisements.json', 'r') as f:
@@ -940,7 +2656,8 @@ def load_ads() -> List[Advertisement]:
                     ad['name'],
                     ad['text'],
                     ad['buttons'],
-                    ad['interval']
+                    ad['interval'],
+                    ad.get('segment')
                 ) for ad in ads_data
             ]
     except FileNotFoundError:
@@ -952,19 +2669,14 @@ def save_ads(ads: List[Advertisement]):
             'name': ad.name,
             'text': ad.text,
             'buttons': ad.buttons,
-            'interval': ad.interval
+            'interval': ad.interval,
+            'segment': ad.segment
         } for ad in ads
     ]
     with open('advertisements.json', 'w') as f:
         json.dump(ads_data, f, indent=4)
 
-async def send_advertisement(bot, ad: Advertisement):
-    conn = sqlite3.connect('user_database.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    users = cursor.fetchall()
-    conn.close()
-
+def build_ad_markup(ad: Advertisement) -> Optional[InlineKeyboardMarkup]:
     # Create keyboard from buttons
     keyboard = []
     row = []
@@ -979,24 +2691,391 @@ async def send_advertisement(bot, ad: Advertisement):
     if row:  # Add remaining buttons
         keyboard.append(row)
 
-    reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+    return InlineKeyboardMarkup(keyboard) if keyboard else None
+
+AD_SEND_DELAY = 0.05  # Small delay between messages to avoid hitting limits
+AD_COALESCE_WINDOW = 5  # Ads due within this many seconds of each other share one pass
+
+# Frequency cap: at most AD_FREQUENCY_CAP ads per user per sliding window
+AD_FREQUENCY_CAP = int(os.environ.get('AD_FREQUENCY_CAP', 4))
+AD_FREQUENCY_WINDOW = 3600
+AD_FREQUENCY_BUCKETS = 6  # 10-minute sub-buckets
+AD_FREQUENCY_PERSIST_INTERVAL = 300
+
+class FrequencyCap:
+    """Sliding-window per-user ad counters.
+
+    Each user has one array('H') ring of sub-bucket counts plus the index of the
+    bucket last written, so a user costs a few dozen bytes. Counters are saved to
+    the ad_frequency table periodically and reloaded on start.
+    """
+
+    __slots__ = ('cap', 'bucket_seconds', 'counters', 'dirty', 'suppressed')
+
+    def __init__(self, cap: int = AD_FREQUENCY_CAP, window: int = AD_FREQUENCY_WINDOW):
+        self.cap = cap
+        self.bucket_seconds = window // AD_FREQUENCY_BUCKETS
+        # user_id -> (last bucket number, array of counts indexed by bucket % AD_FREQUENCY_BUCKETS)
+        self.counters: Dict[int, Tuple[int, array]] = {}
+        self.dirty = set()
+        self.suppressed: Dict[str, int] = {}
+
+    def _advance(self, user_id: int, bucket: int) -> array:
+        last, counts = self.counters.get(user_id, (bucket, None))
+        if counts is None:
+            counts = array('H', bytes(2 * AD_FREQUENCY_BUCKETS))
+        elif bucket - last >= AD_FREQUENCY_BUCKETS:
+            counts = array('H', bytes(2 * AD_FREQUENCY_BUCKETS))
+        else:
+            # Zero the sub-buckets that slid out of the window since the last write
+            for stale in range(last + 1, bucket + 1):
+                counts[stale % AD_FREQUENCY_BUCKETS] = 0
+        self.counters[user_id] = (max(bucket, last), counts)
+        return counts
+
+    def check(self, user_id: int, ad_name: str, now: Optional[float] = None) -> bool:
+        """Whether user_id is below the cap; counts a suppression for ad_name if not.
+        A send is only counted once it went through, with record()."""
+        bucket = int((time.time() if now is None else now) // self.bucket_seconds)
+        if sum(self._advance(user_id, bucket)) >= self.cap:
+            self.suppressed[ad_name] = self.suppressed.get(ad_name, 0) + 1
+            return False
+        return True
+
+    def record(self, user_id: int, now: Optional[float] = None):
+        """Count a delivered ad against user_id's window."""
+        bucket = int((time.time() if now is None else now) // self.bucket_seconds)
+        counts = self._advance(user_id, bucket)
+        slot = bucket % AD_FREQUENCY_BUCKETS
+        counts[slot] = min(counts[slot] + 1, 0xFFFF)
+        self.dirty.add(user_id)
+
+    def load(self, database: str = 'user_database.db'):
+        oldest = int(time.time() // self.bucket_seconds) - AD_FREQUENCY_BUCKETS
+        conn = connect_db(database)
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, last_bucket, counts FROM ad_frequency WHERE last_bucket > ?', (oldest,))
+        for user_id, last_bucket, blob in cursor.fetchall():
+            counts = array('H')
+            counts.frombytes(blob)
+            self.counters[user_id] = (last_bucket, counts)
+        cursor.execute('SELECT ad_name, suppressed FROM ad_suppressions')
+        self.suppressed.update(dict(cursor.fetchall()))
+        conn.close()
+
+    async def save(self, database: str = 'user_database.db') -> int:
+        """Write dirty counters and suppression totals; forget users whose window has expired.
+
+        The counters are copied on the event loop and written from a worker thread.
+        """
+        rows, suppressions, oldest = self._collect()
+        try:
+            await asyncio.to_thread(self._write, rows, suppressions, oldest, database)
+        except sqlite3.Error:
+            # Saved with the next batch instead
+            self.dirty.update(user_id for user_id, _, _ in rows)
+            raise
+        return len(rows)
+
+    def _collect(self):
+        oldest = int(time.time() // self.bucket_seconds) - AD_FREQUENCY_BUCKETS
+        expired = [user_id for user_id, (last, _) in self.counters.items() if last <= oldest]
+        for user_id in expired:
+            del self.counters[user_id]
+            self.dirty.discard(user_id)
+
+        rows = [
+            (user_id, self.counters[user_id][0], self.counters[user_id][1].tobytes())
+            for user_id in self.dirty
+        ]
+        self.dirty.clear()
+        return rows, list(self.suppressed.items()), oldest
+
+    def _write(self, rows, suppressions, oldest: int, database: str):
+        conn = connect_db(database)
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO ad_frequency (user_id, last_bucket, counts) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_bucket = excluded.last_bucket, counts = excluded.counts
+        ''', rows)
+        cursor.execute('DELETE FROM ad_frequency WHERE last_bucket <= ?', (oldest,))
+        cursor.executemany('''
+            INSERT INTO ad_suppressions (ad_name, suppressed) VALUES (?, ?)
+            ON CONFLICT(ad_name) DO UPDATE SET suppressed = excluded.suppressed
+        ''', suppressions)
+        conn.commit()
+        conn.close()
+
+    def forget_ad(self, ad_name: str, database: str = 'user_database.db'):
+        self.suppressed.pop(ad_name, None)
+        conn = connect_db(database)
+        conn.execute('DELETE FROM ad_suppressions WHERE ad_name = ?', (ad_name,))
+        conn.commit()
+        conn.close()
+
+frequency_cap = FrequencyCap()
+# ad name -> sends Telegram refused (blocked the bot, deactivated, ...) since start
+ad_send_failures: Dict[str, int] = {}
+
+async def frequency_cap_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    saved = await frequency_cap.save()
+    if saved:
+        logger.info(f"Frequency cap: saved {saved} user counters")
+
+async def send_advertisements(bot, ads: List[Advertisement], resume_after: Optional[int] = None,
+                              progress: Optional[ProgressReporter] = None) -> Tuple[int, Optional[int]]:
+    """Send every ad in ads to its audience in a single pass over recipients.
+
+    Recipients are visited in user_id order, a page at a time (read off the event
+    loop), so memory stays flat however many users there are. Returns (messages
+    sent, last user_id reached) when the pass stopped early for shutdown,
+    (messages sent, None) otherwise.
+    """
+    def prepare():
+        targeted = [(ad, recipient_query(ad.segment)) for ad in ads]
+        targeted = [(ad, query) for ad, query in targeted if query is not None]
+        total = count_recipients([query for _, query in targeted], resume_after or 0) if progress is not None else None
+        return targeted, total
+
+    targeted, total = await asyncio.to_thread(prepare)
+    queries = [query for _, query in targeted]
+    markups = {ad.name: build_ad_markup(ad) for ad in ads}
+    if progress is not None:
+        progress.update(0, total=total)
+
+    sent = 0
+    last_user_id = resume_after or 0
+    while True:
+        page = await asyncio.to_thread(fetch_recipient_page, queries, last_user_id, RECIPIENT_PAGE_SIZE)
+        if not page:
+            return sent, None
+        for user_id, ad_indexes in page:
+            if lifecycle.stopping.is_set():
+                return sent, last_user_id
+            last_user_id = user_id
+            if progress is not None:
+                progress.advance()
+            for ad in (targeted[index][0] for index in ad_indexes):
+                if not frequency_cap.check(user_id, ad.name):
+                    continue
+                try:
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=ad.text,
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=markups[ad.name]
+                    )
+                except TelegramError as e:
+                    # Not delivered, so it doesn't count against the user's cap
+                    ad_send_failures[ad.name] = ad_send_failures.get(ad.name, 0) + 1
+                    logger.debug(f"Ad {ad.name} to {user_id} failed: {e}")
+                    continue
+                frequency_cap.record(user_id)
+                sent += 1
+                await asyncio.sleep(AD_SEND_DELAY)
+
+async def send_advertisement(bot, ad: Advertisement):
+    await send_advertisements(bot, [ad])
+
+def save_broadcast_checkpoint(ad_names: List[str], last_user_id: int, sent: int, fired_at: float):
+    conn = connect_db()
+    conn.execute(
+        'INSERT INTO broadcast_checkpoints (ad_names, last_user_id, sent, fired_at) VALUES (?, ?, ?, ?)',
+        (json.dumps(ad_names), last_user_id, sent, fired_at)
+    )
+    conn.commit()
+    conn.close()
+
+def take_broadcast_checkpoints() -> List[Tuple[List[str], int, float]]:
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM broadcast_checkpoints
+        RETURNING ad_names, last_user_id, COALESCE(fired_at, CAST(strftime('%s', created_at) AS REAL))
+    ''')
+    checkpoints = [
+        (json.loads(ad_names), last_user_id, fired_at) for ad_names, last_user_id, fired_at in cursor.fetchall()
+    ]
+    conn.commit()
+    conn.close()
+    return checkpoints
+
+class AdScheduler:
+    """Owns the next fire time of every ad in one heap and runs them at fixed cadence.
+
+    Fire times advance by the interval from the scheduled time, not from when the
+    broadcast finished, so ads don't drift. Ads that fall due together are sent in
+    one pass, and passes never overlap; a pass that overruns shows up as lag.
+    """
+
+    def __init__(self):
+        self.ads: Dict[str, Advertisement] = {}
+        self.next_fire: Dict[str, float] = {}
+        self.stats: Dict[str, Dict] = {}
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.last_pass = None  # (started, duration, ads, messages sent)
+        self.progress: Optional[ProgressReporter] = None  # the running pass, if any
+
+    def add(self, ad: Advertisement, first_fire: Optional[float] = None):
+        self.ads[ad.name] = ad
+        self.stats.setdefault(ad.name, {'fires': 0, 'missed': 0, 'last_fired': None, 'last_lag': 0.0})
+        self._push(ad.name, time.monotonic() if first_fire is None else first_fire)
+
+    def remove(self, name: str):
+        # Heap entries for removed ads are dropped lazily when they surface
+        self.ads.pop(name, None)
+        self.next_fire.pop(name, None)
+        self.stats.pop(name, None)
+        self._wakeup.set()
+
+    def _push(self, name: str, when: float):
+        self.next_fire[name] = when
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, name))
+        self._wakeup.set()
+
+    def _pop_due(self, now: float) -> List[Tuple[str, float]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now + AD_COALESCE_WINDOW:
+            when, _, name = heapq.heappop(self._heap)
+            if self.next_fire.get(name) != when:
+                continue  # stale entry: ad removed or rescheduled
+            due.append((name, when))
+        return due
+
+    def _reschedule(self, name: str, scheduled: float, now: float):
+        interval = self.ads[name].interval
+        next_fire = scheduled + interval
+        if next_fire <= now:
+            # Fell more than a whole interval behind: skip the missed slots, keep the phase
+            missed = int((now - next_fire) // interval) + 1
+            self.stats[name]['missed'] += missed
+            next_fire += missed * interval
+        self._push(name, next_fire)
+
+    def start(self, bot):
+        checkpoints = take_broadcast_checkpoints()
+        # Ads whose pass was interrupted are finished by the resume; their next pass
+        # keeps the cadence from when the interrupted one fired instead of repeating now
+        fired = {}
+        for ad_names, _, fired_at in checkpoints:
+            for name in ad_names:
+                fired[name] = max(fired.get(name, fired_at), fired_at)
+        now, wall_now = time.monotonic(), time.time()
+        for ad in load_ads():
+            if ad.name in fired:
+                self.add(ad, now + max(0.0, fired[ad.name] + ad.interval - wall_now))
+                self.stats[ad.name]['last_fired'] = ad.last_sent = datetime.fromtimestamp(fired[ad.name])
+            else:
+                self.add(ad)
+        self._task = lifecycle.spawn('ad_scheduler', self.run(bot, checkpoints))
+
+    async def _broadcast(self, bot, ads: List[Advertisement], resume_after: Optional[int] = None,
+                         fired_at: Optional[float] = None) -> int:
+        # Nobody watches by default; /adschedule attaches a status message to it
+        self.progress = ProgressReporter(f"Broadcast of {', '.join(ad.name for ad in ads)}", unit='users')
+        try:
+            async with self.progress, lifecycle.work('broadcast'):
+                sent, stopped_at = await send_advertisements(bot, ads, resume_after, self.progress)
+                if stopped_at is not None:
+                    # Interrupted by shutdown: the next start picks up after stopped_at
+                    save_broadcast_checkpoint(
+                        [ad.name for ad in ads], stopped_at, sent, time.time() if fired_at is None else fired_at
+                    )
+                    logger.info(f"Broadcast of {[ad.name for ad in ads]} checkpointed after user {stopped_at}")
+        finally:
+            self.progress = None
+        return sent
+
+    async def _resume_checkpoints(self, bot, checkpoints):
+        for ad_names, last_user_id, fired_at in checkpoints:
+            ads = [self.ads[name] for name in ad_names if name in self.ads]
+            if ads:
+                logger.info(f"Resuming broadcast of {ad_names} after user {last_user_id}")
+                await self._broadcast(bot, ads, last_user_id, fired_at)
+
+    async def run(self, bot, checkpoints=()):
+        await self._resume_checkpoints(bot, checkpoints)
+        while not lifecycle.stopping.is_set():
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = self._pop_due(now)
+            if not due:
+                timeout = self._heap[0][0] - AD_COALESCE_WINDOW - now if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            started = time.monotonic()
+            for name, scheduled in due:
+                stats = self.stats[name]
+                stats['fires'] += 1
+                stats['last_fired'] = datetime.now()
+                stats['last_lag'] = max(0.0, started - scheduled)
+                self.ads[name].last_sent = stats['last_fired']
+            ads = [self.ads[name] for name, _ in due]
+            try:
+                sent = await self._broadcast(bot, ads, fired_at=time.time())
+            except Exception:
+                logger.exception("Advertisement pass failed")
+                sent = 0
+            finished = time.monotonic()
+            self.passes += 1
+            self.last_pass = (datetime.now(), finished - started, len(ads), sent)
+
+            for name, scheduled in due:
+                if name in self.ads:
+                    self._reschedule(name, scheduled, finished)
+
+    def schedule(self) -> List[Tuple[Advertisement, float, Dict]]:
+        now = time.monotonic()
+        return sorted(
+            ((self.ads[name], when - now, self.stats[name]) for name, when in self.next_fire.items()),
+            key=lambda item: item[1]
+        )
+
+ad_scheduler = AdScheduler()
 
-    for user in users:
-        try:
-            await bot.send_message(
-                chat_id=user[0],
-                text=ad.text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
-            await asyncio.sleep(0.05)  # Small delay to avoid hitting limits
-        except TelegramError:
-            continue
+async def ad_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return  # Exit if not an admin
 
-async def advertisement_loop(bot, ad: Advertisement):
-    while True:
-        await send_advertisement(bot, ad)
-        await asyncio.sleep(ad.interval)
+    schedule = ad_scheduler.schedule()
+    if not schedule:
+        await update.message.reply_text("No advertisements scheduled.")
+        return
+
+    lines = ["🗓 Advertisement Schedule\n"]
+    for ad, due_in, stats in schedule:
+        last = stats['last_fired'].strftime('%Y-%m-%d %H:%M:%S') if stats['last_fired'] else 'never'
+        lines.append(
+            f"• {ad.name} ({ad.segment or 'all users'}), every {ad.interval}s\n"
+            f"  next in {format_duration(due_in)}, last sent {last}, "
+            f"lag {stats['last_lag']:.1f}s, sent {stats['fires']}x, missed {stats['missed']}, "
+            f"capped {frequency_cap.suppressed.get(ad.name, 0)} sends, "
+            f"failed {ad_send_failures.get(ad.name, 0)}"
+        )
+    if ad_scheduler.last_pass:
+        started, duration, ad_count, sent = ad_scheduler.last_pass
+        lines.append(
+            f"\nLast pass: {started.strftime('%H:%M:%S')}, {ad_count} ad(s), "
+            f"{sent} messages in {duration:.1f}s ({ad_scheduler.passes} passes total)"
+        )
+    lines.append(
+        f"Frequency cap: {frequency_cap.cap} ads per user per {format_duration(AD_FREQUENCY_WINDOW)}, "
+        f"{len(frequency_cap.counters)} users tracked"
+    )
+    await update.message.reply_text("\n".join(lines))
+
+    # Follow a pass that is running right now in its own live status message
+    if ad_scheduler.progress is not None:
+        ad_scheduler.progress.attach(await update.message.reply_text(ad_scheduler.progress.render()))
 
 async def adminadd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_admin(update):
@@ -1074,36 +3153,60 @@ async def handle_ad_creation(update: Update, context: ContextTypes.DEFAULT_TYPE)
             if interval < 60:
                 await update.message.reply_text("Interval must be at least 60 seconds.")
                 return
+        except ValueError:
+            await update.message.reply_text("Please send a valid number of seconds.")
+            return
 
-            # Create new advertisement
-            ad = Advertisement(
-                context.user_data['ad_name'],
-                context.user_data['ad_text'],
-                context.user_data['ad_buttons'],
-                interval
-            )
+        context.user_data['ad_interval'] = interval
+        await update.message.reply_text(
+            "Send the name of the audience segment to target (see /segment list), "
+            "or 'all' to send to every user.\n"
+            "Or send /cancel to cancel"
+        )
+        context.user_data['awaiting_ad'] = 'segment'
 
-            # Load existing ads
-            ads = load_ads()
-            ads.append(ad)
-            save_ads(ads)
+    elif state == 'segment':
+        segment = update.message.text.strip()
+        if segment.lower() == 'all':
+            segment = None
+        else:
+            conn = connect_db()
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM audience_segments WHERE name = ?', (segment,))
+            exists = cursor.fetchone() is not None
+            conn.close()
+            if not exists:
+                await update.message.reply_text("Unknown segment. Send an existing segment name or 'all'.")
+                return
 
-            # Start the advertisement loop
-            task = asyncio.create_task(advertisement_loop(context.bot, ad))
-            active_ad_tasks[ad.name] = task
+        interval = context.user_data['ad_interval']
 
-            await update.message.reply_text(
-                "✅ Advertisement created and scheduled!\n\n"
-                f"Name: {ad.name}\n"
-                f"Text: {ad.text}\n"
-                f"Interval: Every {interval} seconds"
-            )
-            
-            # Clear user data
-            context.user_data.clear()
+        # Create new advertisement
+        ad = Advertisement(
+            context.user_data['ad_name'],
+            context.user_data['ad_text'],
+            context.user_data['ad_buttons'],
+            interval,
+            segment
+        )
 
-        except ValueError:
-            await update.message.reply_text("Please send a valid number of seconds.")
+        # Load existing ads
+        ads = load_ads()
+        ads.append(ad)
+        save_ads(ads)
+
+        ad_scheduler.add(ad)
+
+        await update.message.reply_text(
+            "✅ Advertisement created and scheduled!\n\n"
+            f"Name: {ad.name}\n"
+            f"Text: {ad.text}\n"
+            f"Interval: Every {interval} seconds\n"
+            f"Audience: {ad.segment or 'All users'}"
+        )
+        
+        # Clear user data
+        context.user_data.clear()
 
 async def admin_ads(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_admin(update):
@@ -1117,7 +3220,8 @@ async def admin_ads(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = []
     for ad in ads:
         keyboard.append([InlineKeyboardButton(
-            f"❌ Remove: {ad.name}",
+            f"❌ Remove: {ad.name} ({ad.segment or 'all users'}, "
+            f"{frequency_cap.suppressed.get(ad.name, 0)} capped)",
             callback_data=f'remove_ad_{ad.name}'
         )])
     
@@ -1138,10 +3242,8 @@ async def handle_ad_removal(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if query.data.startswith('remove_ad_'):
         ad_name = query.data[10:]  # Remove 'remove_ad_' prefix
         
-        # Stop the ad task if it's running
-        if ad_name in active_ad_tasks:
-            active_ad_tasks[ad_name].cancel()
-            del active_ad_tasks[ad_name]
+        ad_scheduler.remove(ad_name)
+        frequency_cap.forget_ad(ad_name)
         
         # Remove from saved ads
         ads = load_ads()
@@ -1150,12 +3252,6 @@ async def handle_ad_removal(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         await query.edit_message_text(f"✅ Advertisement '{ad_name}' has been removed.")
 
-async def start_existing_ads(application):
-    ads = load_ads()
-    for i, ad in enumerate(ads):
-        task = asyncio.create_task(advertisement_loop(application.bot, ad))
-        active_ad_tasks[i] = task
-
 
 # Define states
 WAITING_FOR_ADMIN_ID = 1
@@ -1164,7 +3260,7 @@ WAITING_FOR_ADMIN_ID = 1
 async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     # Check if user is main admin
@@ -1211,13 +3307,14 @@ async def start_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return WAITING_FOR_ADMIN_ID
 
-async def show_admin_management(query):
-    conn = sqlite3.connect('user_database.db')
+async def render_admin_management():
+    conn = connect_db()
     cursor = conn.cursor()
     
     # Get current admins
     cursor.execute('SELECT admin_id, is_main_admin FROM administrators')
     admins = cursor.fetchall()
+    conn.close()
     
     keyboard = []
     for admin_id, is_main in admins:
@@ -1232,12 +3329,10 @@ async def show_admin_management(query):
     keyboard.append([InlineKeyboardButton("➕ Add New Admin", callback_data='add_admin')])
     keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='admin_back')])
     
-    await query.edit_message_text(
-        "👮 Admin Management\n\nCurrent Admins:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    
-    conn.close()
+    return "👮 Admin Management\n\nCurrent Admins:", InlineKeyboardMarkup(keyboard)
+
+async def show_admin_management(query):
+    await show_screen(query, 'admins', None, render_admin_management)
 
 async def cancel_admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text("Admin addition cancelled.")
@@ -1246,7 +3341,7 @@ async def cancel_admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 async def handle_admin_removal(query, admin_id: int):
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     # Check if the target is the main admin
@@ -1265,6 +3360,8 @@ async def handle_admin_removal(query, admin_id: int):
     cursor.execute('DELETE FROM administrators WHERE admin_id = ?', (admin_id,))
     conn.commit()
     conn.close()
+    touch_tables('administrators')
+    flood_control.admin_ids.discard(admin_id)
     
     await query.edit_message_text(
         f"Admin {admin_id} has been removed.",
@@ -1288,7 +3385,7 @@ async def handle_admin_id_input(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     # Check if user is already an admin
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT admin_id FROM administrators WHERE admin_id = ?', (new_admin_id,))
     
@@ -1302,6 +3399,8 @@ async def handle_admin_id_input(update: Update, context: ContextTypes.DEFAULT_TY
                    (new_admin_id, user_id, datetime.now().isoformat()))
     conn.commit()
     conn.close()
+    touch_tables('administrators')
+    flood_control.admin_ids.add(new_admin_id)
 
     # Notify admin
     await update.message.reply_text(f"✅ User {new_admin_id} has been added as an admin.")
@@ -1324,7 +3423,7 @@ async def cancel_admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 def is_main_admin(user_id: int) -> bool:
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT is_main_admin FROM administrators WHERE admin_id = ?', (user_id,))
     result = cursor.fetchone()
@@ -1335,7 +3434,7 @@ async def message_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_id = update.effective_user.id
     
     # Check if user is muted
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     cursor.execute('SELECT muted_until FROM muted_users WHERE user_id = ?', (user_id,))
     muted = cursor.fetchone()
@@ -1360,10 +3459,10 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
     # Handle admin reply
     if context.user_data.get('awaiting_reply'):
         message_id = context.user_data['awaiting_reply']
-        await save_admin_reply(message_id, message, user_id, context)
+        replied = await save_admin_reply(message_id, message, user_id, context)
         del context.user_data['awaiting_reply']
         await update.message.reply_text(
-            "Reply sent successfully!",
+            "Reply sent successfully!" if replied else "Reply not sent: the message was handled by another admin.",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🔙 Back to Messages", callback_data='admin_messages_0')
             ]])
@@ -1378,7 +3477,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         
         # Check for banned words
-        conn = sqlite3.connect('user_database.db')
+        conn = connect_db()
         cursor = conn.cursor()
         cursor.execute('SELECT word FROM banned_words')
         banned_words = {row[0].lower() for row in cursor.fetchall()}
@@ -1401,24 +3500,101 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
         context.user_data['awaiting_admin_message'] = False
 
 
+# Inbox work queue: admins claim pending messages under a lease that expires
+MESSAGE_LEASE_SECONDS = 600
+MESSAGE_CLAIM_BATCH = 5
+
+def format_duration(seconds: int) -> str:
+    seconds = max(0, int(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m"
+    if seconds < 86400:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    return f"{seconds // 86400}d {seconds % 86400 // 3600}h"
+
+def claim_messages(admin_id: int, batch: int = MESSAGE_CLAIM_BATCH) -> List[int]:
+    """Atomically lease the oldest unclaimed pending messages to admin_id."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    # One UPDATE statement runs under SQLite's write lock, so two admins never get the same rows
+    cursor.execute('''
+        UPDATE messages
+        SET claimed_by = ?, claim_expires_at = datetime('now', ?)
+        WHERE message_id IN (
+            SELECT message_id FROM messages
+            WHERE status = 'pending'
+              AND (claimed_by IS NULL OR claim_expires_at <= datetime('now'))
+            ORDER BY timestamp
+            LIMIT ?
+        )
+        RETURNING message_id
+    ''', (admin_id, f'+{MESSAGE_LEASE_SECONDS} seconds', batch))
+    claimed = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    conn.close()
+    return claimed
+
+def claim_message(message_id: int, admin_id: int) -> bool:
+    """Claim (or renew) a single pending message unless another admin holds a live lease."""
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE messages
+        SET claimed_by = ?, claim_expires_at = datetime('now', ?)
+        WHERE message_id = ? AND status = 'pending'
+          AND (claimed_by IS NULL OR claimed_by = ? OR claim_expires_at <= datetime('now'))
+    ''', (admin_id, f'+{MESSAGE_LEASE_SECONDS} seconds', message_id, admin_id))
+    claimed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return claimed
+
+def release_claims(admin_id: int) -> int:
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE messages SET claimed_by = NULL, claim_expires_at = NULL
+        WHERE claimed_by = ? AND status = 'pending'
+    ''', (admin_id,))
+    released = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return released
+
 async def show_messages(query, page: int):
-    conn = sqlite3.connect('user_database.db')
+    admin_id = query.from_user.id
+    conn = connect_db()
     cursor = conn.cursor()
     
-    # Get total pending messages count
-    cursor.execute('SELECT COUNT(*) FROM messages WHERE status = "pending"')
-    total_messages = cursor.fetchone()[0]
-    total_pages = math.ceil(total_messages / 5)  # 5 messages per page
+    # Queue depth comes from the trigger-maintained counter, age from the (status, timestamp) index
+    cursor.execute("SELECT value FROM counters WHERE name = 'messages_pending'")
+    row = cursor.fetchone()
+    queue_depth = row[0] if row else 0
+    cursor.execute('''
+        SELECT CAST((julianday('now') - julianday(MIN(timestamp))) * 86400 AS INTEGER)
+        FROM messages WHERE status = 'pending'
+    ''')
+    oldest_age = cursor.fetchone()[0]
+    
+    # This admin's live claims
+    cursor.execute('''
+        SELECT COUNT(*), MIN(claim_expires_at) FROM messages
+        WHERE claimed_by = ? AND claim_expires_at > datetime('now') AND status = 'pending'
+    ''', (admin_id,))
+    total_claimed, lease_until = cursor.fetchone()
+    total_pages = math.ceil(total_claimed / 5)  # 5 messages per page
     
-    # Get pending messages for current page
     cursor.execute('''
         SELECT message_id, user_id, message, timestamp 
         FROM messages 
-        WHERE status = "pending"
-        ORDER BY timestamp DESC
+        WHERE claimed_by = ? AND claim_expires_at > datetime('now') AND status = 'pending'
+        ORDER BY timestamp
         LIMIT 5 OFFSET ?
-    ''', (page * 5,))
+    ''', (admin_id, page * 5))
     messages = cursor.fetchall()
+    conn.close()
     
     keyboard = []
     for msg_id, user_id, msg_text, timestamp in messages:
@@ -1439,28 +3615,254 @@ async def show_messages(query, page: int):
     if nav_buttons:
         keyboard.append(nav_buttons)
     
+    keyboard.append([InlineKeyboardButton(f"📥 Claim next {MESSAGE_CLAIM_BATCH}", callback_data='admin_claim_messages')])
+    if total_claimed:
+        keyboard.append([InlineKeyboardButton("↩️ Release my claims", callback_data='admin_release_messages')])
     keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
     
-    message_text = "📨 Pending Messages"
-    if total_messages == 0:
+    message_text = f"📨 Pending Messages: {queue_depth}"
+    if oldest_age is not None:
+        message_text += f" (oldest waiting {format_duration(oldest_age)})"
+    if total_claimed:
+        message_text += f"\n\nYour claims: {total_claimed}, lease until {lease_until} UTC (Page {page + 1}/{max(1, total_pages)})"
+    elif queue_depth == 0:
         message_text += "\n\nNo pending messages."
     else:
-        message_text += f" (Page {page + 1}/{max(1, total_pages)})"
+        message_text += "\n\nClaim a batch to start working through the queue."
     
     await query.edit_message_text(
         message_text,
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    
+
+async def handle_claim_messages(query):
+    claimed = claim_messages(query.from_user.id)
+    await query.answer(None if claimed else "No unclaimed messages right now.")
+    await show_messages(query, 0)
+
+async def handle_release_messages(query):
+    release_claims(query.from_user.id)
+    await show_messages(query, 0)
+
+
+MESSAGE_SEARCH_PAGE_SIZE = 5
+MESSAGE_STATUSES = ('pending', 'replied', 'ignored')
+
+def parse_message_search(args: List[str]) -> Dict:
+    """Split /searchmessages arguments into search terms and filters."""
+    criteria = {'terms': []}
+    for arg in args:
+        name, _, value = arg.partition(':')
+        name = name.lower()
+        if value and name == 'user':
+            criteria['user_id'] = int(value)
+        elif value and name == 'status':
+            if value.lower() not in MESSAGE_STATUSES:
+                raise ValueError(f"Unknown status '{value}'")
+            criteria['status'] = value.lower()
+        elif value and name in ('from', 'to'):
+            datetime.strptime(value, '%Y-%m-%d')
+            criteria[name] = value
+        else:
+            criteria['terms'].append(arg)
+    return criteria
+
+def search_messages(criteria: Dict, page: int, database: str = 'user_database.db'):
+    """Return one page of matching messages and whether a next page exists."""
+    conditions = []
+    params = []
+    if criteria.get('user_id') is not None:
+        conditions.append('m.user_id = ?')
+        params.append(criteria['user_id'])
+    if criteria.get('status'):
+        conditions.append('m.status = ?')
+        params.append(criteria['status'])
+    if criteria.get('from'):
+        conditions.append('m.timestamp >= ?')
+        params.append(criteria['from'])
+    if criteria.get('to'):
+        conditions.append("m.timestamp < date(?, '+1 day')")
+        params.append(criteria['to'])
+
+    if criteria['terms']:
+        # Quote every term so user input can't inject FTS5 query syntax
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in criteria['terms'])
+        sql = '''
+            SELECT m.message_id, m.user_id, m.message, m.status, m.timestamp
+            FROM messages_fts
+            JOIN messages m ON m.message_id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        '''
+        params.insert(0, match)
+        if conditions:
+            sql += ' AND ' + ' AND '.join(conditions)
+        sql += ' ORDER BY messages_fts.rank'
+    else:
+        sql = 'SELECT m.message_id, m.user_id, m.message, m.status, m.timestamp FROM messages m'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY m.timestamp DESC'
+    sql += ' LIMIT ? OFFSET ?'
+    params += [MESSAGE_SEARCH_PAGE_SIZE + 1, page * MESSAGE_SEARCH_PAGE_SIZE]
+
+    conn = connect_db(database)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
     conn.close()
+    return rows[:MESSAGE_SEARCH_PAGE_SIZE], len(rows) > MESSAGE_SEARCH_PAGE_SIZE
+
+def render_message_search(criteria: Dict, page: int, archive: bool = False):
+    results, has_next = search_messages(criteria, page, MESSAGE_ARCHIVE_DB if archive else 'user_database.db')
+    callback_prefix = 'admin_archsearch_' if archive else 'admin_msgsearch_'
+
+    title = "🗄 Archive search" if archive else "🔎 Search"
+    message_text = f"{title}: {' '.join(criteria['terms']) or 'all messages'} (Page {page + 1})\n\n"
+    if not results:
+        message_text += "No matching messages."
+
+    keyboard = []
+    for msg_id, user_id, msg_text, status, timestamp in results:
+        if archive:
+            # Archived messages can't be opened with view_message, so show more of the text inline
+            preview = f"{msg_text[:200]}..." if len(msg_text) > 200 else msg_text
+        else:
+            preview = f"{msg_text[:30]}..." if len(msg_text) > 30 else msg_text
+            keyboard.append([InlineKeyboardButton(f"View #{msg_id}", callback_data=f'view_message_{msg_id}')])
+        message_text += f"#{msg_id} from {user_id} [{status}] {timestamp}\n└ {preview}\n\n"
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'{callback_prefix}{page-1}'))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'{callback_prefix}{page+1}'))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
+
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+# Search messages command
+async def search_messages_command(update: Update, context: ContextTypes.DEFAULT_TYPE, archive: bool = False) -> None:
+    if not await check_admin(update):
+        return
+
+    command = '/searcharchive' if archive else '/searchmessages'
+    if not context.args:
+        await update.message.reply_text(
+            f"Usage: {command} <words> [user:<id>] [status:pending|replied|ignored] "
+            "[from:YYYY-MM-DD] [to:YYYY-MM-DD]"
+        )
+        return
+
+    try:
+        criteria = parse_message_search(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"Invalid search: {e}")
+        return
+
+    context.user_data['archive_search' if archive else 'message_search'] = criteria
+    message_text, reply_markup = render_message_search(criteria, 0, archive)
+    await update.message.reply_text(message_text, reply_markup=reply_markup)
+
+async def search_archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await search_messages_command(update, context, archive=True)
+
+async def show_message_search(query, page: int, context: ContextTypes.DEFAULT_TYPE, archive: bool = False):
+    criteria = context.user_data.get('archive_search' if archive else 'message_search')
+    if not criteria:
+        await query.edit_message_text(
+            f"Search expired. Run {'/searcharchive' if archive else '/searchmessages'} again.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='admin_back')]])
+        )
+        return
+
+    message_text, reply_markup = render_message_search(criteria, page, archive)
+    await query.edit_message_text(message_text, reply_markup=reply_markup)
+
+# Retention: handled messages older than MESSAGE_RETENTION_DAYS move to the archive database
+MESSAGE_ARCHIVE_DB = 'user_database_archive.db'
+MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', 30))
+MESSAGE_ARCHIVE_BATCH = 500
+MESSAGE_ARCHIVE_INTERVAL = 3600
+MESSAGE_ARCHIVE_PAUSE = 0.05  # seconds between batches, lets other writers in
+MESSAGE_VACUUM_PAGES = 1000  # pages returned to the OS per incremental_vacuum step
+
+def archive_messages(
+    retention_days: int = MESSAGE_RETENTION_DAYS,
+    batch_size: int = MESSAGE_ARCHIVE_BATCH,
+    database: str = 'user_database.db',
+    archive_database: str = MESSAGE_ARCHIVE_DB,
+) -> Tuple[int, int]:
+    """Move replied/ignored messages older than retention_days to the archive in batches.
+
+    Returns (messages archived, pages freed). Runs blocking I/O; call it from a worker thread.
+    """
+    conn = connect_db(database)
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS archive', (archive_database,))
+    archived = 0
+    try:
+        while True:
+            cursor.execute('''
+                SELECT message_id FROM messages
+                WHERE status IN ('replied', 'ignored') AND timestamp < datetime('now', ?)
+                ORDER BY timestamp
+                LIMIT ?
+            ''', (f'-{retention_days} days', batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                break
+
+            placeholders = ','.join('?' * len(ids))
+            # Each database commits atomically on its own; a batch cut off between the two is
+            # copied again next run, and OR IGNORE makes that a no-op
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO archive.messages
+                    (message_id, user_id, message, timestamp, status, admin_reply, replied_by)
+                SELECT message_id, user_id, message, timestamp, status, admin_reply, replied_by
+                FROM main.messages WHERE message_id IN ({placeholders})
+            ''', ids)
+            cursor.execute(f'DELETE FROM main.messages WHERE message_id IN ({placeholders})', ids)
+            conn.commit()
+            archived += len(ids)
+            if len(ids) < batch_size:
+                break
+            time.sleep(MESSAGE_ARCHIVE_PAUSE)
+
+        cursor.execute('PRAGMA main.auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            # incremental_vacuum does nothing until `python app.py vacuum` has run
+            return archived, 0
+        cursor.execute('PRAGMA main.freelist_count')
+        free_pages = remaining = cursor.fetchone()[0]
+        while remaining:
+            # executescript steps the pragma to completion; execute() would free a single page
+            conn.executescript(f'PRAGMA main.incremental_vacuum({MESSAGE_VACUUM_PAGES})')
+            cursor.execute('PRAGMA main.freelist_count')
+            remaining = cursor.fetchone()[0]
+            time.sleep(MESSAGE_ARCHIVE_PAUSE)
+        return archived, free_pages
+    finally:
+        conn.close()
 
+async def archive_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    async with lifecycle.work('archive'):
+        try:
+            archived, freed_pages = await asyncio.to_thread(archive_messages)
+        except sqlite3.Error as e:
+            logger.error(f"Message archival failed: {e}")
+            return
+    if archived:
+        logger.info(f"Archived {archived} handled messages, freed {freed_pages} pages")
 
 async def view_message(query, message_id: int):
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     cursor.execute('''
-        SELECT user_id, message, timestamp 
+        SELECT user_id, message, timestamp, status, claimed_by,
+               claim_expires_at > datetime('now')
         FROM messages 
         WHERE message_id = ?
     ''', (message_id,))
@@ -1476,12 +3878,16 @@ async def view_message(query, message_id: int):
         )
         return
     
-    user_id, msg_text, timestamp = message
+    user_id, msg_text, timestamp, status, claimed_by, lease_live = message
+    claimed_by_other = claimed_by not in (None, query.from_user.id) and lease_live
+    
+    keyboard = []
+    if status == 'pending' and not claimed_by_other:
+        keyboard.append([InlineKeyboardButton("✍️ Reply", callback_data=f'reply_message_{message_id}')])
+        keyboard.append([InlineKeyboardButton("❌ Ignore", callback_data=f'ignore_message_{message_id}')])
     
     # Create mute duration options
-    keyboard = [
-        [InlineKeyboardButton("✍️ Reply", callback_data=f'reply_message_{message_id}')],
-        [InlineKeyboardButton("❌ Ignore", callback_data=f'ignore_message_{message_id}')],
+    keyboard += [
         [InlineKeyboardButton("🔇 Mute 1 Day", callback_data=f'mute_user_{user_id}_1d')],
         [InlineKeyboardButton("🔇 Mute 1 Week", callback_data=f'mute_user_{user_id}_1w')],
         [InlineKeyboardButton("🔇 Mute 2 Weeks", callback_data=f'mute_user_{user_id}_2w')],
@@ -1490,9 +3896,14 @@ async def view_message(query, message_id: int):
         [InlineKeyboardButton("🔙 Back", callback_data='admin_messages_0')]
     ]
     
+    status_line = f"Status: {status}"
+    if claimed_by_other:
+        status_line += f" (🔒 claimed by admin {claimed_by})"
+    
     await query.edit_message_text(
         f"Message from User {user_id}\n"
-        f"Sent at: {timestamp}\n\n"
+        f"Sent at: {timestamp}\n"
+        f"{status_line}\n\n"
         f"Message:\n{msg_text}",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1511,16 +3922,18 @@ async def handle_user_mute(query, user_id: int, duration: str, context: ContextT
     elif duration == 'forever':
         mute_until = datetime.max
     
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     cursor.execute('''
-        INSERT OR REPLACE INTO muted_users (user_id, muted_until, muted_by)
+        INSERT INTO muted_users (user_id, muted_until, muted_by)
         VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET muted_until = excluded.muted_until, muted_by = excluded.muted_by
     ''', (user_id, mute_until.isoformat(), query.from_user.id))
     
     conn.commit()
     conn.close()
+    touch_tables('muted_users')
     
     # Notify user about mute
     try:
@@ -1539,12 +3952,11 @@ async def handle_user_mute(query, user_id: int, duration: str, context: ContextT
     )
 
 # Show muted users
-async def show_muted_users(query, page: int):
-    conn = sqlite3.connect('user_database.db')
+async def render_muted_users(page: int):
+    conn = connect_db()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT COUNT(*) FROM muted_users')
-    total_users = cursor.fetchone()[0]
+    total_users = read_counter(cursor, 'muted_users')
     total_pages = math.ceil(total_users / 5)
     
     cursor.execute('''
@@ -1553,6 +3965,7 @@ async def show_muted_users(query, page: int):
         LIMIT 5 OFFSET ?
     ''', (page * 5,))
     muted_users = cursor.fetchall()
+    conn.close()
     
     keyboard = []
     for user_id, muted_until, muted_by in muted_users:
@@ -1583,21 +3996,20 @@ async def show_muted_users(query, page: int):
         message_text += f"Muted until: {muted_until_dt.strftime('%Y-%m-%d %H:%M:%S')}\n"
         message_text += f"Muted by: {muted_by}\n\n"
     
-    await query.edit_message_text(
-        message_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    
-    conn.close()
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def show_muted_users(query, page: int):
+    await show_screen(query, 'muted', page, lambda: render_muted_users(page))
 
 # Handle user unmuting
 async def handle_user_unmute(query, user_id: int):
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM muted_users WHERE user_id = ?', (user_id,))
     conn.commit()
     conn.close()
+    touch_tables('muted_users')
     
     await query.edit_message_text(
         f"User {user_id} has been unmuted.",
@@ -1620,7 +4032,7 @@ async def manage_banned_words(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     word = context.args[0].lower()
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     if command == '/addword':
@@ -1638,6 +4050,15 @@ async def manage_banned_words(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def handle_message_reply(query, message_id: int, context: ContextTypes.DEFAULT_TYPE):
+    # Take (or renew) the lease so nobody else answers while the reply is typed
+    if not claim_message(message_id, query.from_user.id):
+        await query.edit_message_text(
+            "This message is already handled or claimed by another admin.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Back", callback_data='admin_messages_0')
+            ]])
+        )
+        return
     context.user_data['awaiting_reply'] = message_id
     await query.edit_message_text(
         "Please type your reply message.",
@@ -1647,19 +4068,22 @@ async def handle_message_reply(query, message_id: int, context: ContextTypes.DEF
     )
 
 # New function to save admin reply and notify user
-async def save_admin_reply(message_id: int, reply_text: str, admin_id: int, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect('user_database.db')
+async def save_admin_reply(message_id: int, reply_text: str, admin_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    conn = connect_db()
     cursor = conn.cursor()
     
-    # Get user_id and update message status
+    # Get user_id and update message status, releasing the claim; fails if another admin took it over
     cursor.execute('''
         UPDATE messages 
         SET status = 'replied', 
             admin_reply = ?,
-            replied_by = ?
-        WHERE message_id = ?
+            replied_by = ?,
+            claimed_by = NULL,
+            claim_expires_at = NULL
+        WHERE message_id = ? AND status = 'pending'
+          AND (claimed_by IS NULL OR claimed_by = ? OR claim_expires_at <= datetime('now'))
         RETURNING user_id
-    ''', (reply_text, admin_id, message_id))
+    ''', (reply_text, admin_id, message_id, admin_id))
     
     result = cursor.fetchone()
     user_id = result[0] if result else None
@@ -1675,28 +4099,439 @@ async def save_admin_reply(message_id: int, reply_text: str, admin_id: int, cont
             )
         except:
             pass
+    return user_id is not None
 
 async def handle_ignored_message(query, message_id: int):
-    conn = sqlite3.connect('user_database.db')
+    conn = connect_db()
     cursor = conn.cursor()
     
     cursor.execute('''
         UPDATE messages 
-        SET status = 'ignored'
-        WHERE message_id = ?
-    ''', (message_id,))
+        SET status = 'ignored', claimed_by = NULL, claim_expires_at = NULL
+        WHERE message_id = ? AND status = 'pending'
+          AND (claimed_by IS NULL OR claimed_by = ? OR claim_expires_at <= datetime('now'))
+    ''', (message_id, query.from_user.id))
+    ignored = cursor.rowcount > 0
     
     conn.commit()
     conn.close()
     
     await query.edit_message_text(
-        "Message has been marked as ignored.",
+        "Message has been marked as ignored." if ignored else "This message is already handled or claimed by another admin.",
         reply_markup=InlineKeyboardMarkup([[
             InlineKeyboardButton("🔙 Back", callback_data='admin_messages_0')
         ]])
     )
 
 
+# Online backups: the SQLite backup API copies a few pages per step, so writers
+# are only blocked for the duration of one step
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 6 * 3600))
+BACKUP_RETENTION = int(os.environ.get('BACKUP_RETENTION', 14))
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005  # seconds between steps, lets writers in
+
+class _BackupRestarted(Exception):
+    """A write from another connection sent the stepped copy back to page 0."""
+
+def _sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def create_backup(database: str = 'user_database.db', backup_dir: str = BACKUP_DIR,
+                  progress: Optional[ProgressReporter] = None) -> Dict:
+    """Snapshot database to backup_dir as <name>-<timestamp>.db.gz with a .sha256 sidecar.
+
+    Runs blocking I/O; call it from a worker thread. progress gets pages copied.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    base = os.path.splitext(os.path.basename(database))[0]
+    name = f'{base}-{stamp}'
+    suffix = 1
+    while os.path.exists(os.path.join(backup_dir, f'{name}.db.gz')):
+        suffix += 1
+        name = f'{base}-{stamp}-{suffix}'
+    snapshot_path = os.path.join(backup_dir, f'{name}.db.partial')
+    archive_path = os.path.join(backup_dir, f'{name}.db.gz')
+    started = time.monotonic()
+    pages = 0
+    last_remaining = None
+
+    def on_step(status, remaining, total):
+        nonlocal pages, last_remaining
+        if lifecycle.stopping.is_set():
+            # Give the worker thread back instead of holding up the shutdown drain
+            raise sqlite3.OperationalError('backup interrupted by shutdown')
+        if last_remaining is not None and remaining > last_remaining:
+            raise _BackupRestarted
+        pages = total
+        last_remaining = remaining
+        if progress is not None:
+            progress.update(total - remaining, total, stage='Copying pages')
+        time.sleep(BACKUP_STEP_PAUSE)
+
+    try:
+        source = connect_db(database)
+        target = connect_db(snapshot_path)
+        try:
+            try:
+                source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=on_step)
+            except _BackupRestarted:
+                # On a busy database the stepped copy would restart forever. One pass
+                # holds a single read transaction, which under WAL doesn't block writers.
+                logger.info("Database changed during the stepped backup; copying in one pass")
+                if progress is not None:
+                    progress.update(0, stage='Copying in one pass')
+                source.backup(target)
+                pages = target.execute('PRAGMA page_count').fetchone()[0]
+            if progress is not None:
+                progress.update(progress.done, stage='Checking snapshot')
+            integrity = target.execute('PRAGMA quick_check').fetchone()[0]
+        finally:
+            target.close()
+            source.close()
+        if integrity != 'ok':
+            raise sqlite3.DatabaseError(f'snapshot failed quick_check: {integrity}')
+
+        size_bytes = os.path.getsize(snapshot_path)
+        with open(snapshot_path, 'rb') as src, gzip.open(archive_path, 'wb', compresslevel=6) as dst:
+            for copied_mb, chunk in enumerate(iter(lambda: src.read(1 << 20), b''), start=1):
+                dst.write(chunk)
+                if progress is not None:
+                    progress.update(copied_mb, -(-size_bytes // (1 << 20)), stage='Compressing', unit='MB')
+        checksum = _sha256_file(archive_path)
+        with open(archive_path + '.sha256', 'w') as f:
+            f.write(f'{checksum}  {os.path.basename(archive_path)}\n')
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    return {
+        'path': archive_path,
+        'sha256': checksum,
+        'pages': pages,
+        'size_bytes': size_bytes,
+        'compressed_bytes': os.path.getsize(archive_path),
+        'duration_seconds': time.monotonic() - started,
+    }
+
+def prune_backups(database: str = 'user_database.db', backup_dir: str = BACKUP_DIR, keep: int = BACKUP_RETENTION) -> int:
+    base = os.path.splitext(os.path.basename(database))[0]
+    archives = sorted(
+        (name for name in os.listdir(backup_dir) if name.startswith(f'{base}-') and name.endswith('.db.gz')),
+        key=lambda name: os.path.getmtime(os.path.join(backup_dir, name))
+    )
+    expired = archives[:-keep] if keep > 0 else archives
+    for name in expired:
+        for path in (os.path.join(backup_dir, name), os.path.join(backup_dir, name + '.sha256')):
+            if os.path.exists(path):
+                os.remove(path)
+    return len(expired)
+
+def record_backup_run(result: Optional[Dict], error: Optional[str] = None):
+    conn = connect_db()
+    conn.execute('''
+        INSERT INTO backup_runs (status, path, sha256, pages, size_bytes, compressed_bytes, duration_seconds, error)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        'ok' if error is None else 'failed',
+        result and result['path'], result and result['sha256'], result and result['pages'],
+        result and result['size_bytes'], result and result['compressed_bytes'],
+        result and result['duration_seconds'], error
+    ))
+    conn.commit()
+    conn.close()
+
+async def run_backup(progress: Optional[ProgressReporter] = None) -> Dict:
+    async with lifecycle.work('backup'):
+        try:
+            result = await asyncio.to_thread(create_backup, progress=progress)
+            await asyncio.to_thread(prune_backups)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Backup failed: {e}")
+            record_backup_run(None, str(e))
+            raise
+    record_backup_run(result)
+    logger.info(
+        f"Backup written to {result['path']}: {result['size_bytes']} bytes "
+        f"({result['compressed_bytes']} compressed) in {result['duration_seconds']:.1f}s"
+    )
+    return result
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await run_backup()
+    except (OSError, sqlite3.Error):
+        pass  # already logged and recorded in backup_runs
+
+async def backup_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return  # Exit if not an admin
+
+    if context.args and context.args[0] == 'list':
+        conn = connect_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT started_at, status, path, size_bytes, compressed_bytes, duration_seconds, error
+            FROM backup_runs ORDER BY run_id DESC LIMIT 10
+        ''')
+        runs = cursor.fetchall()
+        conn.close()
+        if not runs:
+            await update.message.reply_text("No backups have run yet.")
+            return
+        lines = ["💾 Recent Backups\n"]
+        for started_at, status, path, size_bytes, compressed_bytes, duration, error in runs:
+            if status == 'ok':
+                lines.append(
+                    f"✅ {started_at} {os.path.basename(path)}\n"
+                    f"   {size_bytes / 1e6:.1f} MB → {compressed_bytes / 1e6:.1f} MB in {duration:.1f}s"
+                )
+            else:
+                lines.append(f"❌ {started_at} {error}")
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    async with ProgressReporter("Backing up the database", unit='pages') as progress:
+        await progress.start(update.message)
+        try:
+            result = await run_backup(progress)
+        except (OSError, sqlite3.Error) as e:
+            await progress.finish(f"❌ Backup failed: {e}")
+            return
+        await progress.finish(
+            f"✅ Backup written to {result['path']}\n"
+            f"Size: {result['size_bytes'] / 1e6:.1f} MB ({result['compressed_bytes'] / 1e6:.1f} MB compressed)\n"
+            f"Took {result['duration_seconds']:.1f}s\n"
+            f"SHA-256: {result['sha256']}"
+        )
+
+# Exports and the referral analysis run in a single worker process; see exports.py
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+_export_executor = None
+_export_progress = None
+_export_lock = asyncio.Lock()
+
+def get_export_executor():
+    global _export_executor, _export_progress
+    if _export_executor is None:
+        _export_progress = create_progress()
+        _export_executor = create_executor(_export_progress)
+    return _export_executor
+
+async def run_export(kind: str, fmt: str, progress: Optional[ProgressReporter] = None) -> Dict:
+    executor = get_export_executor()
+    path = export_path(kind, fmt)
+    # One worker and one shared progress slot: exports queue up here
+    async with _export_lock, lifecycle.work(f'export {kind}'):
+        _export_progress[0] = _export_progress[1] = 0
+        future = asyncio.get_running_loop().run_in_executor(executor, export_table, kind, fmt, path)
+        while progress is not None and not future.done():
+            progress.update(_export_progress[0], _export_progress[1] or None)
+            await asyncio.wait([future], timeout=progress.interval)
+        return await future
+
+def shutdown_export_executor():
+    global _export_executor
+    if _export_executor is not None:
+        _export_executor.shutdown(wait=False, cancel_futures=True)
+        _export_executor = None
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return  # Exit if not an admin
+
+    args = [arg.lower() for arg in context.args]
+    if not args or args[0] not in EXPORT_QUERIES or (len(args) > 1 and args[1] not in EXPORT_FORMATS):
+        await update.message.reply_text(
+            f"Usage: /export <{'|'.join(EXPORT_QUERIES)}> [{'|'.join(EXPORT_FORMATS)}]"
+        )
+        return
+    kind = args[0]
+    fmt = args[1] if len(args) > 1 else 'csv'
+
+    async with ProgressReporter(f"Exporting {kind} as {fmt}", unit='rows') as progress:
+        await progress.start(update.message)
+        try:
+            result = await run_export(kind, fmt, progress)
+        except (RuntimeError, OSError, sqlite3.Error) as e:
+            await progress.finish(f"❌ Export failed: {e}")
+            return
+
+        summary = f"{result['rows']} rows, {result['size_bytes'] / 1e6:.1f} MB, {result['duration_seconds']:.1f}s"
+        progress.update(result['rows'], result['rows'])
+        await progress.finish(f"✅ Exported {kind}: {summary}")
+    if result['size_bytes'] > TELEGRAM_UPLOAD_LIMIT:
+        await update.message.reply_text(
+            f"✅ Export written to {result['path']} ({summary}).\n"
+            "It is too large to send through Telegram; fetch it from the server."
+        )
+        return
+    with open(result['path'], 'rb') as f:
+        await update.message.reply_document(
+            document=f,
+            filename=os.path.basename(result['path']),
+            caption=f"✅ {kind} export: {summary}"
+        )
+
+# Referral graph analysis; see analyze_referrals.py
+REFERRAL_ANALYSIS_INTERVAL = int(os.environ.get('REFERRAL_ANALYSIS_INTERVAL', 24 * 3600))
+FLAGS_PER_PAGE = 5
+
+async def run_referral_analysis() -> Dict:
+    executor = get_export_executor()
+    # Shares the export worker, so it waits for a running export and vice versa
+    async with _export_lock, lifecycle.work('referral analysis'):
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(executor, analyze_referrals)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Referral analysis failed: {e}")
+            raise
+    touch_tables('referral_flags')
+    logger.info(
+        f"Referral analysis flagged {result['flagged']} of {result['users']} users "
+        f"({result['referrals']} referrals) in {result['duration_seconds']:.1f}s"
+    )
+    return result
+
+async def referral_analysis_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await run_referral_analysis()
+    except (OSError, sqlite3.Error):
+        pass  # already logged
+
+async def analyze_referrals_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await check_admin(update):
+        return  # Exit if not an admin
+
+    message = await update.message.reply_text("🔎 Analyzing the referral graph...")
+    try:
+        result = await run_referral_analysis()
+    except (OSError, sqlite3.Error) as e:
+        await message.edit_text(f"❌ Referral analysis failed: {e}")
+        return
+
+    reasons = ", ".join(
+        f"{reason}: {result['reasons'][reason]}" for reason in FLAG_WEIGHTS if reason in result['reasons']
+    )
+    await message.edit_text(
+        f"✅ Referral analysis done in {result['duration_seconds']:.1f}s\n\n"
+        f"Users: {result['users']}\n"
+        f"Referrals: {result['referrals']}\n"
+        f"Referral trees: {result['trees']} (largest {result['largest_tree']}, deepest chain {result['max_depth']})\n"
+        f"Flagged: {result['flagged']}" + (f" ({reasons})" if reasons else ""),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🚩 Review Flags", callback_data='admin_flags_0')]])
+    )
+
+async def render_referral_flags(page: int):
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*), MAX(flagged_at) FROM referral_flags')
+    total_flags, flagged_at = cursor.fetchone()
+    cursor.execute('''
+        SELECT user_id, score, reasons, details
+        FROM referral_flags
+        ORDER BY score DESC, user_id
+        LIMIT ? OFFSET ?
+    ''', (FLAGS_PER_PAGE, page * FLAGS_PER_PAGE))
+    flags = cursor.fetchall()
+    conn.close()
+    total_pages = math.ceil(total_flags / FLAGS_PER_PAGE)
+
+    if total_flags:
+        message_text = f"🚩 Referral Flags ({total_flags}, analyzed {flagged_at} UTC)\nPage {page + 1}/{total_pages}\n\n"
+    else:
+        message_text = "🚩 Referral Flags\n\nNothing is flagged. The analysis runs daily, or now with /analyzereferrals."
+    keyboard = []
+    for user_id, score, reasons, details in flags:
+        message_text += f"User {user_id}: score {score} ({reasons.replace(',', ', ')})\n{details}\n\n"
+        keyboard.append([InlineKeyboardButton(f"👤 Review {user_id}", callback_data=f'modify_user_{user_id}')])
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'admin_flags_{page-1}'))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f'admin_flags_{page+1}'))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton("🔙 Back to Admin Panel", callback_data='admin_back')])
+    return message_text, InlineKeyboardMarkup(keyboard)
+
+async def show_referral_flags(query, page: int):
+    await show_screen(query, 'flags', page, lambda: render_referral_flags(page))
+
+def restore_backup(archive_path: str, database: str = 'user_database.db'):
+    """Replace database with a verified snapshot. The bot must be stopped."""
+    checksum_path = archive_path + '.sha256'
+    if not os.path.exists(checksum_path):
+        raise SystemExit(f"Missing checksum file {checksum_path}")
+    with open(checksum_path) as f:
+        expected = f.read().split()[0]
+    if _sha256_file(archive_path) != expected:
+        raise SystemExit(f"Checksum mismatch for {archive_path}; refusing to restore")
+
+    restored_path = database + '.restoring'
+    with gzip.open(archive_path, 'rb') as src, open(restored_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    conn = connect_db(restored_path)
+    integrity = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    conn.close()
+    if integrity != 'ok':
+        os.remove(restored_path)
+        raise SystemExit(f"Snapshot failed integrity_check: {integrity}")
+
+    # Keep the current database (and its WAL) next to it rather than deleting it
+    aside = f"{database}.pre-restore-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.replace(database + suffix, aside + suffix)
+    os.replace(restored_path, database)
+    print(f"Restored {database} from {archive_path}; previous database kept as {aside}")
+
+def enable_incremental_vacuum(database: str = 'user_database.db'):
+    """Switch database to incremental auto_vacuum with a full VACUUM. The bot must be stopped."""
+    conn = connect_db(database)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            print(f"{database} already uses incremental auto_vacuum")
+            return
+        size_before = os.path.getsize(database)
+        started = time.monotonic()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    print(
+        f"VACUUM of {database} took {time.monotonic() - started:.1f}s "
+        f"({size_before / 1e6:.1f} MB -> {os.path.getsize(database) / 1e6:.1f} MB); incremental auto_vacuum enabled"
+    )
+
+async def on_post_init(application: Application) -> None:
+    # Creates the repository tables on backends that init_database() doesn't manage
+    await get_repository().create_schema()
+    # Start existing ads
+    frequency_cap.load()
+    ad_scheduler.start(application.bot)
+    lifecycle.install_signal_handlers(application)
+    lifecycle.spawn('loop_watchdog', loop_watchdog.run())
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+
+async def on_post_stop(application: Application) -> None:
+    # Updates are no longer fetched and handlers have finished; drain background work
+    await lifecycle.drain()
+    await frequency_cap.save()
+    shutdown_export_executor()
+
+async def on_post_shutdown(application: Application) -> None:
+    # Persistence was flushed by Application.shutdown(); release database resources
+    await close_repository()
+
 def main():
     # Initialize database
     init_database()
@@ -1707,7 +4542,9 @@ def main():
         states={
             WAITING_FOR_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wallet)]
         },
-        fallbacks=[CommandHandler("cancel", cancel_settings)]
+        fallbacks=[CommandHandler("cancel", cancel_settings)],
+        name="settings",
+        persistent=True
     )
     admin_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(start_add_admin, pattern='^add_admin$')],
@@ -1720,11 +4557,37 @@ def main():
             CommandHandler('cancel', cancel_admin_add),
             MessageHandler(filters.ALL, lambda u, c: WAITING_FOR_ADMIN_ID)
         ],
-        allow_reentry=True
+        allow_reentry=True,
+        name="add_admin",
+        persistent=True
     )
 
-    # Replace 'YOUR_BOT_TOKEN' with your actual bot token
-    application = Application.builder().token('8091822623:AAGC5kB9IMlYmslBwBLU-82gLjUxBtQuNWM').build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(TimedRequest())
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence())
+        .post_init(on_post_init)
+        .post_stop(on_post_stop)
+        .post_shutdown(on_post_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = builder.build()
+    
+    # Flood control runs first and drops over-budget updates
+    flood_control.refresh_admins()
+    application.add_handler(TypeHandler(Update, flood_guard), group=-1)
+    application.job_queue.run_repeating(flood_sweep_job, interval=FLOOD_SWEEP_INTERVAL)
+    application.job_queue.run_repeating(frequency_cap_job, interval=AD_FREQUENCY_PERSIST_INTERVAL)
+    application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=BACKUP_INTERVAL)
+    application.job_queue.run_repeating(archive_job, interval=MESSAGE_ARCHIVE_INTERVAL)
+    application.job_queue.run_repeating(change_feed_job, interval=CHANGE_FEED_POLL_INTERVAL)
+    application.job_queue.run_repeating(prune_change_log_job, interval=CHANGE_LOG_PRUNE_INTERVAL)
+    application.job_queue.run_repeating(
+        referral_analysis_job, interval=REFERRAL_ANALYSIS_INTERVAL, first=REFERRAL_ANALYSIS_INTERVAL
+    )
     
     # Register handlers in specific order
     application.add_handler(CommandHandler("start", start))
@@ -1733,12 +4596,23 @@ def main():
     application.add_handler(CommandHandler("about", about))
     application.add_handler(CommandHandler("withdraw", withdraw))
     application.add_handler(CommandHandler("referral", referral_link))
+    application.add_handler(CommandHandler("leaderboard", leaderboard))
+    application.add_handler(CommandHandler("updatestats", update_stats))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("admin", admin_panel))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CommandHandler("adminadd", adminadd))
     application.add_handler(CommandHandler("adminads", admin_ads))
+    application.add_handler(CommandHandler("adschedule", ad_schedule))
+    application.add_handler(CommandHandler("backup", backup_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("analyzereferrals", analyze_referrals_command))
     application.add_handler(CommandHandler("messageadmin", message_admin))
     application.add_handler(CommandHandler("addword", manage_banned_words))
     application.add_handler(CommandHandler("removeword", manage_banned_words))
+    application.add_handler(CommandHandler("searchmessages", search_messages_command))
+    application.add_handler(CommandHandler("searcharchive", search_archive_command))
+    application.add_handler(CommandHandler("segment", manage_segments))
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
         handle_admin_message
@@ -1774,11 +4648,6 @@ def main():
         handle_ad_creation
     ))
     
-    # Start existing ads
-    application.job_queue.run_once(
-        lambda context: asyncio.create_task(start_existing_ads(application)),
-        when=0
-    )
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_id_input))
         # Add command handlers first
     application.add_handler(CommandHandler("start", start))
@@ -1791,13 +4660,8 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_message))
 
     # Run the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
-
-if __name__ == '__main__':
-    main()
-
-
-
+    # Lifecycle installs its own SIGINT/SIGTERM handlers so work can start draining before stop
+    application.run_polling(allowed_updates=Update.ALL_TYPES, stop_signals=None)
 
 
 import streamlit as st
@@ -1824,13 +4688,51 @@ def fetch_logs():
 def clear_logs():
     open(LOG_FILE, "w").close()
 
-# Function to fetch users from database
-def fetch_users():
+DASHBOARD_PAGE_SIZE = 500
+
+# Function to get the newest change to a table (from any process); cached reads take
+# it as an argument, so a write anywhere gives them a new cache key. change_versions
+# keeps it after change_log is pruned, so a key never goes back to an older value.
+def latest_change(table):
+    conn = sqlite3.connect(DB_FILE)
+    row = conn.execute("SELECT change_id FROM change_versions WHERE table_name = ?", (table,)).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+# Function to fetch one page of users from database
+@st.cache_data(max_entries=64)
+def fetch_users(page=0, page_size=DASHBOARD_PAGE_SIZE, version=None):
     conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM users", conn)
+    df = pd.read_sql_query(
+        "SELECT * FROM users ORDER BY user_id LIMIT ? OFFSET ?",
+        conn,
+        params=(page_size, page * page_size)
+    )
     conn.close()
     return df
 
+@st.cache_data(max_entries=4)
+def count_users(version=None):
+    conn = sqlite3.connect(DB_FILE)
+    row = conn.execute("SELECT value FROM counters WHERE name = 'users'").fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+# Function to fetch the trigger-maintained totals and the last days of rollups
+def fetch_stats(days=30):
+    conn = sqlite3.connect(DB_FILE)
+    counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    daily = pd.read_sql_query(
+        "SELECT * FROM daily_stats ORDER BY day DESC LIMIT ?", conn, params=(days,)
+    )
+    conn.close()
+    return counters, daily.sort_values("day").set_index("day")
+
+# Function to export a table in a worker process, streaming rows to disk
+def export_to_file(kind, fmt):
+    with create_executor() as executor:
+        return executor.submit(export_table, kind, fmt, export_path(kind, fmt), DB_FILE).result()
+
 # Function to update user points
 def update_user_points(user_id, new_points):
     conn = sqlite3.connect(DB_FILE)
@@ -1839,50 +4741,122 @@ def update_user_points(user_id, new_points):
     conn.commit()
     conn.close()
 
-# Function to delete a user
-def delete_user(user_id):
+# Function to delete a user (named apart from the bot's delete_user, which it would shadow)
+def delete_user_record(user_id):
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
+    cursor.execute("SELECT referred_by FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    cursor.execute("UPDATE users SET referred_by = NULL WHERE referred_by = ?", (user_id,))
+    cursor.execute("DELETE FROM referral_counts WHERE referrer_id = ?", (user_id,))
+    if row and row[0]:
+        cursor.execute(
+            "UPDATE referral_counts SET referral_count = referral_count - 1 "
+            "WHERE referrer_id = ? AND referral_count > 0",
+            (row[0],)
+        )
     cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
     conn.commit()
     conn.close()
 
-# Streamlit UI
-st.title("Admin Panel - Logs & Database")
+# Streamlit UI; only drawn under `streamlit run app.py`, so importing app (the export
+# worker, generate_data, benchmarks) doesn't run it
+def run_dashboard():
+    st.title("Admin Panel - Logs & Database")
 
-# Sidebar Navigation
-menu = st.sidebar.radio("Navigation", ["📜 Logs", "👥 User Database"])
+    # Sidebar Navigation
+    menu = st.sidebar.radio("Navigation", ["📜 Logs", "👥 User Database", "📊 Stats", "📤 Export"])
 
-# Log Viewer
-if menu == "📜 Logs":
-    st.subheader("📜 Log Viewer")
+    # Log Viewer
+    if menu == "📜 Logs":
+        st.subheader("📜 Log Viewer")
 
-    logs = fetch_logs()
-    st.text_area("Logs:", "\n".join(logs), height=300)
+        logs = fetch_logs()
+        st.text_area("Logs:", "\n".join(logs), height=300)
 
-    if st.button("Clear Logs"):
-        clear_logs()
-        st.success("Logs cleared!")
+        if st.button("Clear Logs"):
+            clear_logs()
+            st.success("Logs cleared!")
 
-# User Database Management
-elif menu == "👥 User Database":
-    st.subheader("👥 User Management")
+    # User Database Management
+    elif menu == "👥 User Database":
+        st.subheader("👥 User Management")
 
-    users = fetch_users()
+        version = latest_change('users')
+        total_users = count_users(version)
+        total_pages = max(1, math.ceil(total_users / DASHBOARD_PAGE_SIZE))
+        page = st.number_input(f"Page (of {total_pages}):", min_value=1, max_value=total_pages, step=1) - 1
+        users = fetch_users(page, version=version)
 
-    if users.empty:
-        st.warning("No users found in the database.")
-    else:
-        st.dataframe(users)
+        if users.empty:
+            st.warning("No users found in the database.")
+        else:
+            st.caption(f"{total_users} users; showing {len(users)} from row {page * DASHBOARD_PAGE_SIZE + 1}")
+            st.dataframe(users)
+
+            user_id = st.number_input("Enter User ID to Modify:", min_value=1, step=1)
+            new_points = st.number_input("Enter New Points:", min_value=0, step=500)
+
+            if st.button("Update Points"):
+                update_user_points(user_id, new_points)
+                st.success(f"Updated User {user_id}'s points to {new_points}")
+
+            if st.button("Delete User"):
+                delete_user_record(user_id)
+                st.warning(f"Deleted User {user_id}")
+
+    # Stats
+    elif menu == "📊 Stats":
+        st.subheader("📊 Stats")
+
+        counters, daily = fetch_stats()
+        users_total = counters.get('users', 0)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Users", users_total)
+        col2.metric("Referred", counters.get('users_referred', 0))
+        col3.metric("Points in circulation", counters.get('points_total', 0))
+        col1.metric("Withdrawals", counters.get('withdrawals', 0))
+        col2.metric("Points withdrawn", counters.get('points_withdrawn', 0))
+        col3.metric("Pending messages", counters.get('messages_pending', 0))
+
+        if daily.empty:
+            st.info("No daily activity recorded yet.")
+        else:
+            st.caption("Last 30 days")
+            st.line_chart(daily[["new_users", "referrals", "messages"]])
+            st.bar_chart(daily[["withdrawals"]])
+            st.dataframe(daily)
 
-        user_id = st.number_input("Enter User ID to Modify:", min_value=1, step=1)
-        new_points = st.number_input("Enter New Points:", min_value=0, step=500)
+    # Export
+    elif menu == "📤 Export":
+        st.subheader("📤 Export")
 
-        if st.button("Update Points"):
-            update_user_points(user_id, new_points)
-            st.success(f"Updated User {user_id}'s points to {new_points}")
+        kind = st.selectbox("Data:", list(EXPORT_QUERIES))
+        fmt = st.selectbox("Format:", list(EXPORT_FORMATS))
+
+        if st.button("Export"):
+            try:
+                with st.spinner(f"Exporting {kind}..."):
+                    result = export_to_file(kind, fmt)
+            except (RuntimeError, OSError, sqlite3.Error) as e:
+                st.error(f"Export failed: {e}")
+            else:
+                st.success(
+                    f"Exported {result['rows']} rows ({result['size_bytes'] / 1e6:.1f} MB) "
+                    f"in {result['duration_seconds']:.1f}s to {result['path']}"
+                )
+                with open(result['path'], "rb") as f:
+                    st.download_button("Download", f, file_name=os.path.basename(result['path']))
 
-        if st.button("Delete User"):
-            delete_user(user_id)
-            st.warning(f"Deleted User {user_id}")
 
+if __name__ == '__main__':
+    if st.runtime.exists():
+        run_dashboard()
+    elif len(sys.argv) == 3 and sys.argv[1] == 'restore':
+        # python app.py restore backups/user_database-YYYYmmdd-HHMMSS.db.gz (with the bot stopped)
+        restore_backup(sys.argv[2])
+    elif len(sys.argv) == 2 and sys.argv[1] == 'vacuum':
+        # python app.py vacuum (with the bot stopped; rewrites the whole database once)
+        enable_incremental_vacuum()
+    else:
+        main()
@@ -0,0 +1,348 @@
+"""Handler-level benchmarks for app.py at realistic database sizes.
+
+Real handlers are called in-process with fake Update/Context objects and a
+stubbed bot that records calls instead of talking to Telegram. Each handler is
+timed over several iterations, then run once more under tracemalloc for its
+peak allocation. Results are compared with a stored baseline and the run fails
+on latency or memory regressions.
+
+Usage:
+    python benchmarks.py --sizes 1000,100000,1000000
+    python benchmarks.py --update-baseline          # record the current numbers
+    python benchmarks.py --cache-dir .bench-cache   # reuse generated databases
+    python benchmarks.py --ci                       # also fail without a baseline to compare against
+
+benchmarks_baseline.json holds the 1k and 100k sizes, recorded with the default
+--seed and --now so every run generates the same databases. CI compares against
+it with
+
+    python benchmarks.py --ci --sizes 1000,100000 --cache-dir .bench-cache
+
+Latencies depend on the machine: after a runner change, or an intended
+slowdown, re-record with --update-baseline --sizes 1000,100000 and commit the
+file with the change that explains it.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from generate_data import FIRST_USER_ID, generate
+from loadtest import percentile
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks_baseline.json')
+# Generated history ends here, so a seed gives the same database on every run
+BENCHMARK_NOW = 1_767_225_600  # 2026-01-01 00:00 UTC
+ADMIN_ID = 5279018187
+NEW_USER_BASE_ID = 9_000_000_000
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text=''):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = None
+        self.message_id = 1
+
+    async def reply_text(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text, **kwargs)
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        self.bot.calls['send_photo'] += 1
+        return FakeMessage(self.bot, self.chat_id, caption or '')
+
+    async def reply_document(self, document, **kwargs):
+        self.bot.calls['send_document'] += 1
+        return FakeMessage(self.bot, self.chat_id)
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.calls['edit_message_text'] += 1
+        return self
+
+    async def delete(self):
+        self.bot.calls['delete_message'] += 1
+        return True
+
+
+class FakeBot:
+    """Records Bot API calls instead of sending them."""
+
+    def __init__(self):
+        self.calls = dict.fromkeys(
+            ('send_message', 'send_photo', 'send_document', 'edit_message_text', 'delete_message', 'get_chat'), 0
+        )
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls['send_message'] += 1
+        return FakeMessage(self, chat_id, text)
+
+    async def get_chat(self, chat_id):
+        self.calls['get_chat'] += 1
+        return SimpleNamespace(id=chat_id, username=f'user{chat_id}')
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, user, data):
+        self.bot = bot
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(bot, user.id)
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        self.bot.calls['edit_message_text'] += 1
+        return self.message
+
+
+def make_user(user_id):
+    return SimpleNamespace(id=user_id, first_name='Bench', last_name=None, username=f'user{user_id}')
+
+
+def make_update(bot, user_id, text='', callback_data=None):
+    user = make_user(user_id)
+    message = None if callback_data else FakeMessage(bot, user_id, text)
+    query = FakeCallbackQuery(bot, user, callback_data) if callback_data else None
+    return SimpleNamespace(
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id),
+        message=message,
+        callback_query=query,
+    )
+
+
+def make_context(bot, args=None, user_data=None):
+    return SimpleNamespace(bot=bot, args=args or [], user_data={} if user_data is None else user_data)
+
+
+class Benchmarks:
+    """One prepared call per handler; each returns a coroutine to time."""
+
+    def __init__(self, app, n_users, rng):
+        self.app = app
+        self.n_users = n_users
+        self.rng = rng
+        self.bot = FakeBot()
+        self.next_new_user = NEW_USER_BASE_ID
+
+    def existing_user(self):
+        return FIRST_USER_ID + self.rng.randrange(self.n_users)
+
+    def new_user(self):
+        self.next_new_user += 1
+        return self.next_new_user
+
+    def random_page(self):
+        pages = max(1, -(-self.n_users // self.app.USERS_PER_PAGE))
+        return self.rng.randrange(pages)
+
+    def start_new(self):
+        update = make_update(self.bot, self.new_user(), '/start')
+        return self.app.start(update, make_context(self.bot))
+
+    def start_referral(self):
+        code = self.app.generate_referral_code(self.existing_user())
+        update = make_update(self.bot, self.new_user(), f'/start {code}')
+        return self.app.start(update, make_context(self.bot, [code]))
+
+    def balance(self):
+        update = make_update(self.bot, self.existing_user(), '/balance')
+        return self.app.balance(update, make_context(self.bot))
+
+    def withdraw(self):
+        update = make_update(self.bot, self.existing_user(), '/withdraw')
+        return self.app.withdraw(update, make_context(self.bot))
+
+    def show_users_list(self):
+        update = make_update(self.bot, ADMIN_ID, callback_data='admin_users_0')
+        return self.app.show_users_list(update.callback_query, self.random_page())
+
+    def show_referrals_list(self):
+        update = make_update(self.bot, ADMIN_ID, callback_data='admin_referrals_0')
+        return self.app.show_referrals_list(update.callback_query, self.random_page())
+
+    def handle_admin_message(self):
+        update = make_update(self.bot, self.existing_user(), 'Hello, when is the next payout?')
+        context = make_context(self.bot, user_data={'awaiting_admin_message': True})
+        return self.app.handle_admin_message(update, context)
+
+    def send_advertisement(self):
+        # A fresh frequency cap so every recipient is actually sent to
+        self.app.frequency_cap = self.app.FrequencyCap(cap=1 << 30)
+        ad = self.app.Advertisement('bench', '<b>Benchmark</b> ad', [{'text': 'Open', 'url': 'https://example.com'}], 3600)
+        return self.app.send_advertisement(self.bot, ad)
+
+
+# name -> iterations; broadcasts go to every user, so they run once
+BENCHMARKS = {
+    'start_new': 30,
+    'start_referral': 30,
+    'balance': 30,
+    'withdraw': 30,
+    'show_users_list': 30,
+    'show_referrals_list': 30,
+    'handle_admin_message': 30,
+    'send_advertisement': 1,
+}
+
+
+async def run_benchmark(benchmarks, name, iterations):
+    make_call = getattr(benchmarks, name)
+    timings = []
+    for _ in range(iterations):
+        coroutine = make_call()
+        started = time.perf_counter()
+        await coroutine
+        timings.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    await make_call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(timings, 95) * 1000, 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def prepare_database(n_users, seed, now, cache_dir):
+    """Path to a generated database for n_users, reusing cache_dir when given."""
+    if cache_dir:
+        cached = os.path.join(cache_dir, f'bench_{n_users}_{seed}_{now}.db')
+        if not os.path.exists(cached):
+            if os.path.exists(cached + '.partial'):
+                os.remove(cached + '.partial')
+            generate(cached + '.partial', n_users, seed=seed, now=now)
+            os.replace(cached + '.partial', cached)
+        return cached
+    return None
+
+
+async def run_size(app, storage, n_users, args):
+    workdir = tempfile.mkdtemp(prefix=f'bench_{n_users}_')
+    db_path = os.path.join(workdir, 'user_database.db')
+    started = time.perf_counter()
+    cached = prepare_database(n_users, args.seed, args.now, args.cache_dir)
+    if cached:
+        shutil.copyfile(cached, db_path)
+    else:
+        generate(db_path, n_users, seed=args.seed, now=args.now)
+
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # app.py uses the relative user_database.db path throughout
+        app.init_database()
+        storage.configure('sqlite+aiosqlite:///user_database.db')
+        build_seconds = time.perf_counter() - started
+
+        benchmarks = Benchmarks(app, n_users, random.Random(args.seed))
+        results = {}
+        for name, iterations in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = await run_benchmark(benchmarks, name, args.iterations or iterations)
+            print(f"  {name:<22} p50 {results[name]['p50_ms']:>9.2f} ms  "
+                  f"p95 {results[name]['p95_ms']:>9.2f} ms  peak {results[name]['peak_kb']:>9.1f} KB")
+        await storage.close_repository()
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"  (database built in {build_seconds:.1f}s)")
+    return results
+
+
+def find_regressions(results, baseline, latency_tolerance, memory_tolerance, require_baseline=False):
+    regressions = []
+    for size, handlers in results.items():
+        for name, current in handlers.items():
+            base = baseline.get(size, {}).get(name)
+            if not base:
+                if require_baseline:
+                    regressions.append(f"{size} users / {name}: no baseline recorded")
+                continue
+            # Relative tolerance plus a small absolute floor so sub-millisecond noise doesn't fail
+            latency_limit = base['p50_ms'] * (1 + latency_tolerance) + 1.0
+            if current['p50_ms'] > latency_limit:
+                regressions.append(f"{size} users / {name}: p50 {current['p50_ms']} ms > {latency_limit:.2f} ms")
+            memory_limit = base['peak_kb'] * (1 + memory_tolerance) + 64
+            if current['peak_kb'] > memory_limit:
+                regressions.append(f"{size} users / {name}: peak {current['peak_kb']} KB > {memory_limit:.1f} KB")
+    return regressions
+
+
+async def main(args):
+    # Import after parsing so --help works without the bot's dependencies
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    import storage
+
+    app.AD_SEND_DELAY = 0  # the stubbed bot has no rate limit to respect
+
+    results = {}
+    for n_users in args.sizes:
+        print(f"{n_users} users")
+        results[str(n_users)] = await run_size(app, storage, n_users, args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for size, handlers in results.items():
+            baseline.setdefault(size, {}).update(handlers)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+        # A CI run that compares against nothing must not pass
+        return 1 if args.ci else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(
+        results, baseline, args.latency_tolerance, args.memory_tolerance, require_baseline=args.ci
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print("No regressions against baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark app.py handlers against generated databases.')
+    parser.add_argument('--sizes', type=lambda v: [int(x) for x in v.split(',')], default=[1000, 100000, 1000000])
+    parser.add_argument('--only', type=lambda v: v.split(','), help='comma-separated benchmark names')
+    parser.add_argument('--iterations', type=int, help='override iterations for every benchmark')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--now', type=int, default=BENCHMARK_NOW, help='unix time the generated history ends at')
+    parser.add_argument('--cache-dir', help='keep generated databases here and reuse them')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='record results as the new baseline')
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help='allowed relative p50 increase')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='allowed relative peak memory increase')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--ci', action='store_true', default=bool(os.environ.get('CI')),
+                        help='fail when the baseline is missing or lacks a benchmark (default when CI is set)')
+    sys.exit(asyncio.run(main(parser.parse_args())))
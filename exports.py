@@ -0,0 +1,158 @@
+"""Chunked exports of users, referrals and messages to gzipped CSV or Parquet.
+
+Exports run in a worker process (see create_executor) so the bot's event loop
+and GIL stay free, and rows are streamed with fetchmany so a table is never
+held in memory at once. Parquet needs the optional pyarrow package.
+"""
+import csv
+import gzip
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_CHUNK_ROWS = 10000
+
+# kind -> (query, [(column, parquet type)])
+EXPORT_QUERIES = {
+    'users': (
+        'SELECT user_id, points, referral_code, referred_by, wallet_address, joined_at '
+        'FROM users ORDER BY user_id',
+        [('user_id', 'int64'), ('points', 'int64'), ('referral_code', 'string'),
+         ('referred_by', 'int64'), ('wallet_address', 'string'), ('joined_at', 'string')],
+    ),
+    'referrals': (
+        'SELECT referred_by, user_id, joined_at FROM users '
+        'WHERE referred_by IS NOT NULL ORDER BY referred_by, user_id',
+        [('referrer_id', 'int64'), ('referred_user_id', 'int64'), ('joined_at', 'string')],
+    ),
+    'messages': (
+        'SELECT message_id, user_id, message, timestamp, status, admin_reply, replied_by '
+        'FROM messages ORDER BY message_id',
+        [('message_id', 'int64'), ('user_id', 'int64'), ('message', 'string'), ('timestamp', 'string'),
+         ('status', 'string'), ('admin_reply', 'string'), ('replied_by', 'int64')],
+    ),
+}
+EXPORT_FORMATS = ('csv', 'parquet')
+
+# Shared [rows written, total rows] for the running export; set in the worker by
+# create_executor so the bot can show progress
+_progress = None
+
+
+def export_path(kind: str, fmt: str, export_dir: str = EXPORT_DIR) -> str:
+    os.makedirs(export_dir, exist_ok=True)
+    extension = 'csv.gz' if fmt == 'csv' else 'parquet'
+    name = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    suffix = 1
+    while os.path.exists(os.path.join(export_dir, f'{name}.{extension}')):
+        suffix += 1
+        name = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{suffix}"
+    return os.path.join(export_dir, f'{name}.{extension}')
+
+
+def _report(rows: int, total: Optional[int] = None):
+    if _progress is not None:
+        _progress[0] = rows
+        if total is not None:
+            _progress[1] = total
+
+
+def _write_csv(cursor, columns, path: str) -> int:
+    rows = 0
+    with gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=6) as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            rows += len(chunk)
+            _report(rows)
+    return rows
+
+
+def _write_parquet(cursor, columns, path: str) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Parquet export needs pyarrow (pip install pyarrow)')
+
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+    rows = 0
+    # One row group per chunk keeps memory bounded by EXPORT_CHUNK_ROWS
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not chunk:
+                break
+            arrays = [pa.array([row[i] for row in chunk], type=field.type) for i, field in enumerate(schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows += len(chunk)
+            _report(rows)
+    return rows
+
+
+def export_table(kind: str, fmt: str, path: str, database: str = 'user_database.db') -> Dict:
+    """Stream one export to path. Returns rows written, file size and duration."""
+    if kind not in EXPORT_QUERIES:
+        raise ValueError(f"Unknown export '{kind}'. Use: {', '.join(EXPORT_QUERIES)}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'. Use: {', '.join(EXPORT_FORMATS)}")
+
+    query, columns = EXPORT_QUERIES[kind]
+    started = time.monotonic()
+    # Read-only connection; one SELECT is a consistent snapshot under WAL
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    try:
+        cursor = conn.cursor()
+        if _progress is not None:
+            cursor.execute(f'SELECT COUNT(*) FROM ({query})')
+            _report(0, cursor.fetchone()[0])
+        cursor.execute(query)
+        write = _write_csv if fmt == 'csv' else _write_parquet
+        rows = write(cursor, columns, path)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        conn.close()
+    return {
+        'path': path,
+        'rows': rows,
+        'size_bytes': os.path.getsize(path),
+        'duration_seconds': time.monotonic() - started,
+    }
+
+
+def _init_worker(progress):
+    global _progress
+    _progress = progress
+    # Exports yield the CPU to the bot process
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def create_executor(progress=None) -> ProcessPoolExecutor:
+    """Single export worker. progress, if given, is a shared array('q', 2) the worker
+    fills with [rows written, total rows] (see create_progress)."""
+    # spawn: the bot runs threads (job queue, to_thread), which fork() can deadlock on
+    return ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(progress,),
+    )
+
+
+def create_progress():
+    return multiprocessing.get_context('spawn').Array('q', 2)
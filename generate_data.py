@@ -0,0 +1,241 @@
+"""Build a realistic bot database of any size for benchmarks and load tests.
+
+Users join in id order over the last year. About a third arrive through a
+referral, and referrers are picked by preferential attachment (weight = 1 +
+referrals so far), which gives deep referred_by chains and power-law fan-out.
+Points follow from the signup and referral bonuses minus withdrawals. Some
+users have wallets (a few shared, as with multi-accounting). Messages carry
+a mix of statuses, and there are mutes and banned words. The schema comes
+from app.init_database(); rows go in with batched executemany inside one
+transaction while its indexes and triggers are set aside, and what those
+triggers maintain is then recomputed from the loaded rows.
+
+Usage:
+    python generate_data.py --users 1000000 --output /tmp/big.db --seed 1 --now 1767225600
+
+Any output path works; the bot itself only opens a file named user_database.db
+in its working directory, so copy or rename the result to run it.
+"""
+import argparse
+import base64
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+FIRST_USER_ID = 100_000
+ADMIN_ID = 5279018187
+BATCH_SIZE = 50_000
+HISTORY_DAYS = 365
+
+REFERRED_RATIO = 0.35
+WALLET_RATIO = 0.4
+SHARED_WALLET_RATIO = 0.005
+WITHDRAWN_RATIO = 0.15
+MESSAGE_RATIO = 0.05
+MUTED_RATIO = 0.002
+MESSAGE_STATUSES = (('pending', 0.2), ('replied', 0.6), ('ignored', 0.2))
+
+BANNED_WORDS = ['scam', 'spam', 'casino', 'porn', 'hack', 'free money', 'airdrop scam', 'pump']
+MESSAGE_TEMPLATES = [
+    'When is the next payout?',
+    'My withdrawal of {points} points has not arrived yet',
+    'How do I change my wallet address?',
+    'I invited {count} friends but only got credit for some of them',
+    'Is the minimum withdrawal still 6500 points?',
+    'The bot did not answer my /balance command',
+    'Can I transfer points to another account?',
+    'My referral link does not work for my friend',
+]
+ADMIN_REPLIES = [
+    'Payouts are processed every Friday.',
+    'Please set a new wallet with /settings.',
+    'Referral credit appears once your friend presses /start.',
+    'Thanks, we are looking into it.',
+]
+
+
+def _load_app():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app
+
+
+def _referral_codes(id_range):
+    import app
+    return [app.generate_referral_code(user_id) for user_id in range(*id_range)]
+
+
+def referral_codes(first_id, n_users):
+    """Codes for a contiguous id range, computed in parallel when there are spare cores."""
+    chunks = [(start, min(start + BATCH_SIZE, first_id + n_users)) for start in range(first_id, first_id + n_users, BATCH_SIZE)]
+    if (os.cpu_count() or 1) > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool() as pool:
+            return [code for chunk in pool.map(_referral_codes, chunks) for code in chunk]
+    return [code for chunk in map(_referral_codes, chunks) for code in chunk]
+
+
+def _wallet(rng):
+    # TON user-friendly form: 48 url-safe base64 characters
+    return 'EQ' + base64.urlsafe_b64encode(rng.randbytes(35)).decode()[:46]
+
+
+def build_users(n_users, rng, now):
+    """Referral tree, join times, points and wallets for users FIRST_USER_ID .. + n_users.
+
+    Times are unix seconds; SQLite formats them (UTC, like CURRENT_TIMESTAMP) on insert.
+    """
+    referred_by = [None] * n_users
+    fanout = [0] * n_users
+    # Every user is in the urn once, plus once per referral made: sampling it is
+    # preferential attachment with weight 1 + referrals
+    urn = []
+    for i in range(n_users):
+        if urn and rng.random() < REFERRED_RATIO:
+            referrer = rng.choice(urn)
+            referred_by[i] = referrer
+            fanout[referrer] += 1
+            urn.append(referrer)
+        urn.append(i)
+
+    start = now - HISTORY_DAYS * 86400
+    step = HISTORY_DAYS * 86400 / max(n_users, 1)
+    joined_at = [int(start + (i + rng.random()) * step) for i in range(n_users)]
+
+    shared_wallets = [_wallet(rng) for _ in range(max(1, int(n_users * SHARED_WALLET_RATIO / 4)))]
+    users = []
+    for i in range(n_users):
+        points = 5000 + 1500 * fanout[i]
+        if points >= 6500 and rng.random() < WITHDRAWN_RATIO:
+            points = 0
+        wallet = None
+        if rng.random() < WALLET_RATIO:
+            wallet = rng.choice(shared_wallets) if rng.random() < SHARED_WALLET_RATIO else _wallet(rng)
+        users.append((
+            FIRST_USER_ID + i,
+            points,
+            None if referred_by[i] is None else FIRST_USER_ID + referred_by[i],
+            wallet,
+            joined_at[i],
+        ))
+    return users, fanout, referred_by, joined_at
+
+
+def generate(output, n_users, seed=1, now=None):
+    """Write n_users users and their activity to output. now (unix seconds, default
+    the current time) is when the history ends; pin it along with seed to get the
+    same database on every run."""
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    now = int(time.time()) if now is None else int(now)
+    if os.path.exists(output):
+        raise ValueError(f"{output} already exists")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    app = _load_app()
+
+    users, fanout, referred_by, joined_at = build_users(n_users, rng, now)
+    codes = referral_codes(FIRST_USER_ID, n_users)
+
+    # The bot's own schema, created while the file is empty so its migrations and
+    # backfills have nothing to do
+    app.init_database(output)
+
+    conn = sqlite3.connect(output)
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')  # 256 MB: the referral_code index is filled in random order
+    # Triggers would fire and indexes grow row by row during the load: set them
+    # aside and rebuild them once the rows are in
+    deferred = conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL"
+    ).fetchall()
+    for kind, name, _ in deferred:
+        conn.execute(f'DROP {kind.upper()} {name}')
+
+    with conn:
+        for offset in range(0, n_users, BATCH_SIZE):
+            conn.executemany(
+                'INSERT INTO users (user_id, points, referral_code, referred_by, wallet_address, joined_at) '
+                "VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'))",
+                [(user_id, points, codes[offset + i], referrer, wallet, joined)
+                 for i, (user_id, points, referrer, wallet, joined) in enumerate(users[offset:offset + BATCH_SIZE])]
+            )
+
+        last_referral = {}
+        for i, referrer in enumerate(referred_by):
+            if referrer is not None:
+                last_referral[referrer] = joined_at[i]
+        conn.executemany(
+            'INSERT INTO referral_counts (referrer_id, referral_count, last_referral_at) '
+            "VALUES (?, ?, datetime(?, 'unixepoch'))",
+            ((FIRST_USER_ID + i, count, last_referral[i]) for i, count in enumerate(fanout) if count)
+        )
+
+        weights = [weight for _, weight in MESSAGE_STATUSES]
+        messages = []
+        for _ in range(int(n_users * MESSAGE_RATIO)):
+            i = rng.randrange(n_users)
+            sent_at = rng.randint(joined_at[i], now)
+            status = rng.choices([status for status, _ in MESSAGE_STATUSES], weights)[0]
+            text = rng.choice(MESSAGE_TEMPLATES).format(points=users[i][1] or 6500, count=fanout[i] + 1)
+            reply = rng.choice(ADMIN_REPLIES) if status == 'replied' else None
+            messages.append((
+                FIRST_USER_ID + i, text, sent_at, status, reply, ADMIN_ID if reply else None
+            ))
+        # Messages are inserted in time order, as the bot would have
+        messages.sort(key=lambda row: row[2])
+        for offset in range(0, len(messages), BATCH_SIZE):
+            conn.executemany(
+                'INSERT INTO messages (user_id, message, timestamp, status, admin_reply, replied_by) '
+                "VALUES (?, ?, datetime(?, 'unixepoch'), ?, ?, ?)",
+                messages[offset:offset + BATCH_SIZE]
+            )
+
+        # muted_until is local time in ISO format, as the mute buttons write it
+        muted = rng.sample(range(n_users), int(n_users * MUTED_RATIO))
+        local_now = datetime.fromtimestamp(now)
+        conn.executemany(
+            'INSERT INTO muted_users (user_id, muted_until, muted_by) VALUES (?, ?, ?)',
+            [(FIRST_USER_ID + i, (local_now + timedelta(days=rng.choice([-7, -1, 1, 7, 30]))).isoformat(), ADMIN_ID)
+             for i in muted]
+        )
+        conn.executemany(
+            "INSERT INTO banned_words (word, added_by, added_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+            [(word, ADMIN_ID, now - HISTORY_DAYS * 86400) for word in BANNED_WORDS]
+        )
+    loaded = time.perf_counter() - started
+
+    with conn:
+        for _, _, sql in deferred:
+            conn.execute(sql)
+        # What the triggers would have kept up, recomputed in one pass each: the
+        # inbox index and daily rollups here, the counters by init_database below
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        app.backfill_daily_stats(conn.cursor())
+        conn.execute('DELETE FROM counters')
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.close()
+    app.init_database(output)
+
+    return {
+        'users': n_users,
+        'referred': sum(1 for referrer in referred_by if referrer is not None),
+        'max_fanout': max(fanout, default=0),
+        'messages': len(messages),
+        'muted': len(muted),
+        'load_seconds': round(loaded, 2),
+        'total_seconds': round(time.perf_counter() - started, 2),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic bot database.')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--output', default='user_database.db')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--now', type=int, help='unix time the history ends at (default: the current time)')
+    args = parser.parse_args()
+    print(generate(args.output, args.users, seed=args.seed, now=args.now))
@@ -0,0 +1,370 @@
+"""End-to-end load test for app.py against a local fake Telegram Bot API server.
+
+The bot runs unmodified in a subprocess with BOT_API_BASE_URL pointing at an
+aiohttp server that imitates the Bot API (getUpdates long polling, send/edit
+methods, injected latency, 429 RetryAfter and 403 Forbidden errors). Synthetic
+updates are fed at a target rate and the time from delivery to the bot's first
+reply is recorded per update.
+
+Usage:
+    python loadtest.py --sizes 1000,100000 --rate 50 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+from generate_data import generate
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+FAKE_TOKEN = '123456:LOADTEST'
+ADMIN_ID = 5279018187
+NEW_USER_BASE_ID = 9_000_000_000
+
+# Methods that count as the bot answering an update
+REPLY_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'}
+# Methods eligible for error injection (those that hit a user's chat)
+INJECTABLE_METHODS = REPLY_METHODS | {'deleteMessage'}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class FakeBotAPI:
+    """Minimal stand-in for api.telegram.org serving one bot token."""
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, forbidden_ratio=0.0, retry_after=1):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.forbidden_ratio = forbidden_ratio
+        self.retry_after = retry_after
+        self.ready = asyncio.Event()
+        self._updates = deque()
+        self._updates_available = asyncio.Event()
+        self._next_message_id = 1
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.pending = defaultdict(deque)  # chat_id -> deque of (delivered_at, kind)
+        self.latencies = defaultdict(list)
+        self.method_counts = defaultdict(int)
+        self.injected = defaultdict(int)
+        self.delivered = 0
+        self.answered = 0
+
+    def enqueue(self, update, kind):
+        self._updates.append((update, kind))
+        self._updates_available.set()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route('POST', '/bot{token}/{method}', self.handle)
+        app.router.add_route('GET', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def _params(self, request):
+        if request.content_type == 'application/json':
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.method_counts[method] += 1
+
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(params)})
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in INJECTABLE_METHODS:
+            roll = random.random()
+            if roll < self.rate_limit_ratio:
+                self.injected['429'] += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                })
+            if roll < self.rate_limit_ratio + self.forbidden_ratio:
+                self.injected['403'] += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 403,
+                    'description': 'Forbidden: bot was blocked by the user',
+                })
+
+        if method in REPLY_METHODS:
+            self._record_reply(params)
+
+        return web.json_response({'ok': True, 'result': self._result_for(method, params)})
+
+    async def _get_updates(self, params):
+        self.ready.set()
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        if not self._updates:
+            self._updates_available.clear()
+            try:
+                await asyncio.wait_for(self._updates_available.wait(), timeout=max(timeout, 0.01))
+            except asyncio.TimeoutError:
+                return []
+
+        batch = []
+        now = time.perf_counter()
+        while self._updates and len(batch) < limit:
+            update, kind = self._updates.popleft()
+            self.pending[self._chat_of(update)].append((now, kind))
+            self.delivered += 1
+            batch.append(update)
+        return batch
+
+    @staticmethod
+    def _chat_of(update):
+        if 'callback_query' in update:
+            return update['callback_query']['message']['chat']['id']
+        return update['message']['chat']['id']
+
+    def _record_reply(self, params):
+        try:
+            chat_id = int(params.get('chat_id'))
+        except (TypeError, ValueError):
+            return
+        queue = self.pending.get(chat_id)
+        if queue:
+            delivered_at, kind = queue.popleft()
+            self.latencies[kind].append(time.perf_counter() - delivered_at)
+            self.answered += 1
+
+    def _result_for(self, method, params):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'LoadTestBot', 'username': 'loadtest_bot'}
+        if method == 'getChat':
+            chat_id = int(params.get('chat_id', 0))
+            return {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}'}
+        if method in ('sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText'):
+            self._next_message_id += 1
+            chat_id = int(params.get('chat_id', 0) or 0)
+            return {
+                'message_id': self._next_message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        return True
+
+
+class LoadGenerator:
+    """Builds synthetic updates for a populated database."""
+
+    def __init__(self, db_path, mix):
+        self.mix = mix
+        self._update_id = 0
+        self._new_user_id = NEW_USER_BASE_ID
+        conn = sqlite3.connect(db_path)
+        sample = conn.execute(
+            'SELECT user_id, referral_code FROM users ORDER BY RANDOM() LIMIT 5000'
+        ).fetchall()
+        conn.close()
+        self.existing_ids = [row[0] for row in sample] or [ADMIN_ID]
+        self.referral_codes = [row[1] for row in sample if row[1]]
+
+    def _next_update_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, user_id, text):
+        entities = []
+        if text.startswith('/'):
+            entities.append({'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])})
+        update_id = self._next_update_id()
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'last_name': str(user_id)},
+                'text': text,
+                'entities': entities,
+            },
+        }
+
+    def _callback(self, user_id, data):
+        update_id = self._next_update_id()
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'chat_instance': 'loadtest',
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Admin'},
+                'data': data,
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': 'Admin Panel',
+                },
+            },
+        }
+
+    def next(self):
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind == 'start':
+            self._new_user_id += 1
+            return self._message(self._new_user_id, '/start'), kind
+        if kind == 'referral' and self.referral_codes:
+            self._new_user_id += 1
+            code = random.choice(self.referral_codes)
+            return self._message(self._new_user_id, f'/start {code}'), kind
+        if kind == 'admin':
+            data = random.choice(['admin_users_0', 'admin_referrals_0', 'admin_messages_0', 'admin_back'])
+            return self._callback(ADMIN_ID, data), kind
+        return self._message(random.choice(self.existing_ids), '/balance'), 'balance'
+
+
+async def run_size(api, port, n_users, args):
+    workdir = tempfile.mkdtemp(prefix=f'loadtest_{n_users}_')
+    db_path = os.path.join(workdir, 'user_database.db')
+    started = time.perf_counter()
+    generate(db_path, n_users, seed=args.seed)
+    build_seconds = time.perf_counter() - started
+
+    api.reset_stats()
+    api.ready.clear()
+    env = dict(os.environ, BOT_TOKEN=FAKE_TOKEN, BOT_API_BASE_URL=f'http://127.0.0.1:{port}/bot')
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, APP_PATH, cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        await asyncio.wait_for(api.ready.wait(), timeout=60)
+        generator = LoadGenerator(db_path, args.mix)
+        api.reset_stats()
+
+        loop = asyncio.get_running_loop()
+        load_started = loop.time()
+        total = int(args.rate * args.duration)
+        for i in range(total):
+            delay = load_started + i / args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update, kind = generator.next()
+            api.enqueue(update, kind)
+
+        drain_deadline = loop.time() + args.drain
+        while api.answered < api.delivered and loop.time() < drain_deadline:
+            await asyncio.sleep(0.1)
+        elapsed = loop.time() - load_started
+    finally:
+        if bot.returncode is None:
+            bot.terminate()
+            try:
+                await asyncio.wait_for(bot.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    all_latencies = [value for values in api.latencies.values() for value in values]
+    return {
+        'users': n_users,
+        'build_seconds': round(build_seconds, 2),
+        'sent': total,
+        'delivered': api.delivered,
+        'answered': api.answered,
+        'throughput': round(api.answered / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(all_latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(all_latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(all_latencies, 99) * 1000, 1),
+        'by_kind': {
+            kind: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 1),
+                'p95_ms': round(percentile(values, 95) * 1000, 1),
+                'p99_ms': round(percentile(values, 99) * 1000, 1),
+            } for kind, values in api.latencies.items()
+        },
+        'injected': dict(api.injected),
+        'api_calls': dict(api.method_counts),
+    }
+
+
+def print_report(results):
+    print(f"{'users':>10} {'sent':>7} {'answered':>9} {'upd/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for result in results:
+        print(
+            f"{result['users']:>10} {result['sent']:>7} {result['answered']:>9} {result['throughput']:>8} "
+            f"{result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8}"
+        )
+        for kind, stats in sorted(result['by_kind'].items()):
+            print(f"{'':>10} └ {kind:<9} n={stats['count']:<6} p50={stats['p50_ms']} p95={stats['p95_ms']} p99={stats['p99_ms']}")
+        if result['injected']:
+            print(f"{'':>10} └ injected errors: {result['injected']}")
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+async def main(args):
+    api = FakeBotAPI(
+        latency=args.latency_ms / 1000,
+        rate_limit_ratio=args.rate_limit_ratio,
+        forbidden_ratio=args.forbidden_ratio,
+        retry_after=args.retry_after,
+    )
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+
+    results = []
+    try:
+        for size in args.sizes:
+            results.append(await run_size(api, args.port, size, args))
+    finally:
+        await runner.cleanup()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test app.py against a fake Bot API server.')
+    parser.add_argument('--sizes', type=lambda v: [int(x) for x in v.split(',')], default=[1000, 100000])
+    parser.add_argument('--rate', type=float, default=50, help='updates per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load per database size')
+    parser.add_argument('--drain', type=float, default=15, help='seconds to wait for outstanding replies')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('start=0.2,balance=0.5,referral=0.2,admin=0.1'))
+    parser.add_argument('--latency-ms', type=float, default=30, help='fake Bot API response latency')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='fraction of sends answered with 429')
+    parser.add_argument('--forbidden-ratio', type=float, default=0.0, help='fraction of sends answered with 403')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep generated databases')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,385 @@
+"""On-demand profiling for the running bot.
+
+SamplingProfiler snapshots thread stacks with sys._current_frames() from a
+background thread and folds them into flamegraph.pl / speedscope format.
+Tracer attributes SQLite and Telegram API time to the update being handled;
+the app opens its sqlite3 connections with Tracer.connection_factory, and the
+SQLAlchemy hooks are only installed while it is enabled, so it costs one
+attribute check per update, connection and API call when off. LoopWatchdog measures event loop
+lag continuously and captures what was blocking the loop when it stalls.
+"""
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import Counter, deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from telegram.request import HTTPXRequest
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 120
+
+
+class SamplingProfiler:
+    """Samples thread stacks at a fixed interval into folded stack counts.
+
+    thread_ids limits sampling to those threads (e.g. the event loop's); by
+    default every thread is sampled, including idle pool workers.
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or (self.thread_ids is not None and ident not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def folded(self) -> str:
+        """Samples in folded format, one 'frame;frame;frame count' line per stack."""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+    def top_functions(self, limit: int = 15) -> List[Tuple[str, int, int]]:
+        """(function, self samples, total samples), by self samples."""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(';')[1:]  # drop the thread name
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(frame, count, total[frame]) for frame, count in own.most_common(limit)]
+
+
+class HandlerStats:
+    __slots__ = ('updates', 'seconds', 'sql_queries', 'sql_seconds', 'api_calls', 'api_seconds')
+
+    def __init__(self):
+        self.updates = 0
+        self.seconds = 0.0
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.api_calls = 0
+        self.api_seconds = 0.0
+
+
+_current_handler: contextvars.ContextVar[Optional[HandlerStats]] = contextvars.ContextVar('current_handler', default=None)
+
+
+class Tracer:
+    """Per-handler wall, SQLite and Telegram API time while enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats: Dict[str, HandlerStats] = {}
+        self.enabled_at: Optional[float] = None
+        self._engines = []
+
+    @property
+    def connection_factory(self):
+        """sqlite3.connect(factory=...) for new connections: timed while enabled."""
+        return TracedConnection if self.enabled else sqlite3.Connection
+
+    def enable(self, engines=()):
+        """Start tracing; engines are SQLAlchemy (sync) engines whose queries are timed too."""
+        if self.enabled:
+            return
+        self.stats = {}
+        self.enabled_at = time.monotonic()
+        self._engines = list(engines)
+        for engine in self._engines:
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', _after_cursor_execute)
+        self._engines = []
+        self.enabled = False
+
+    @contextlib.contextmanager
+    def trace(self, name: str):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = HandlerStats()
+        token = _current_handler.set(stats)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.updates += 1
+            stats.seconds += time.perf_counter() - started
+            _current_handler.reset(token)
+
+    def report(self, limit: int = 15) -> List[Tuple[str, HandlerStats]]:
+        return sorted(self.stats.items(), key=lambda item: item[1].seconds, reverse=True)[:limit]
+
+
+tracer = Tracer()
+
+
+def _record_sql(seconds: float, query: bool = True):
+    stats = _current_handler.get()
+    if stats is not None:
+        stats.sql_queries += query
+        stats.sql_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_sql(time.perf_counter() - conn.info['query_started'].pop())
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            _record_sql(time.perf_counter() - started)
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            _record_sql(time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _record_sql(time.perf_counter() - started, query=False)
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            _record_sql(time.perf_counter() - started, query=False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record_sql(time.perf_counter() - started, query=False)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest that reports Bot API call time to the tracer while it is enabled."""
+
+    async def do_request(self, *args, **kwargs):
+        stats = _current_handler.get() if tracer.enabled else None
+        if stats is None:
+            return await super().do_request(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            stats.api_calls += 1
+            stats.api_seconds += time.perf_counter() - started
+
+
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD = float(os.environ.get('LOOP_LAG_THRESHOLD', 0.25))
+LOOP_LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LoopWatchdog:
+    """Measures event loop lag and captures the stack of whatever blocks the loop.
+
+    A heartbeat coroutine sleeps LOOP_LAG_INTERVAL at a time and records how late
+    it wakes up. A watcher thread notices when the heartbeat goes quiet for longer
+    than the threshold and, while the loop is still blocked, snapshots the loop
+    thread's stack and running_handler, which coroutines wrapped with labelled()
+    set whenever they run (the update processor wraps each update's handler).
+    The watcher only reads plain attributes; asyncio is not thread-safe.
+    """
+
+    def __init__(self, threshold: float = LOOP_LAG_THRESHOLD, interval: float = LOOP_LAG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.bucket_counts = [0] * (len(LOOP_LAG_BUCKETS) + 1)
+        self.samples = 0
+        self.lag_sum = 0.0
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = deque(maxlen=20)
+        self.running_handler: Optional[str] = None
+        self._loop_thread = None
+        self._last_beat = 0.0
+        self._beat = 0
+        self._captured = None
+        self._stop = threading.Event()
+        self._metrics = None
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        if prometheus_client is not None and self._metrics is None:
+            self._metrics = (
+                prometheus_client.Histogram(
+                    'bot_event_loop_lag_seconds', 'Event loop wake-up delay', buckets=LOOP_LAG_BUCKETS
+                ),
+                prometheus_client.Counter(
+                    'bot_event_loop_stalls', 'Event loop stalls over the lag threshold', ['handler']
+                ),
+            )
+        watcher = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        watcher.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._last_beat = now
+                self._beat += 1
+                self._record(max(0.0, now - expected))
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        captured_beat = None
+        while not self._stop.wait(self.interval / 2):
+            if time.monotonic() - self._last_beat - self.interval < self.threshold:
+                continue
+            if captured_beat == self._beat:
+                continue  # this stall is already captured
+            captured_beat = self._beat
+            frame = sys._current_frames().get(self._loop_thread)
+            self._captured = {
+                'handler': self.running_handler,
+                'stack': ''.join(traceback.format_stack(frame)) if frame else None,
+            }
+
+    @types.coroutine
+    def labelled(self, name: str, coroutine):
+        """Await coroutine with running_handler set to name during each of its steps."""
+        value, error = None, None
+        while True:
+            outer, self.running_handler = self.running_handler, name
+            try:
+                if error is None:
+                    yielded = coroutine.send(value)
+                else:
+                    yielded = coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.running_handler = outer
+            value, error = None, None
+            try:
+                value = yield yielded
+            except BaseException as e:
+                error = e
+
+    def _record(self, lag: float):
+        self.samples += 1
+        self.lag_sum += lag
+        self.max_lag = max(self.max_lag, lag)
+        for index, bound in enumerate(LOOP_LAG_BUCKETS):
+            if lag <= bound:
+                self.bucket_counts[index] += 1
+                break
+        else:
+            self.bucket_counts[-1] += 1
+        if self._metrics:
+            self._metrics[0].observe(lag)
+        if lag < self.threshold:
+            return
+
+        # Short stalls can end before the watcher looks; they are counted without a stack
+        captured, self._captured = self._captured or {'handler': None, 'stack': None}, None
+        stall = dict(captured, lag=lag, at=datetime.now())
+        self.stall_count += 1
+        self.stalls.append(stall)
+        if self._metrics:
+            self._metrics[1].labels(handler=stall['handler'] or 'unknown').inc()
+        logger.warning(
+            f"Event loop blocked for {lag:.3f}s (handler: {stall['handler'] or 'unknown'})"
+            + (f"\n{stall['stack']}" if stall['stack'] else "")
+        )
+
+    def percentile(self, percent: float) -> float:
+        """Upper bucket bound below which percent of lag samples fall."""
+        target = self.samples * percent / 100
+        seen = 0
+        for bound, count in zip(LOOP_LAG_BUCKETS + (float('inf'),), self.bucket_counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+def start_metrics_server(port: int) -> bool:
+    if prometheus_client is None:
+        logger.warning("METRICS_PORT is set but prometheus_client is not installed; metrics are not exported")
+        return False
+    prometheus_client.start_http_server(port)
+    return True
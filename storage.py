@@ -0,0 +1,278 @@
+"""Storage layer over SQLAlchemy async sessions.
+
+The bot runs on SQLite (user_database.db, WAL mode): only part of it goes
+through the Repository, and the admin panel, inbox, ads, archive and the
+trigger-maintained tables use sqlite3 on the same file.
+
+The Repository itself is backend-neutral. The contract tests in
+tests/test_storage.py run it against SQLite and, with asyncpg installed and
+POSTGRES_TEST_URL set, against PostgreSQL:
+
+    python -m pytest tests/test_storage.py
+    POSTGRES_TEST_URL=postgresql+asyncpg://... python -m pytest tests/test_storage.py
+"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    event,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+DATABASE_URL = 'sqlite+aiosqlite:///user_database.db'
+
+# Telegram ids need 64 bits; on SQLite keep INTEGER so the primary key stays the rowid
+UserId = BigInteger().with_variant(Integer, 'sqlite')
+
+metadata = MetaData()
+
+users = Table(
+    'users', metadata,
+    Column('user_id', UserId, primary_key=True, autoincrement=False),
+    Column('points', Integer, default=0),
+    Column('referral_code', Text, unique=True),
+    Column('referred_by', UserId),
+    Column('wallet_address', Text),
+    Column('joined_at', DateTime),
+    Index('idx_users_referred_by', 'referred_by'),
+)
+
+referral_counts = Table(
+    'referral_counts', metadata,
+    Column('referrer_id', UserId, primary_key=True, autoincrement=False),
+    Column('referral_count', Integer, nullable=False, default=0),
+    Column('last_referral_at', DateTime),
+)
+Index(
+    'idx_referral_counts_rank',
+    referral_counts.c.referral_count.desc(),
+    referral_counts.c.referrer_id,
+)
+
+withdrawals = Table(
+    'withdrawals', metadata,
+    Column('withdrawal_id', Integer, primary_key=True, autoincrement=True),
+    Column('user_id', UserId, nullable=False),
+    Column('points', Integer, nullable=False),
+    Column('wallet_address', Text),
+    Column('created_at', DateTime, server_default=func.current_timestamp()),
+)
+
+legacy_referral_codes = Table(
+    'legacy_referral_codes', metadata,
+    Column('code', Text, primary_key=True),
+    Column('user_id', UserId, nullable=False),
+)
+
+
+# Per-table write counters for this process. In-process caches (the admin screen
+# render cache) key on them, so every write path bumps the tables it changed.
+_table_versions: Dict[str, int] = {}
+
+
+def touch_tables(*tables: str):
+    for table in tables:
+        _table_versions[table] = _table_versions.get(table, 0) + 1
+
+
+def table_versions(tables: Iterable[str]) -> Tuple[int, ...]:
+    return tuple(_table_versions.get(table, 0) for table in tables)
+
+
+def create_engine_for_url(url: str) -> AsyncEngine:
+    if url.startswith('sqlite'):
+        engine = create_async_engine(url, connect_args={'timeout': 30})
+
+        @event.listens_for(engine.sync_engine, 'connect')
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL lets the bot, the dashboard and the raw sqlite3 handlers read while one writes
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.close()
+
+        return engine
+
+    # PostgreSQL (needs asyncpg); used by the contract tests
+    return create_async_engine(url, pool_size=10, max_overflow=10, pool_pre_ping=True)
+
+
+class Repository:
+    """User, referral and balance operations shared by every backend."""
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.dialect = engine.dialect.name
+        self.sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+    def _insert(self, table):
+        if self.dialect == 'postgresql':
+            return postgresql_insert(table)
+        return sqlite_insert(table)
+
+    async def create_schema(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+    async def get_user(self, user_id: int):
+        async with self.sessions() as session:
+            result = await session.execute(
+                select(
+                    users.c.user_id,
+                    users.c.points,
+                    users.c.referral_code,
+                    users.c.referred_by,
+                    users.c.wallet_address,
+                ).where(users.c.user_id == user_id)
+            )
+            return result.first()
+
+    async def find_legacy_referral_code(self, referral_code: str) -> Optional[int]:
+        async with self.sessions() as session:
+            result = await session.execute(
+                select(legacy_referral_codes.c.user_id).where(legacy_referral_codes.c.code == referral_code)
+            )
+            return result.scalar()
+
+    async def register_user(
+        self,
+        user_id: int,
+        referral_code: str,
+        referred_by: Optional[int] = None,
+        starting_points: int = 5000,
+        referral_bonus: int = 1500,
+    ) -> bool:
+        """Create a user and credit the referrer in one transaction.
+
+        Returns False if the user already exists.
+        """
+        try:
+            async with self.sessions.begin() as session:
+                await session.execute(
+                    users.insert().values(
+                        user_id=user_id,
+                        points=starting_points,
+                        referral_code=referral_code,
+                        referred_by=referred_by,
+                        joined_at=func.current_timestamp(),
+                    )
+                )
+                if referred_by is not None:
+                    await session.execute(
+                        update(users)
+                        .where(users.c.user_id == referred_by)
+                        .values(points=users.c.points + referral_bonus)
+                    )
+                    upsert = self._insert(referral_counts).values(
+                        referrer_id=referred_by,
+                        referral_count=1,
+                        last_referral_at=func.current_timestamp(),
+                    )
+                    await session.execute(
+                        upsert.on_conflict_do_update(
+                            index_elements=[referral_counts.c.referrer_id],
+                            set_={
+                                'referral_count': referral_counts.c.referral_count + 1,
+                                'last_referral_at': func.current_timestamp(),
+                            },
+                        )
+                    )
+        except IntegrityError:
+            return False
+        touch_tables('users', 'referral_counts')
+        return True
+
+    async def set_wallet(self, user_id: int, wallet_address: str) -> bool:
+        async with self.sessions.begin() as session:
+            result = await session.execute(
+                update(users).where(users.c.user_id == user_id).values(wallet_address=wallet_address)
+            )
+        if result.rowcount == 0:
+            return False
+        touch_tables('users')
+        return True
+
+    async def withdraw_points(
+        self, user_id: int, expected_points: int, min_points: int, wallet_address: Optional[str] = None
+    ) -> bool:
+        """Zero the balance only if it is still expected_points and at least min_points.
+
+        A successful withdrawal is recorded in the withdrawals table in the same transaction.
+        """
+        async with self.sessions.begin() as session:
+            result = await session.execute(
+                update(users)
+                .where(
+                    users.c.user_id == user_id,
+                    users.c.points == expected_points,
+                    users.c.points >= min_points,
+                )
+                .values(points=0)
+            )
+            if result.rowcount > 0:
+                await session.execute(
+                    withdrawals.insert().values(
+                        user_id=user_id, points=expected_points, wallet_address=wallet_address
+                    )
+                )
+        if result.rowcount == 0:
+            return False
+        touch_tables('users', 'withdrawals')
+        return True
+
+    async def get_referral_count(self, user_id: int) -> int:
+        async with self.sessions() as session:
+            result = await session.execute(
+                select(referral_counts.c.referral_count).where(referral_counts.c.referrer_id == user_id)
+            )
+            return result.scalar() or 0
+
+    async def top_referrers(self, limit: int) -> List[Tuple[int, int]]:
+        async with self.sessions() as session:
+            result = await session.execute(
+                select(referral_counts.c.referrer_id, referral_counts.c.referral_count)
+                .where(referral_counts.c.referral_count > 0)
+                .order_by(referral_counts.c.referral_count.desc(), referral_counts.c.referrer_id)
+                .limit(limit)
+            )
+            return [tuple(row) for row in result.all()]
+
+
+_repository: Optional[Repository] = None
+
+
+def get_repository() -> Repository:
+    global _repository
+    if _repository is None:
+        _repository = Repository(create_engine_for_url(DATABASE_URL))
+    return _repository
+
+
+def configure(url: str):
+    """Point get_repository() at another database (call close_repository() first)."""
+    global DATABASE_URL, _repository
+    DATABASE_URL = url
+    _repository = None
+
+
+async def close_repository():
+    global _repository
+    if _repository is not None:
+        await _repository.dispose()
+        _repository = None
@@ -0,0 +1,33 @@
+"""Shared fixtures: app.py against a fresh user_database.db in a temp dir.
+
+app.py opens user_database.db relative to the working directory, so tests that
+touch the database run from tmp_path.
+"""
+import os
+import sys
+
+import pytest
+import pytest_asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Path of a user_database.db with the bot's schema, in the working directory."""
+    monkeypatch.chdir(tmp_path)
+    app.init_database()
+    return tmp_path / 'user_database.db'
+
+
+@pytest_asyncio.fixture
+async def repository(database):
+    """The bot's Repository, opened on the test database."""
+    storage.configure(storage.DATABASE_URL)
+    try:
+        yield storage.get_repository()
+    finally:
+        await storage.close_repository()
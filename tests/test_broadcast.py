@@ -0,0 +1,118 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+from telegram.error import Forbidden
+
+import app
+
+USER_IDS = list(range(1, 251))
+
+
+class FakeBot:
+    def __init__(self, stop_after=None):
+        self.sent = []
+        self.stop_after = stop_after
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        if self.stop_after is not None and len(self.sent) == self.stop_after:
+            app.lifecycle.stopping.set()
+
+
+@pytest.fixture
+def users(database, monkeypatch):
+    conn = sqlite3.connect(database)
+    conn.executemany('INSERT INTO users (user_id, points) VALUES (?, ?)', [(i, i * 10) for i in USER_IDS])
+    conn.execute('''
+        INSERT INTO audience_segments (name, predicates, refresh_interval)
+        VALUES ('rich', ?, 0), ('cached', ?, 3600)
+    ''', (json.dumps({'min_points': 2000}), json.dumps({'max_points': 300})))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(app, 'AD_SEND_DELAY', 0)
+    monkeypatch.setattr(app, 'RECIPIENT_PAGE_SIZE', 7)
+    monkeypatch.setattr(app, 'frequency_cap', app.FrequencyCap(cap=1000))
+    monkeypatch.setattr(app.lifecycle, 'stopping', asyncio.Event())
+    return USER_IDS
+
+
+def ad(name, segment=None):
+    return app.Advertisement(name, f'text of {name}', [], 3600, segment)
+
+
+def expected(users):
+    return sorted(
+        [(user_id, 'text of all') for user_id in users]
+        + [(user_id, 'text of rich') for user_id in users if user_id * 10 >= 2000]
+        + [(user_id, 'text of cached') for user_id in users if user_id * 10 <= 300]
+    )
+
+
+@pytest.mark.asyncio
+async def test_pages_cover_every_recipient_once(users):
+    bot = FakeBot()
+    ads = [ad('all'), ad('rich', 'rich'), ad('cached', 'cached'), ad('gone', 'deleted segment')]
+    assert await app.send_advertisements(bot, ads) == (len(expected(users)), None)
+    assert sorted(bot.sent) == expected(users)
+    # Recipients are visited in user_id order
+    assert [chat_id for chat_id, _ in bot.sent] == sorted(chat_id for chat_id, _ in bot.sent)
+
+
+@pytest.mark.asyncio
+async def test_resume_after_checkpoint(users):
+    ads = [ad('all'), ad('rich', 'rich'), ad('cached', 'cached')]
+    bot = FakeBot(stop_after=40)
+    sent, stopped_at = await app.send_advertisements(bot, ads)
+    assert stopped_at is not None and sent == len(bot.sent)
+
+    app.lifecycle.stopping.clear()
+    resumed = FakeBot()
+    _, finished = await app.send_advertisements(resumed, ads, resume_after=stopped_at)
+    assert finished is None
+    assert all(chat_id > stopped_at for chat_id, _ in resumed.sent)
+    assert sorted(bot.sent + resumed.sent) == expected(users)
+
+
+def test_fetch_recipient_page_merges_queries(users):
+    queries = [app.recipient_query(None), app.recipient_query('rich')]
+    page = app.fetch_recipient_page(queries, 190, 5)
+    # 'all' has a full page up to 195, so nothing beyond it is returned yet
+    assert page == [(191, [0]), (192, [0]), (193, [0]), (194, [0]), (195, [0])]
+    page = app.fetch_recipient_page(queries, 199, 5)
+    assert page == [(200, [0, 1]), (201, [0, 1]), (202, [0, 1]), (203, [0, 1]), (204, [0, 1])]
+    assert app.fetch_recipient_page(queries, 250, 5) == []
+    assert app.count_recipients(queries, 190) == 60
+
+
+class BlockedBot(FakeBot):
+    def __init__(self, blocked):
+        super().__init__()
+        self.blocked = set(blocked)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Forbidden('Forbidden: bot was blocked by the user')
+        await super().send_message(chat_id, text, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_failed_sends_do_not_use_up_the_cap(users, monkeypatch):
+    monkeypatch.setattr(app, 'frequency_cap', app.FrequencyCap(cap=1))
+    monkeypatch.setattr(app, 'ad_send_failures', {})
+    blocked = {1, 2, 3}
+    bot = BlockedBot(blocked)
+    sent, _ = await app.send_advertisements(bot, [ad('all'), ad('rich', 'rich')])
+
+    assert sent == len(users) - len(blocked)
+    assert app.ad_send_failures == {'all': len(blocked)}
+    assert all(sum(app.frequency_cap.counters[user_id][1]) == 0 for user_id in blocked)
+    # Everyone else got 'all' and hit the cap of 1, so 'rich' was suppressed
+    assert app.frequency_cap.suppressed == {'rich': len([u for u in users if u * 10 >= 2000])}
+
+    # Once unblocked, the users still have their full budget
+    bot = FakeBot()
+    monkeypatch.setattr(app, 'RECIPIENT_PAGE_SIZE', 1000)
+    await app.send_advertisements(bot, [ad('all')])
+    assert sorted(chat_id for chat_id, _ in bot.sent) == sorted(blocked)
@@ -0,0 +1,132 @@
+import sqlite3
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def feed(database):
+    feed = app.ChangeFeed(str(database))
+    feed.delivered = []
+    for table in app.CHANGE_FEED_TABLES:
+        feed.subscribe(table, lambda row_ids, table=table: feed.delivered.append((table, row_ids)))
+    feed.poll()  # start following at the newest change
+    return feed
+
+
+def write(database, *statements):
+    conn = sqlite3.connect(database)
+    for statement in statements:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+
+def age_changes(database, up_to_id, seconds=2 * app.CHANGE_LOG_RETENTION):
+    """Backdate change_log entries so prune_change_log drops them."""
+    write(database, f"UPDATE change_log SET changed_at = datetime('now', '-{seconds} seconds') WHERE change_id <= {up_to_id}")
+
+
+def newest_change(database):
+    conn = sqlite3.connect(database)
+    newest = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    conn.close()
+    return newest[0] if newest else 0
+
+
+def test_history_before_startup_is_not_replayed(database):
+    write(database, 'INSERT INTO users (user_id) VALUES (1)')
+    feed = app.ChangeFeed(str(database))
+    assert feed.poll() == 0
+    assert feed.last_change_id == newest_change(database)
+    assert feed.poll() == 0
+
+
+def test_changes_are_grouped_per_table(database, feed):
+    write(
+        database,
+        'INSERT INTO users (user_id) VALUES (1)',
+        'INSERT INTO users (user_id) VALUES (2)',
+        'UPDATE users SET points = 5 WHERE user_id = 1',
+        'INSERT INTO muted_users (user_id) VALUES (2)',
+        'DELETE FROM muted_users WHERE user_id = 2',
+    )
+    assert feed.poll() == 5
+    assert sorted(feed.delivered) == [('muted_users', {2}), ('users', {1, 2})]
+    assert feed.resyncs == 0
+    assert feed.last_change_id == newest_change(database)
+
+
+def test_a_gap_left_by_pruning_resyncs(database, feed):
+    write(database, *[f'INSERT INTO users (user_id) VALUES ({i})' for i in range(1, 4)])
+    age_changes(database, feed.last_change_id + 1)
+    assert app.prune_change_log() == 1
+
+    assert feed.poll() == 0
+    assert feed.resyncs == 1
+    assert sorted(feed.delivered) == [(table, None) for table in sorted(app.CHANGE_FEED_TABLES)]
+    assert feed.last_change_id == newest_change(database)
+
+    # Back in step afterwards
+    feed.delivered.clear()
+    write(database, 'INSERT INTO users (user_id) VALUES (4)')
+    assert feed.poll() == 1
+    assert feed.delivered == [('users', {4})]
+
+
+def test_everything_after_the_follower_pruned_resyncs(database, feed):
+    write(database, 'INSERT INTO users (user_id) VALUES (1)', 'INSERT INTO users (user_id) VALUES (2)')
+    age_changes(database, newest_change(database))
+    assert app.prune_change_log() == 2
+
+    feed.poll()
+    assert feed.resyncs == 1
+    assert ('users', None) in feed.delivered
+    assert feed.last_change_id == newest_change(database)
+
+
+def test_a_backlog_over_the_batch_size_resyncs(database, feed, monkeypatch):
+    monkeypatch.setattr(app, 'CHANGE_FEED_BATCH', 5)
+    write(database, *[f'INSERT INTO users (user_id) VALUES ({i})' for i in range(1, 6)])
+    assert feed.poll() == 5
+    assert feed.resyncs == 0
+
+    write(database, *[f'INSERT INTO users (user_id) VALUES ({i})' for i in range(6, 12)])
+    feed.delivered.clear()
+    assert feed.poll() == 0
+    assert feed.resyncs == 1
+    assert ('users', None) in feed.delivered
+    assert feed.last_change_id == newest_change(database)
+
+
+def test_prune_keeps_recent_changes(database):
+    write(database, 'INSERT INTO users (user_id) VALUES (1)', 'INSERT INTO users (user_id) VALUES (2)')
+    age_changes(database, newest_change(database) - 1)
+    assert app.prune_change_log() == 1
+    assert app.prune_change_log() == 0
+
+
+def test_change_versions_survive_pruning(database, monkeypatch):
+    monkeypatch.setattr(app, 'DB_FILE', str(database))
+    write(database, 'INSERT INTO users (user_id) VALUES (1)', 'INSERT INTO muted_users (user_id) VALUES (1)')
+    users_version = app.latest_change('users')
+    assert users_version == newest_change(database) - 1
+    assert app.latest_change('muted_users') == newest_change(database)
+    assert app.latest_change('administrators') == 0
+
+    age_changes(database, newest_change(database))
+    assert app.prune_change_log() == 2
+    # The dashboard's cache keys never go back to an older value
+    assert app.latest_change('users') == users_version
+
+    write(database, 'UPDATE users SET points = 1 WHERE user_id = 1')
+    assert app.latest_change('users') == newest_change(database) > users_version
+
+
+def test_change_versions_backfilled_from_an_existing_log(database):
+    write(database, 'INSERT INTO users (user_id) VALUES (1)', 'DELETE FROM change_versions')
+    app.init_database()
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT change_id FROM change_versions WHERE table_name = 'users'").fetchone() == (newest_change(database),)
+    conn.close()
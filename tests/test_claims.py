@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+ADMIN_A, ADMIN_B, ADMIN_C = 11, 12, 13
+
+
+def add_messages(database, count):
+    conn = sqlite3.connect(database)
+    ids = [
+        conn.execute(
+            "INSERT INTO messages (user_id, message, timestamp) VALUES (?, ?, datetime('now', ?))",
+            (1000 + i, f'message {i}', f'-{count - i} minutes')
+        ).lastrowid
+        for i in range(count)
+    ]
+    conn.commit()
+    conn.close()
+    return ids
+
+
+def expire_claims(database, admin_id):
+    conn = sqlite3.connect(database)
+    conn.execute(
+        "UPDATE messages SET claim_expires_at = datetime('now', '-1 second') WHERE claimed_by = ?", (admin_id,)
+    )
+    conn.commit()
+    conn.close()
+
+
+def assert_pending_counter(database):
+    conn = sqlite3.connect(database)
+    counter = conn.execute("SELECT value FROM counters WHERE name = 'messages_pending'").fetchone()[0]
+    actual = conn.execute("SELECT COUNT(*) FROM messages WHERE status = 'pending'").fetchone()[0]
+    conn.close()
+    assert counter == actual
+
+
+class FakeQuery:
+    def __init__(self, admin_id):
+        self.from_user = SimpleNamespace(id=admin_id)
+        self.texts = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def test_claims_are_disjoint_and_oldest_first(database):
+    ids = add_messages(database, 12)
+    first = app.claim_messages(ADMIN_A, 5)
+    second = app.claim_messages(ADMIN_B, 5)
+    third = app.claim_messages(ADMIN_C, 5)
+    assert sorted(first) == ids[:5]
+    assert sorted(second) == ids[5:10]
+    assert sorted(third) == ids[10:]
+    assert app.claim_messages(ADMIN_A, 5) == []
+
+
+def test_concurrent_claimers_never_share_a_message(database):
+    ids = add_messages(database, 200)
+    claimed = {}
+
+    def claimer(admin_id):
+        mine = claimed.setdefault(admin_id, [])
+        while True:
+            batch = app.claim_messages(admin_id, 3)
+            if not batch:
+                return
+            mine.extend(batch)
+
+    threads = [threading.Thread(target=claimer, args=(admin_id,)) for admin_id in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    everything = [message_id for batch in claimed.values() for message_id in batch]
+    assert sorted(everything) == ids
+
+
+def test_expired_lease_can_be_reclaimed(database):
+    ids = add_messages(database, 2)
+    assert sorted(app.claim_messages(ADMIN_A, 5)) == ids
+    assert not app.claim_message(ids[0], ADMIN_B)
+    assert app.claim_message(ids[0], ADMIN_A), 'the holder renews its own lease'
+
+    expire_claims(database, ADMIN_A)
+    assert sorted(app.claim_messages(ADMIN_B, 5)) == ids
+    assert not app.claim_message(ids[0], ADMIN_A)
+
+
+def test_release_claims(database):
+    ids = add_messages(database, 3)
+    app.claim_messages(ADMIN_A, 2)
+    assert app.release_claims(ADMIN_A) == 2
+    assert sorted(app.claim_messages(ADMIN_B, 5)) == ids
+
+
+@pytest.mark.asyncio
+async def test_reply_refused_while_another_admin_holds_the_claim(database):
+    [message_id] = add_messages(database, 1)
+    assert app.claim_message(message_id, ADMIN_A)
+    context = SimpleNamespace(bot=FakeBot())
+
+    assert not await app.save_admin_reply(message_id, 'from B', ADMIN_B, context)
+    assert context.bot.sent == []
+    assert await app.save_admin_reply(message_id, 'from A', ADMIN_A, context)
+    assert context.bot.sent == [(1000, "Admin reply to your message:\n\nfrom A")]
+    # Already answered: nobody can answer it again
+    assert not await app.save_admin_reply(message_id, 'again', ADMIN_A, context)
+    assert_pending_counter(database)
+
+
+@pytest.mark.asyncio
+async def test_ignore_refused_while_another_admin_holds_the_claim(database):
+    [message_id] = add_messages(database, 1)
+    assert app.claim_message(message_id, ADMIN_A)
+
+    query = FakeQuery(ADMIN_B)
+    await app.handle_ignored_message(query, message_id)
+    assert query.texts == ["This message is already handled or claimed by another admin."]
+
+    expire_claims(database, ADMIN_A)
+    await app.handle_ignored_message(query, message_id)
+    assert query.texts[-1] == "Message has been marked as ignored."
+    assert_pending_counter(database)
+
+
+def test_pending_counter_tracks_every_write(database):
+    ids = add_messages(database, 10)
+    assert_pending_counter(database)
+    app.claim_messages(ADMIN_A, 4)
+    assert_pending_counter(database)
+
+    conn = sqlite3.connect(database)
+    conn.execute("UPDATE messages SET status = 'replied' WHERE message_id IN (?, ?)", ids[:2])
+    conn.execute("UPDATE messages SET status = 'ignored' WHERE message_id = ?", (ids[2],))
+    conn.execute("UPDATE messages SET status = 'pending' WHERE message_id = ?", (ids[2],))
+    conn.execute("UPDATE messages SET status = 'pending' WHERE message_id = ?", (ids[3],))  # no change
+    conn.execute('DELETE FROM messages WHERE message_id IN (?, ?)', (ids[0], ids[4]))
+    conn.execute("INSERT INTO messages (user_id, message, status) VALUES (1, 'done', 'replied')")
+    conn.commit()
+    conn.close()
+    assert_pending_counter(database)
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+import app
+
+USER = 1001
+
+
+def fresh(budgets=None):
+    control = app.FloodControl(budgets or app.FLOOD_BUDGETS)
+    control.admin_ids = {app.ADMIN_IDS[0]}
+    return control
+
+
+def spend(control, bucket_class, count, now=0.0, user_id=USER):
+    return [control.allow(user_id, bucket_class, now=now) for _ in range(count)]
+
+
+def test_bucket_allows_capacity_then_drops():
+    control = fresh({'command': (3, 1.0)})
+    assert spend(control, 'command', 4) == [True, True, True, False]
+    assert control.dropped == 1
+
+
+def test_tokens_refill_over_time():
+    control = fresh({'command': (3, 0.5)})
+    assert spend(control, 'command', 3) == [True] * 3
+    assert not control.allow(USER, 'command', now=1.0)  # half a token back
+    assert control.allow(USER, 'command', now=2.0)
+    assert not control.allow(USER, 'command', now=2.0)
+    # Refill stops at capacity, however long the bucket was idle
+    assert spend(control, 'command', 4, now=1000.0) == [True, True, True, False]
+
+
+@pytest.mark.parametrize('bucket_class', list(app.FLOOD_BUDGETS))
+def test_each_class_has_its_own_budget(bucket_class):
+    control = fresh()
+    capacity, _ = app.FLOOD_BUDGETS[bucket_class]
+    assert spend(control, bucket_class, capacity + 1) == [True] * capacity + [False]
+    # Exhausting one class leaves the others and other users untouched
+    for other in app.FLOOD_BUDGETS:
+        if other != bucket_class:
+            assert control.allow(USER, other, now=0.0)
+    assert control.allow(USER + 1, bucket_class, now=0.0)
+
+
+def test_admins_are_exempt():
+    control = fresh({'media': (1, 0.0)})
+    assert all(spend(control, 'media', 50, user_id=app.ADMIN_IDS[0]))
+    assert control.dropped == 0
+    assert not control.buckets['media']
+
+
+def test_sweep_expires_idle_buckets():
+    control = fresh({'command': (3, 1.0), 'callback': (3, 1.0)})
+    control.allow(USER, 'command', now=0.0)
+    control.allow(USER + 1, 'callback', now=500.0)
+    assert control.sweep(now=app.FLOOD_BUCKET_TTL + 1) == 1
+    assert USER not in control.buckets['command']
+    assert USER + 1 in control.buckets['callback']
+    # An expired user starts again from a full bucket
+    assert spend(control, 'command', 3, now=app.FLOOD_BUCKET_TTL + 1) == [True] * 3
+
+
+def make_update(user_id, text=None, callback=False):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        callback_query=SimpleNamespace() if callback else None,
+        message=None if callback else SimpleNamespace(text=text),
+    )
+
+
+@pytest.mark.parametrize('text, bucket_class', [
+    ('/balance', 'media'),
+    ('/start abc', 'account'),
+    ('/withdraw@SomeBot', 'account'),
+    ('/messageadmin', 'contact'),
+    ('/help', 'command'),
+    ('hello', 'message'),
+])
+def test_classify_update(text, bucket_class):
+    assert app.classify_update(make_update(USER, text)) == bucket_class
+
+
+def test_classify_callback():
+    assert app.classify_update(make_update(USER, callback=True)) == 'callback'
+
+
+@pytest.mark.asyncio
+async def test_flood_guard_stops_over_budget_updates(monkeypatch):
+    monkeypatch.setattr(app, 'flood_control', fresh())
+    capacity, _ = app.FLOOD_BUDGETS['media']
+    for _ in range(capacity):
+        await app.flood_guard(make_update(USER, '/balance'), None)
+    with pytest.raises(ApplicationHandlerStop):
+        await app.flood_guard(make_update(USER, '/balance'), None)
+    # Admins and updates without a user always pass
+    for _ in range(capacity + 1):
+        await app.flood_guard(make_update(app.ADMIN_IDS[0], '/balance'), None)
+    await app.flood_guard(SimpleNamespace(effective_user=None), None)
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+import app
+
+USER = 7
+BUCKET = app.AD_FREQUENCY_WINDOW // app.AD_FREQUENCY_BUCKETS
+T0 = 1_767_225_600  # a bucket boundary
+
+
+def send(cap, now, user_id=USER, ad_name='ad'):
+    if not cap.check(user_id, ad_name, now=now):
+        return False
+    cap.record(user_id, now=now)
+    return True
+
+
+def test_check_does_not_count_a_send():
+    cap = app.FrequencyCap(cap=2)
+    for _ in range(5):
+        assert cap.check(USER, 'ad', now=T0)
+    assert sum(cap.counters[USER][1]) == 0
+    assert USER not in cap.dirty
+
+
+def test_cap_within_the_window():
+    cap = app.FrequencyCap(cap=3)
+    assert [send(cap, T0 + i) for i in range(4)] == [True, True, True, False]
+    assert cap.suppressed == {'ad': 1}
+    # Other users have their own window
+    assert send(cap, T0, user_id=USER + 1)
+
+
+def test_sub_buckets_slide_out_of_the_window():
+    cap = app.FrequencyCap(cap=3)
+    assert send(cap, T0)  # bucket 0
+    assert send(cap, T0 + 2 * BUCKET)  # bucket 2
+    assert send(cap, T0 + 4 * BUCKET)  # bucket 4
+    assert not send(cap, T0 + 5 * BUCKET)
+    # At bucket 6 the ring reuses bucket 0's slot: that send has left the window
+    assert send(cap, T0 + 6 * BUCKET)
+    assert not send(cap, T0 + 7 * BUCKET)
+    assert send(cap, T0 + 8 * BUCKET)  # bucket 2's send expired
+    assert sorted(cap.counters[USER][1]) == [0, 0, 0, 1, 1, 1]
+
+
+def test_whole_window_expires_after_idling():
+    cap = app.FrequencyCap(cap=2)
+    assert send(cap, T0) and send(cap, T0 + 1)
+    assert not send(cap, T0 + app.AD_FREQUENCY_WINDOW - 1)
+    assert send(cap, T0 + app.AD_FREQUENCY_WINDOW + 10 * BUCKET)
+    assert sum(cap.counters[USER][1]) == 1
+
+
+def test_an_out_of_order_time_does_not_rewind_the_ring():
+    cap = app.FrequencyCap(cap=10)
+    send(cap, T0 + 3 * BUCKET)
+    send(cap, T0)
+    assert cap.counters[USER][0] == T0 // BUCKET + 3
+
+
+def test_counts_saturate_instead_of_overflowing():
+    cap = app.FrequencyCap(cap=1 << 20)
+    cap.record(USER, now=T0)
+    slot = (T0 // BUCKET) % app.AD_FREQUENCY_BUCKETS
+    cap.counters[USER][1][slot] = 0xFFFF
+    cap.record(USER, now=T0)  # array('H') would raise OverflowError at 0x10000
+    assert cap.counters[USER][1][slot] == 0xFFFF
+
+
+@pytest.mark.asyncio
+async def test_save_and_load_round_trip(database):
+    cap = app.FrequencyCap(cap=3)
+    now = app.time.time()
+    send(cap, now, user_id=1)
+    send(cap, now, user_id=2)
+    send(cap, now - 2 * app.AD_FREQUENCY_WINDOW, user_id=3)  # already expired
+    cap.check(9, 'capped-ad', now=now)
+    cap.suppressed['capped-ad'] = 4
+
+    assert await cap.save() == 2
+    assert 3 not in cap.counters and not cap.dirty
+    assert await cap.save() == 0
+
+    loaded = app.FrequencyCap(cap=3)
+    loaded.load()
+    assert {user_id: list(counts) for user_id, (_, counts) in loaded.counters.items()} == {
+        user_id: list(cap.counters[user_id][1]) for user_id in (1, 2)
+    }
+    assert loaded.suppressed == {'capped-ad': 4}
+
+
+@pytest.mark.asyncio
+async def test_failed_save_keeps_counters_dirty(tmp_path):
+    cap = app.FrequencyCap(cap=3)
+    send(cap, app.time.time())
+    with pytest.raises(sqlite3.Error):
+        await cap.save(str(tmp_path / 'missing.db'))  # no ad_frequency table
+    assert cap.dirty == {USER}
@@ -0,0 +1,48 @@
+import sqlite3
+
+import app
+from generate_data import FIRST_USER_ID, generate
+
+NOW = 1_767_225_600
+
+
+def test_init_database_at_any_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    database = tmp_path / 'data' / 'bot.sqlite'
+    database.parent.mkdir()
+    app.init_database(str(database))
+    assert not (tmp_path / 'user_database.db').exists()
+    # The message archive lives next to the database
+    assert (database.parent / app.MESSAGE_ARCHIVE_DB).exists()
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users'").fetchone()
+    conn.close()
+
+
+def test_generate_writes_any_output_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output = tmp_path / 'nested' / 'sample.db'
+    stats = generate(str(output), 500, seed=3, now=NOW)
+    assert stats['users'] == 500
+    assert not (tmp_path / 'user_database.db').exists()
+
+    conn = sqlite3.connect(output)
+    assert conn.execute('SELECT MIN(user_id), COUNT(*) FROM users').fetchone() == (FIRST_USER_ID, 500)
+    assert conn.execute('SELECT referral_code FROM users WHERE user_id = ?', (FIRST_USER_ID,)).fetchone() == (
+        app.generate_referral_code(FIRST_USER_ID),
+    )
+    assert conn.execute('PRAGMA integrity_check').fetchone() == ('ok',)
+    conn.close()
+
+
+def test_generate_is_reproducible(tmp_path):
+    first = tmp_path / 'first.db'
+    second = tmp_path / 'second.db'
+    generate(str(first), 300, seed=5, now=NOW)
+    generate(str(second), 300, seed=5, now=NOW)
+    rows = []
+    for path in (first, second):
+        conn = sqlite3.connect(path)
+        rows.append(conn.execute('SELECT user_id, points, referred_by, wallet_address FROM users ORDER BY user_id').fetchall())
+        conn.close()
+    assert rows[0] == rows[1]
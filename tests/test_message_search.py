@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+import app
+
+MESSAGES = [
+    (1, 'When is the next payout?', 'pending', '2026-01-01 10:00:00'),
+    (2, 'My payout has not arrived', 'replied', '2026-01-02 10:00:00'),
+    (1, 'How do I change my wallet?', 'ignored', '2026-01-03 23:59:59'),
+    (3, 'payout "urgent" NEAR me - please*', 'pending', '2026-01-04 00:00:00'),
+]
+
+
+@pytest.fixture
+def inbox(database):
+    conn = sqlite3.connect(database)
+    ids = [
+        conn.execute(
+            'INSERT INTO messages (user_id, message, status, timestamp) VALUES (?, ?, ?, ?)', row
+        ).lastrowid
+        for row in MESSAGES
+    ]
+    conn.commit()
+    conn.close()
+    return ids
+
+
+def found(criteria, page=0):
+    rows, _ = app.search_messages(criteria, page)
+    return sorted(row[0] for row in rows)
+
+
+def test_parse_terms_and_filters():
+    criteria = app.parse_message_search(
+        ['late', 'payout', 'user:42', 'STATUS:Pending', 'from:2026-01-01', 'to:2026-01-31']
+    )
+    assert criteria == {
+        'terms': ['late', 'payout'], 'user_id': 42, 'status': 'pending', 'from': '2026-01-01', 'to': '2026-01-31'
+    }
+    # Filter names without a value, and unknown names, are search terms
+    assert app.parse_message_search(['user:', 'note:x', 'http://a'])['terms'] == ['user:', 'note:x', 'http://a']
+
+
+@pytest.mark.parametrize('arg', ['user:abc', 'status:lost', 'from:2026-13-01', 'to:yesterday'])
+def test_parse_rejects_bad_filter_values(arg):
+    with pytest.raises(ValueError):
+        app.parse_message_search([arg])
+
+
+def test_filters(inbox):
+    assert found(app.parse_message_search(['payout'])) == [inbox[0], inbox[1], inbox[3]]
+    assert found(app.parse_message_search(['payout', 'status:pending'])) == [inbox[0], inbox[3]]
+    assert found(app.parse_message_search(['user:1'])) == [inbox[0], inbox[2]]
+    # to: includes the whole day
+    assert found(app.parse_message_search(['from:2026-01-02', 'to:2026-01-03'])) == [inbox[1], inbox[2]]
+
+
+def test_paging(inbox):
+    criteria = app.parse_message_search(['user:1'])
+    rows, has_next = app.search_messages(criteria, 0)
+    assert len(rows) == 2 and not has_next
+    conn = sqlite3.connect('user_database.db')
+    conn.executemany('INSERT INTO messages (user_id, message) VALUES (1, ?)',
+                     [(f'more {i}',) for i in range(app.MESSAGE_SEARCH_PAGE_SIZE)])
+    conn.commit()
+    conn.close()
+    rows, has_next = app.search_messages(criteria, 0)
+    assert len(rows) == app.MESSAGE_SEARCH_PAGE_SIZE and has_next
+    rows, has_next = app.search_messages(criteria, 1)
+    assert len(rows) == 2 and not has_next
+
+
+@pytest.mark.parametrize('term', [
+    '"', '""', 'urgent"', '"urgent"', '*', 'please*', 'pay*', 'NEAR', 'NEAR(payout', '-', '-payout',
+    'AND', 'OR', 'NOT', '(', ')', ':', '^payout', 'message:payout', '{message}', "'", ';',
+])
+def test_fts_syntax_in_terms_is_literal(inbox, term):
+    # Must not raise sqlite3.OperationalError (fts5: syntax error)
+    app.search_messages({'terms': [term]}, 0)
+
+
+def test_operators_match_as_words(inbox):
+    assert found({'terms': ['NEAR']}) == [inbox[3]]
+    assert found({'terms': ['urgent"']}) == [inbox[3]]
+    # A trailing * is not a prefix query
+    assert found({'terms': ['pay*']}) == []
+
+
+def test_fts_follows_updates_and_deletes(inbox):
+    conn = sqlite3.connect('user_database.db')
+    conn.execute("UPDATE messages SET message = 'Where is my refund?' WHERE message_id = ?", (inbox[1],))
+    conn.execute("UPDATE messages SET admin_reply = 'Refund sent' WHERE message_id = ?", (inbox[0],))
+    conn.execute('DELETE FROM messages WHERE message_id = ?', (inbox[3],))
+    conn.commit()
+    conn.close()
+
+    assert found({'terms': ['payout']}) == [inbox[0]]
+    assert found({'terms': ['refund']}) == [inbox[0], inbox[1]]
+    conn = sqlite3.connect('user_database.db')
+    # The index holds no stale entries for the old text or the deleted row
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('integrity-check')")
+    assert conn.execute('SELECT COUNT(*) FROM messages_fts').fetchone() == (3,)
+    conn.close()
@@ -0,0 +1,156 @@
+import sqlite3
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def writes(database):
+    """Every row insert or update the persistence tables see, as (table, key)."""
+    conn = sqlite3.connect(database)
+    conn.executescript('''
+        CREATE TABLE persistence_writes (table_name TEXT, row_key TEXT);
+        CREATE TRIGGER user_data_insert AFTER INSERT ON persisted_user_data BEGIN
+            INSERT INTO persistence_writes VALUES ('user_data', new.user_id || ':' || new.key);
+        END;
+        CREATE TRIGGER user_data_update AFTER UPDATE ON persisted_user_data BEGIN
+            INSERT INTO persistence_writes VALUES ('user_data', new.user_id || ':' || new.key);
+        END;
+        CREATE TRIGGER conversations_insert AFTER INSERT ON persisted_conversations BEGIN
+            INSERT INTO persistence_writes VALUES ('conversations', new.name || ':' || new.conversation_key);
+        END;
+        CREATE TRIGGER conversations_update AFTER UPDATE ON persisted_conversations BEGIN
+            INSERT INTO persistence_writes VALUES ('conversations', new.name || ':' || new.conversation_key);
+        END;
+    ''')
+    conn.close()
+
+    def take():
+        conn = sqlite3.connect(database)
+        rows = conn.execute('SELECT table_name, row_key FROM persistence_writes ORDER BY rowid').fetchall()
+        conn.execute('DELETE FROM persistence_writes')
+        conn.commit()
+        conn.close()
+        return rows
+
+    return take
+
+
+def rows(database, table):
+    conn = sqlite3.connect(database)
+    if table == 'persisted_user_data':
+        result = conn.execute('SELECT user_id, key, value FROM persisted_user_data ORDER BY user_id, key').fetchall()
+    else:
+        result = conn.execute('SELECT name, conversation_key, state FROM persisted_conversations ORDER BY name').fetchall()
+    conn.close()
+    return result
+
+
+@pytest.mark.asyncio
+async def test_only_changed_keys_are_written(database, writes):
+    persistence = app.SQLitePersistence(str(database))
+    await persistence.update_user_data(1, {'lang': 'en', 'page': 0, 'seen': [1, 2]})
+    await persistence.flush()
+    assert sorted(writes()) == [('user_data', '1:lang'), ('user_data', '1:page'), ('user_data', '1:seen')]
+
+    await persistence.update_user_data(1, {'lang': 'en', 'page': 1, 'seen': [1, 2]})
+    await persistence.update_user_data(2, {})
+    await persistence.flush()
+    assert writes() == [('user_data', '1:page')]
+
+    # Unchanged data writes nothing at all; dropped keys are deleted
+    await persistence.update_user_data(1, {'lang': 'en', 'page': 1, 'seen': [1, 2]})
+    await persistence.flush()
+    assert writes() == []
+    await persistence.update_user_data(1, {'lang': 'en'})
+    await persistence.flush()
+    assert writes() == []
+    assert rows(database, 'persisted_user_data') == [(1, 'lang', '"en"')]
+
+
+@pytest.mark.asyncio
+async def test_reload_knows_what_is_on_disk(database, writes):
+    persistence = app.SQLitePersistence(str(database))
+    await persistence.update_user_data(1, {'lang': 'en', 'page': 3})
+    await persistence.flush()
+    writes()
+
+    reloaded = app.SQLitePersistence(str(database))
+    assert await reloaded.get_user_data() == {1: {'lang': 'en', 'page': 3}}
+    await reloaded.update_user_data(1, {'lang': 'en', 'page': 3})
+    await reloaded.flush()
+    assert writes() == []
+
+
+@pytest.mark.asyncio
+async def test_values_that_are_not_json_are_skipped(database):
+    persistence = app.SQLitePersistence(str(database))
+    await persistence.update_user_data(1, {'lang': 'en', 'task': object()})
+    await persistence.flush()
+    assert rows(database, 'persisted_user_data') == [(1, 'lang', '"en"')]
+
+
+@pytest.mark.asyncio
+async def test_drop_user_data(database):
+    persistence = app.SQLitePersistence(str(database))
+    await persistence.update_user_data(1, {'lang': 'en'})
+    await persistence.update_user_data(2, {'lang': 'de'})
+    await persistence.flush()
+    await persistence.drop_user_data(1)
+    await persistence.flush()
+    assert rows(database, 'persisted_user_data') == [(2, 'lang', '"de"')]
+
+
+@pytest.mark.asyncio
+async def test_a_failed_batch_is_retried(database):
+    persistence = app.SQLitePersistence(str(database))
+    conn = sqlite3.connect(database)
+    conn.execute('ALTER TABLE persisted_conversations RENAME TO persisted_conversations_away')
+    conn.commit()
+
+    await persistence.update_user_data(1, {'lang': 'en', 'page': 0})
+    await persistence.update_conversation('settings', (10, 1), app.WAITING_FOR_WALLET)
+    await persistence.flush()
+    # The whole batch rolled back, user_data included, and is still staged
+    assert rows(database, 'persisted_user_data') == []
+    assert persistence._pending_user_data and persistence._pending_conversations
+
+    # Newer values staged meanwhile win over the failed batch
+    await persistence.update_user_data(1, {'lang': 'de', 'page': 0})
+    conn.execute('ALTER TABLE persisted_conversations_away RENAME TO persisted_conversations')
+    conn.commit()
+    conn.close()
+    await persistence.flush()
+    assert rows(database, 'persisted_user_data') == [(1, 'lang', '"de"'), (1, 'page', '0')]
+    assert rows(database, 'persisted_conversations') == [('settings', '[10, 1]', str(app.WAITING_FOR_WALLET))]
+    assert not persistence._pending_user_data and not persistence._pending_conversations
+
+
+@pytest.mark.asyncio
+async def test_a_batch_survives_an_unreachable_database(database, tmp_path):
+    persistence = app.SQLitePersistence(str(tmp_path / 'missing' / 'user_database.db'))
+    await persistence.update_conversation('settings', (10, 1), app.WAITING_FOR_WALLET)
+    await persistence.flush()
+    assert persistence._pending_conversations
+
+    persistence.database = str(database)
+    await persistence.flush()
+    assert rows(database, 'persisted_conversations') == [('settings', '[10, 1]', str(app.WAITING_FOR_WALLET))]
+
+
+@pytest.mark.asyncio
+async def test_conversation_states_round_trip_across_a_reload(database):
+    persistence = app.SQLitePersistence(str(database))
+    await persistence.update_conversation('settings', (10, 1), app.WAITING_FOR_WALLET)
+    await persistence.update_conversation('settings', (20, 2), app.WAITING_FOR_WALLET)
+    await persistence.update_conversation('add_admin', (10, 1), app.WAITING_FOR_ADMIN_ID)
+    await persistence.flush()
+    # Ending a conversation deletes its state
+    await persistence.update_conversation('settings', (20, 2), None)
+    await persistence.flush()
+
+    reloaded = app.SQLitePersistence(str(database))
+    assert await reloaded.get_conversations('settings') == {(10, 1): app.WAITING_FOR_WALLET}
+    assert await reloaded.get_conversations('add_admin') == {(10, 1): app.WAITING_FOR_ADMIN_ID}
+    assert await reloaded.get_conversations('unknown') == {}
@@ -0,0 +1,152 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import app
+import profiling
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = profiling.Tracer()
+    monkeypatch.setattr(profiling, 'tracer', tracer)
+    monkeypatch.setattr(app, 'tracer', tracer)
+    yield tracer
+    tracer.disable()
+
+
+def test_enabling_leaves_sqlite3_connect_alone(tracer):
+    connect = sqlite3.connect
+    tracer.enable()
+    assert sqlite3.connect is connect
+    conn = sqlite3.connect(':memory:')
+    assert type(conn) is sqlite3.Connection
+    conn.close()
+
+
+def test_connect_db_is_traced_only_while_enabled(database, tracer):
+    conn = app.connect_db()
+    assert type(conn) is sqlite3.Connection
+    conn.close()
+
+    tracer.enable()
+    conn = app.connect_db()
+    assert isinstance(conn, profiling.TracedConnection)
+    conn.close()
+
+    tracer.disable()
+    conn = app.connect_db()
+    assert type(conn) is sqlite3.Connection
+    conn.close()
+
+
+def test_queries_and_fetches_are_attributed_to_the_handler(database, tracer):
+    tracer.enable()
+    conn = app.connect_db()
+    conn.executemany('INSERT INTO users (user_id) VALUES (?)', [(i,) for i in range(1, 21)])
+    with tracer.trace('balance'):
+        cursor = conn.execute('SELECT user_id FROM users ORDER BY user_id')
+        assert cursor.fetchone() == (1,)
+        assert len(cursor.fetchmany(5)) == 5
+        assert len(cursor.fetchall()) == 14
+    conn.close()
+
+    stats = tracer.stats['balance']
+    assert stats.updates == 1
+    # Fetches add time but are not counted as queries
+    assert stats.sql_queries == 1
+    assert 0 < stats.sql_seconds <= stats.seconds
+
+
+def test_fetches_alone_record_time(database, tracer):
+    tracer.enable()
+    conn = app.connect_db()
+    cursor = conn.execute('SELECT 1')
+    with tracer.trace('start'):
+        cursor.fetchone()
+        cursor.fetchmany()
+    conn.close()
+    assert tracer.stats['start'].sql_queries == 0
+    assert tracer.stats['start'].sql_seconds > 0
+
+
+@pytest.mark.asyncio
+async def test_labelled_names_only_the_steps_its_coroutine_runs():
+    watchdog = profiling.LoopWatchdog()
+    seen = []
+
+    async def handler(name, pauses):
+        for _ in range(pauses):
+            seen.append((name, watchdog.running_handler))
+            await asyncio.sleep(0)
+        seen.append((name, watchdog.running_handler))
+        return name
+
+    results = await asyncio.gather(
+        watchdog.labelled('start', handler('start', 3)),
+        watchdog.labelled('balance', handler('balance', 2)),
+    )
+    assert results == ['start', 'balance']
+    # Interleaved at every await, yet each step saw its own name
+    assert all(name == running for name, running in seen)
+    assert len(seen) == 7
+    assert watchdog.running_handler is None
+
+
+@pytest.mark.asyncio
+async def test_labelled_passes_exceptions_and_cancellation_through():
+    watchdog = profiling.LoopWatchdog()
+
+    async def fails():
+        await asyncio.sleep(0)
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        await watchdog.labelled('fails', fails())
+
+    cancelled = []
+
+    async def waits():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(watchdog.running_handler)
+            raise
+
+    task = asyncio.create_task(watchdog.labelled('waits', waits()))
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert cancelled == ['waits']
+    assert watchdog.running_handler is None
+
+
+@pytest.mark.asyncio
+async def test_a_stall_is_attributed_to_the_blocking_handler():
+    watchdog = profiling.LoopWatchdog(threshold=0.05, interval=0.01)
+    heartbeat = asyncio.create_task(watchdog.run())
+
+    async def blocks():
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+
+    async def idles():
+        await asyncio.sleep(0.5)
+
+    try:
+        idle = asyncio.create_task(watchdog.labelled('idles', idles()))
+        await watchdog.labelled('blocks', blocks())
+        await asyncio.sleep(0.05)
+        idle.cancel()
+    finally:
+        heartbeat.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await heartbeat
+
+    assert watchdog.stall_count == 1
+    stall = watchdog.stalls[0]
+    assert stall['handler'] == 'blocks'
+    assert 'blocks' in stall['stack']
@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+import app
+from storage import legacy_referral_codes
+
+EDGE_IDS = [0, 1, 2 ** 26 - 1, 2 ** 26, 5279018187, 7_000_000_000_123, 2 ** 52 - 1]
+
+
+@pytest.mark.parametrize('user_id', EDGE_IDS)
+def test_round_trip(user_id):
+    code = app.generate_referral_code(user_id)
+    assert len(code) == app.REFERRAL_CODE_LENGTH
+    assert set(code) <= set(app.BASE62_ALPHABET)
+    assert app.decode_referral_code(code) == user_id
+
+
+def test_codes_are_distinct():
+    ids = list(range(100_000, 110_000)) + EDGE_IDS
+    assert len({app.generate_referral_code(user_id) for user_id in ids}) == len(ids)
+
+
+@pytest.mark.parametrize('user_id', [-1, 2 ** 52, 2 ** 63])
+def test_out_of_range_ids_are_rejected(user_id):
+    with pytest.raises(ValueError):
+        app.generate_referral_code(user_id)
+
+
+@pytest.mark.parametrize('code', [
+    '',
+    '0a1b2c3d',  # legacy 8-hex-char code
+    '0000000000',  # too long
+    'abc-12345',
+    'abc 12345',
+    'abcé12345',
+    'zzzzzzzzz',  # 62**9 - 1 doesn't fit in 52 bits
+])
+def test_malformed_codes_do_not_decode(code):
+    assert app.decode_referral_code(code) is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_referral_code(repository):
+    assert await repository.register_user(42, app.generate_referral_code(42))
+    async with repository.sessions.begin() as session:
+        await session.execute(legacy_referral_codes.insert().values(code='0a1b2c3d', user_id=42))
+
+    assert await app.resolve_referral_code(app.generate_referral_code(42)) == 42
+    # Well-formed, but nobody with that id has registered
+    assert await app.resolve_referral_code(app.generate_referral_code(43)) is None
+    assert await app.resolve_referral_code('0a1b2c3d') == 42
+    assert await app.resolve_referral_code('ffffffff') is None
+    assert await app.resolve_referral_code('not a code') is None
+
+
+def test_migration_runs_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # A database from before the migration: 8-hex-char codes, one user without a code
+    conn = sqlite3.connect('user_database.db')
+    conn.execute('''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        points INTEGER DEFAULT 0,
+        referral_code TEXT UNIQUE,
+        referred_by INTEGER,
+        wallet_address TEXT
+    )
+    ''')
+    conn.executemany('INSERT INTO users (user_id, referral_code) VALUES (?, ?)',
+                     [(1, '0a1b2c3d'), (2, 'deadbeef'), (3, None)])
+    conn.commit()
+    conn.close()
+
+    app.init_database()
+    conn = sqlite3.connect('user_database.db')
+    codes = dict(conn.execute('SELECT user_id, referral_code FROM users'))
+    assert codes == {user_id: app.generate_referral_code(user_id) for user_id in (1, 2, 3)}
+    assert sorted(conn.execute('SELECT code, user_id FROM legacy_referral_codes')) == [
+        ('0a1b2c3d', 1), ('deadbeef', 2)
+    ]
+    assert conn.execute(
+        "SELECT COUNT(*) FROM schema_migrations WHERE name = 'referral_codes_v2'"
+    ).fetchone() == (1,)
+
+    # Recorded in schema_migrations, so a later start leaves codes alone
+    conn.execute("UPDATE users SET referral_code = 'cafebabe' WHERE user_id = 3")
+    conn.commit()
+    conn.close()
+    app.init_database()
+    conn = sqlite3.connect('user_database.db')
+    assert conn.execute('SELECT referral_code FROM users WHERE user_id = 3').fetchone() == ('cafebabe',)
+    assert conn.execute('SELECT COUNT(*) FROM legacy_referral_codes').fetchone() == (2,)
+    conn.close()
+
+
+def test_migration_is_idempotent(database):
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO users (user_id, referral_code) VALUES (1, '0a1b2c3d')")
+    cursor = conn.cursor()
+    assert app.migrate_referral_codes(cursor) == 1
+    assert app.migrate_referral_codes(cursor) == 0
+    assert cursor.execute('SELECT code, user_id FROM legacy_referral_codes').fetchall() == [('0a1b2c3d', 1)]
+    conn.close()
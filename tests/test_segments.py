@@ -0,0 +1,113 @@
+import json
+import sqlite3
+
+import pytest
+
+import app
+
+SENTINEL = 987654
+
+
+@pytest.mark.parametrize('arg, predicates, clause', [
+    ('has_wallet=yes', {'has_wallet': True}, 'wallet_address IS NOT NULL'),
+    ('has_wallet=no', {'has_wallet': False}, 'wallet_address IS NULL'),
+    ('referred=true', {'referred': True}, 'referred_by IS NOT NULL'),
+    ('referred=0', {'referred': False}, 'referred_by IS NULL'),
+    (f'min_points={SENTINEL}', {'min_points': SENTINEL}, 'points >= ?'),
+    (f'max_points={SENTINEL}', {'max_points': SENTINEL}, 'points <= ?'),
+    (f'joined_within_days={SENTINEL}', {'joined_within_days': SENTINEL}, "joined_at >= datetime('now', ?)"),
+])
+def test_each_predicate_compiles_to_parameterized_sql(arg, predicates, clause):
+    assert app.parse_segment_predicates([arg]) == predicates
+    where, params = app.compile_segment(predicates)
+    assert where == clause
+    # Values only ever travel as parameters
+    assert str(SENTINEL) not in where
+    assert all(str(SENTINEL) in str(param) for param in params)
+
+
+def test_predicates_combine_with_and():
+    where, params = app.compile_segment({'min_points': 10, 'has_wallet': True, 'max_points': 20})
+    assert where == 'wallet_address IS NOT NULL AND points <= ? AND points >= ?'
+    assert params == [20, 10]
+    assert app.compile_segment({}) == ('1', [])
+
+
+@pytest.mark.parametrize('arg', [
+    'unknown=1',
+    'min_points',
+    'points>=5',
+    'min_points=',
+    'min_points=abc',
+    'min_points=1 OR 1=1',
+    "max_points=1; DROP TABLE users",
+    'has_wallet=maybe',
+    'joined_within_days=-3',
+    'joined_within_days=1.5',
+])
+def test_unknown_keys_and_bad_values_are_rejected(arg):
+    with pytest.raises(ValueError):
+        app.parse_segment_predicates([arg])
+
+
+@pytest.fixture
+def population(database):
+    conn = sqlite3.connect(database)
+    conn.executemany(
+        "INSERT INTO users (user_id, points, wallet_address, joined_at) VALUES (?, ?, ?, datetime('now', ?))",
+        [(1, 100, None, '-40 days'), (2, 9000, 'w2', '-2 days'), (3, 7000, None, '-1 days')]
+    )
+    conn.commit()
+    conn.close()
+
+
+def members(segment):
+    query, params = app.recipient_query(segment)
+    conn = sqlite3.connect('user_database.db')
+    user_ids = sorted(row[0] for row in conn.execute(query, params))
+    conn.close()
+    return user_ids
+
+
+def test_segment_selects_matching_users(population):
+    where, params = app.compile_segment(app.parse_segment_predicates(['min_points=5000', 'joined_within_days=7']))
+    conn = sqlite3.connect('user_database.db')
+    assert sorted(row[0] for row in conn.execute(f'SELECT user_id FROM users WHERE {where}', params)) == [2, 3]
+    conn.close()
+
+
+def test_materialized_segment_refreshes_only_once_stale(population):
+    conn = sqlite3.connect('user_database.db')
+    conn.execute(
+        "INSERT INTO audience_segments (name, predicates, refresh_interval) VALUES ('rich', ?, 3600)",
+        (json.dumps({'min_points': 5000}),)
+    )
+    conn.commit()
+    assert members('rich') == [2, 3]
+    assert conn.execute("SELECT member_count FROM audience_segments").fetchone() == (2,)
+
+    # A new match is not seen while the cached set is fresh
+    conn.execute('INSERT INTO users (user_id, points) VALUES (4, 8000)')
+    conn.commit()
+    assert members('rich') == [2, 3]
+
+    conn.execute("UPDATE audience_segments SET refreshed_at = datetime('now', '-3601 seconds')")
+    conn.commit()
+    assert members('rich') == [2, 3, 4]
+    assert conn.execute("SELECT member_count FROM audience_segments").fetchone() == (3,)
+    conn.close()
+
+
+def test_live_segment_is_evaluated_every_time(population):
+    conn = sqlite3.connect('user_database.db')
+    conn.execute(
+        "INSERT INTO audience_segments (name, predicates, refresh_interval) VALUES ('wallets', ?, 0)",
+        (json.dumps({'has_wallet': True}),)
+    )
+    conn.commit()
+    assert members('wallets') == [2]
+    conn.execute("UPDATE users SET wallet_address = 'w1' WHERE user_id = 1")
+    conn.commit()
+    conn.close()
+    assert members('wallets') == [1, 2]
+    assert app.recipient_query('missing') is None
@@ -0,0 +1,128 @@
+"""Contract tests every storage backend must pass.
+
+SQLite runs in a temp dir. PostgreSQL runs when asyncpg is installed and
+POSTGRES_TEST_URL points at an empty database (e.g. a throwaway `docker run -e POSTGRES_PASSWORD=... postgres:16`);
+the tests create their tables there and drop them afterwards, and refuse to
+touch a database that already has any of them.
+"""
+import os
+import sys
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import inspect, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import (  # noqa: E402
+    Repository,
+    create_engine_for_url,
+    legacy_referral_codes,
+    metadata,
+    table_versions,
+    withdrawals,
+)
+
+POSTGRES_TEST_URL = os.environ.get('POSTGRES_TEST_URL')
+
+
+@pytest_asyncio.fixture(params=['sqlite', 'postgresql'])
+async def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        url = f"sqlite+aiosqlite:///{tmp_path / 'contract.db'}"
+    elif POSTGRES_TEST_URL:
+        pytest.importorskip('asyncpg')
+        url = POSTGRES_TEST_URL
+    else:
+        pytest.skip('set POSTGRES_TEST_URL to run against PostgreSQL')
+
+    repository = Repository(create_engine_for_url(url))
+    async with repository.engine.connect() as conn:
+        existing = await conn.run_sync(lambda sync_conn: set(inspect(sync_conn).get_table_names()))
+    clashing = existing & set(metadata.tables)
+    if clashing:
+        await repository.dispose()
+        pytest.fail(f"refusing to use a database that already has {sorted(clashing)}; point it at an empty one")
+
+    await repository.create_schema()
+    try:
+        yield repository
+    finally:
+        # Only tables this fixture created are dropped
+        async with repository.engine.begin() as conn:
+            await conn.run_sync(metadata.drop_all)
+        await repository.dispose()
+
+
+@pytest.mark.asyncio
+async def test_register_user(repo):
+    assert await repo.get_user(1) is None
+    assert await repo.register_user(1, 'code1')
+    assert not await repo.register_user(1, 'code1'), 'duplicate registration must be rejected'
+
+    user = await repo.get_user(1)
+    assert (user.points, user.referral_code, user.referred_by) == (5000, 'code1', None)
+
+
+@pytest.mark.asyncio
+async def test_legacy_referral_codes(repo):
+    assert await repo.register_user(1, 'code1')
+    async with repo.sessions.begin() as session:
+        await session.execute(legacy_referral_codes.insert().values(code='0a1b2c3d', user_id=1))
+    assert await repo.find_legacy_referral_code('0a1b2c3d') == 1
+    assert await repo.find_legacy_referral_code('missing') is None
+
+
+@pytest.mark.asyncio
+async def test_referrals_credit_referrer_and_counter(repo):
+    assert await repo.register_user(1, 'code1')
+    assert await repo.register_user(2, 'code2', referred_by=1)
+    assert await repo.register_user(3, 'code3', referred_by=1)
+    assert await repo.register_user(4, 'code4', referred_by=2)
+    assert (await repo.get_user(1)).points == 5000 + 2 * 1500
+    assert (await repo.get_user(2)).referred_by == 1
+    assert await repo.get_referral_count(1) == 2
+    assert await repo.get_referral_count(4) == 0
+    assert await repo.top_referrers(10) == [(1, 2), (2, 1)]
+    assert await repo.top_referrers(1) == [(1, 2)]
+
+    # A failed registration must not leave a partial referral credit behind
+    assert not await repo.register_user(2, 'other', referred_by=1)
+    assert await repo.get_referral_count(1) == 2
+    assert (await repo.get_user(1)).points == 5000 + 2 * 1500
+
+
+@pytest.mark.asyncio
+async def test_set_wallet(repo):
+    assert await repo.register_user(1, 'code1')
+    assert await repo.set_wallet(1, 'wallet-1')
+    versions = table_versions(['users'])
+    assert not await repo.set_wallet(99, 'wallet-99')
+    assert table_versions(['users']) == versions, 'a write that changed nothing must not invalidate caches'
+    assert (await repo.get_user(1)).wallet_address == 'wallet-1'
+
+
+@pytest.mark.asyncio
+async def test_withdraw_points(repo):
+    assert await repo.register_user(1, 'code1')
+    assert await repo.register_user(2, 'code2', referred_by=1)
+    assert await repo.register_user(3, 'code3', referred_by=1)
+
+    versions = table_versions(['users', 'withdrawals'])
+    assert not await repo.withdraw_points(1, 1234, 6500), 'stale balance must not withdraw'
+    assert table_versions(['users', 'withdrawals']) == versions
+    assert await repo.withdraw_points(1, 8000, 6500, 'wallet-1')
+    assert (await repo.get_user(1)).points == 0
+    assert not await repo.withdraw_points(1, 0, 6500)
+    assert not await repo.withdraw_points(2, 5000, 6500), 'balance below minimum'
+    async with repo.sessions() as session:
+        recorded = (await session.execute(select(withdrawals.c.user_id, withdrawals.c.points))).all()
+    assert [tuple(row) for row in recorded] == [(1, 8000)], 'only the successful withdrawal is recorded'
+
+
+@pytest.mark.asyncio
+async def test_64_bit_user_ids(repo):
+    big_id = 7_000_000_000_123
+    assert await repo.register_user(1, 'code1')
+    assert await repo.register_user(big_id, 'big', referred_by=1)
+    assert (await repo.get_user(big_id)).user_id == big_id
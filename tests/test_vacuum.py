@@ -0,0 +1,80 @@
+import logging
+import sqlite3
+
+import pytest
+
+import app
+
+
+def auto_vacuum(database):
+    conn = sqlite3.connect(database)
+    mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    conn.close()
+    return mode
+
+
+@pytest.fixture
+def legacy_database(tmp_path, monkeypatch):
+    """A user_database.db created before incremental auto_vacuum, then brought up to date."""
+    monkeypatch.chdir(tmp_path)
+    conn = sqlite3.connect('user_database.db')
+    conn.execute('CREATE TABLE legacy (value TEXT)')  # any table fixes auto_vacuum
+    conn.close()
+    app.init_database()
+    return tmp_path / 'user_database.db'
+
+
+def add_old_messages(database, count=300):
+    conn = sqlite3.connect(database)
+    conn.executemany(
+        "INSERT INTO messages (user_id, message, timestamp, status) VALUES (?, ?, datetime('now', '-400 days'), 'replied')",
+        [(i, 'x' * 2000) for i in range(count)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def test_a_new_database_starts_incremental(database):
+    assert auto_vacuum(database) == 2
+
+
+def test_startup_does_not_vacuum_an_existing_database(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    conn = sqlite3.connect('user_database.db')
+    conn.execute('CREATE TABLE legacy (value TEXT)')  # any table fixes auto_vacuum
+    conn.close()
+    with caplog.at_level(logging.WARNING):
+        app.init_database()
+    assert auto_vacuum('user_database.db') == 0
+    assert 'python app.py vacuum' in caplog.text
+
+
+def test_archiving_without_incremental_vacuum_frees_nothing(legacy_database, monkeypatch):
+    monkeypatch.setattr(app, 'MESSAGE_ARCHIVE_PAUSE', 0)
+    app.init_archive_database(app.MESSAGE_ARCHIVE_DB)
+    add_old_messages(legacy_database)
+    # Would spin forever if it waited for incremental_vacuum to empty the freelist
+    assert app.archive_messages() == (300, 0)
+
+
+def test_archiving_returns_pages_once_incremental(database, monkeypatch):
+    monkeypatch.setattr(app, 'MESSAGE_ARCHIVE_PAUSE', 0)
+    app.init_archive_database(app.MESSAGE_ARCHIVE_DB)
+    add_old_messages(database)
+    archived, freed = app.archive_messages()
+    assert archived == 300 and freed > 0
+
+
+def test_vacuum_command_switches_an_existing_database(legacy_database, capsys):
+    add_old_messages(legacy_database)
+    app.enable_incremental_vacuum()
+    assert auto_vacuum(legacy_database) == 2
+    assert 'VACUUM of user_database.db took' in capsys.readouterr().out
+
+    conn = sqlite3.connect(legacy_database)
+    assert conn.execute('SELECT COUNT(*) FROM messages').fetchone() == (300,)
+    assert conn.execute('PRAGMA integrity_check').fetchone() == ('ok',)
+    conn.close()
+
+    app.enable_incremental_vacuum()
+    assert 'already uses incremental auto_vacuum' in capsys.readouterr().out